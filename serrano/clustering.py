@@ -0,0 +1,256 @@
+"""NumPy implementation of the clustering used for field dimensions.
+
+This is equivalent to `weighted_counts` and `find_outliers` in
+`avocado.stats.kmeans` but operates on arrays rather than lists of points,
+so far larger numbers of observations can be clustered. The k-means is
+weighted by the count of each observation and uses mini-batches once the
+number of observations exceeds `DIMS_KMEANS_BATCH_SIZE`.
+
+NumPy is an optional dependency. This module must only be imported if
+`dep_supported('numpy')` is true.
+"""
+import math
+import numpy
+from serrano.conf import settings
+
+# Maximum number of elements of the distance matrix computed at once when
+# assigning observations to centroids.
+ASSIGN_CHUNK_ELEMENTS = 1000000
+
+
+def normalize(obs):
+    """Scales each dimension by its standard deviation. Dimensions with no
+    variance are set to zero. Returns the scaled array and the deviations.
+    """
+    std = obs.std(axis=0)
+    scale = numpy.where(std == 0, 1, std)
+    norm = obs / scale
+    norm[:, std == 0] = 0
+
+    return norm, std
+
+
+def assign(obs, centroids):
+    """Returns the index of the nearest centroid of each observation and the
+    distance to it.
+    """
+    n = len(obs)
+    labels = numpy.empty(n, dtype=int)
+    distances = numpy.empty(n)
+
+    size = max(ASSIGN_CHUNK_ELEMENTS // max(len(centroids), 1), 1)
+    centroid_norms = (centroids ** 2).sum(axis=1)
+
+    for start in range(0, n, size):
+        chunk = obs[start:start + size]
+
+        # Squared distances expanded as |x|^2 - 2x.c + |c|^2
+        d2 = (chunk ** 2).sum(axis=1)[:, None] - \
+            2 * numpy.dot(chunk, centroids.T) + centroid_norms
+
+        index = d2.argmin(axis=1)
+
+        labels[start:start + size] = index
+        distances[start:start + size] = numpy.sqrt(
+            numpy.maximum(d2[numpy.arange(len(chunk)), index], 0))
+
+    return labels, distances
+
+
+def initial_centroids(obs, k):
+    """Picks k initial centroids at evenly spaced positions of each
+    dimension's sorted values, like `avocado.stats.kmeans.kmeans_optm`.
+    """
+    step = max(len(obs) // k, 1)
+    offset = step // 2
+
+    return numpy.sort(obs, axis=0)[offset::step][:k].copy()
+
+
+def cluster_sums(labels, obs, weights, k):
+    "Returns the weighted sums of the observations and weights per cluster."
+    totals = numpy.bincount(labels, weights=weights, minlength=k)
+    sums = numpy.empty((k, obs.shape[1]))
+
+    for j in range(obs.shape[1]):
+        sums[:, j] = numpy.bincount(labels, weights=weights * obs[:, j],
+                                    minlength=k)
+
+    return sums, totals
+
+
+def kmeans(obs, weights, k, batch_size=None, max_iter=100, tol=1e-5):
+    """Weighted k-means of the observations. Returns the centroids of the
+    non-empty clusters.
+
+    If there are more than `batch_size` observations, mini-batches of that
+    many observations are sampled and the centroids are moved towards them
+    with a per-centroid learning rate of the inverse of the accumulated
+    weight of the centroid.
+    """
+    if batch_size is None:
+        batch_size = settings.DIMS_KMEANS_BATCH_SIZE
+
+    n = len(obs)
+    centroids = initial_centroids(obs, k)
+    k = len(centroids)
+
+    if n <= batch_size:
+        previous = None
+
+        for i in range(max_iter):
+            labels, distances = assign(obs, centroids)
+            sums, totals = cluster_sums(labels, obs, weights, k)
+
+            members = totals > 0
+            centroids[members] = sums[members] / totals[members, None]
+
+            mean = numpy.average(distances, weights=weights)
+
+            if previous is not None and abs(previous - mean) < tol:
+                break
+
+            previous = mean
+    else:
+        random = numpy.random.RandomState(0)
+        accumulated = numpy.zeros(k)
+
+        for i in range(max_iter):
+            index = random.randint(0, n, batch_size)
+            batch = obs[index]
+            batch_weights = weights[index]
+
+            labels, _ = assign(batch, centroids)
+            sums, totals = cluster_sums(labels, batch, batch_weights, k)
+
+            members = totals > 0
+            accumulated[members] += totals[members]
+
+            shift = (sums[members] -
+                     totals[members, None] * centroids[members]) / \
+                accumulated[members, None]
+
+            centroids[members] += shift
+
+            if numpy.abs(shift).max() < tol:
+                break
+
+    labels, _ = assign(obs, centroids)
+    members = numpy.bincount(labels, minlength=k) > 0
+
+    return centroids[members]
+
+
+def find_outliers(obs, threshold=3):
+    """Returns the indexes of the observations whose distance to the mean
+    of the normalized observations is at least `threshold` times the mean
+    distance.
+    """
+    norm, _ = normalize(obs)
+
+    distances = numpy.sqrt(((norm - norm.mean(axis=0)) ** 2).sum(axis=1))
+    mean = distances.mean()
+
+    if mean <= 0:
+        return numpy.array([], dtype=int)
+
+    return numpy.flatnonzero(distances / mean >= threshold)
+
+
+def weighted_counts(obs, counts, k=None, outliers=None):
+    """Clusters the observations and returns a list of points with the
+    values of each centroid and the count of the observations in the cluster
+    weighted by their distance to it, and the values of the outliers which
+    are excluded from clustering. `outliers` are the indexes of the outliers
+    if they have already been found.
+    """
+    if outliers is None:
+        outliers = find_outliers(obs)
+
+    keep = numpy.ones(len(obs), dtype=bool)
+    keep[outliers] = False
+
+    outlier_values = obs[outliers].tolist()
+    obs = obs[keep]
+    counts = counts[keep]
+
+    if not len(obs):
+        return [], outlier_values
+
+    k = k or int(math.sqrt(len(obs) / 2))
+    k = min(max(k, 1), len(obs))
+
+    norm, std = normalize(obs)
+    centroids = kmeans(norm, counts, k)
+
+    labels, distances = assign(norm, centroids)
+
+    k = len(centroids)
+    distance_sums = numpy.bincount(labels, weights=distances, minlength=k)
+    totals = distance_sums[labels]
+
+    factors = numpy.ones(len(obs))
+    nonzero = totals > 0
+    factors[nonzero] = 1 - distances[nonzero] / totals[nonzero]
+
+    weighted = numpy.bincount(labels, weights=factors * counts, minlength=k)
+
+    # The centroids are scaled back to the original dimensions. Dimensions
+    # without variance have the same value for all observations.
+    centroids = centroids * std
+    constant = std == 0
+    centroids[:, constant] = obs[0, constant]
+
+    points = []
+
+    for values, count in zip(centroids.tolist(), weighted.tolist()):
+        points.append({
+            'values': values,
+            'count': int(count),
+        })
+
+    return points, outlier_values
+
+
+def cluster_rows(rows, cluster, k=None):
+    """Clusters rows of (count, value, ...) of numeric dimensions.
+
+    Rows with null values are not clustered and are appended to the
+    points. If `cluster` is false, the points are returned as is, except
+    for the outliers. Returns the points and the outliers.
+    """
+    numeric = []
+    null_points = []
+
+    for row in rows:
+        if None in row:
+            null_points.append({'count': row[0], 'values': list(row[1:])})
+        else:
+            numeric.append(row)
+
+    if not numeric:
+        return null_points, []
+
+    # Decimals are converted to floats by NumPy. The floats are only used
+    # to compute the clusters and outliers, the values of the rows are
+    # returned as is.
+    data = numpy.array(numeric, dtype=float)
+    counts = data[:, 0]
+    obs = data[:, 1:]
+
+    indexes = find_outliers(obs)
+
+    if cluster:
+        points, _ = weighted_counts(obs, counts, k, outliers=indexes)
+        outliers = [list(numeric[i][1:]) for i in indexes]
+    else:
+        keep = numpy.ones(len(obs), dtype=bool)
+        keep[indexes] = False
+
+        outliers = [{'count': numeric[i][0], 'values': list(numeric[i][1:])}
+                    for i in indexes]
+
+        points = [{'count': row[0], 'values': list(row[1:])}
+                  for row, kept in zip(numeric, keep) if kept]
+
+    return points + null_points, outliers
@@ -0,0 +1,166 @@
+import zlib
+from django.utils.cache import patch_vary_headers
+from serrano.conf import settings, dep_supported
+
+
+def _gzip_compressobj():
+    # The window bits offset of 16 produces a gzip header and trailer.
+    return zlib.compressobj(settings.COMPRESSION_LEVEL, zlib.DEFLATED,
+                            16 + zlib.MAX_WBITS)
+
+
+class GzipCompressor(object):
+    def __init__(self):
+        self.compressobj = _gzip_compressobj()
+
+    def compress(self, data):
+        # A sync flush is performed so the data written so far can be
+        # decompressed by the client while the stream continues.
+        return self.compressobj.compress(data) + \
+            self.compressobj.flush(zlib.Z_SYNC_FLUSH)
+
+    def flush(self):
+        return self.compressobj.flush()
+
+
+class ZstdCompressor(object):
+    def __init__(self):
+        import zstandard
+        self.flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        self.compressobj = zstandard.ZstdCompressor().compressobj()
+
+    def compress(self, data):
+        return self.compressobj.compress(data) + \
+            self.compressobj.flush(self.flush_block)
+
+    def flush(self):
+        return self.compressobj.flush()
+
+
+# Supported content codings in order of preference.
+COMPRESSORS = (
+    ('zstd', ZstdCompressor),
+    ('gzip', GzipCompressor),
+)
+
+
+def get_encodings():
+    "Returns the content codings available in order of preference."
+    encodings = []
+
+    for encoding, compressor in COMPRESSORS:
+        if encoding == 'zstd' and not dep_supported('zstandard'):
+            continue
+
+        encodings.append(encoding)
+
+    return encodings
+
+
+def parse_accept_encoding(header):
+    "Parses an Accept-Encoding header into a dict of codings and q-values."
+    codings = {}
+
+    for item in header.split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+
+        if not coding:
+            continue
+
+        q = 1.0
+
+        for param in parts[1:]:
+            key, _, value = param.partition('=')
+
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+
+        codings[coding] = q
+
+    return codings
+
+
+def get_encoding(request):
+    """Returns the content coding to use for the response or None if the
+    client does not accept any of the supported codings.
+    """
+    header = request.META.get('HTTP_ACCEPT_ENCODING')
+
+    if not header:
+        return
+
+    codings = parse_accept_encoding(header)
+    default = codings.get('*', 0.0)
+
+    best = None
+    best_q = 0.0
+
+    # Ties are broken by the server preference.
+    for encoding in get_encodings():
+        q = codings.get(encoding, default)
+
+        if q > best_q:
+            best = encoding
+            best_q = q
+
+    return best
+
+
+def get_compressor(encoding):
+    return dict(COMPRESSORS)[encoding]()
+
+
+def compress(data, encoding):
+    compressor = get_compressor(encoding)
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_stream(iterable, encoding):
+    "Generator that compresses the chunks of an iterable."
+    compressor = get_compressor(encoding)
+
+    for chunk in iterable:
+        if chunk:
+            data = compressor.compress(chunk)
+
+            if data:
+                yield data
+
+    yield compressor.flush()
+
+
+def patch_response(request, response):
+    """Compresses the response content using a coding accepted by the
+    client. Streaming responses are compressed as they are streamed.
+    """
+    if not settings.COMPRESSION_ENABLED or \
+            response.has_header('Content-Encoding'):
+        return response
+
+    patch_vary_headers(response, ('Accept-Encoding',))
+
+    encoding = get_encoding(request)
+
+    if encoding is None:
+        return response
+
+    if response.streaming:
+        response.streaming_content = compress_stream(
+            response.streaming_content, encoding)
+
+        if response.has_header('Content-Length'):
+            del response['Content-Length']
+    else:
+        if len(response.content) < settings.COMPRESSION_MIN_SIZE:
+            return response
+
+        response.content = compress(response.content, encoding)
+        response['Content-Length'] = str(len(response.content))
+
+    response['Content-Encoding'] = encoding
+
+    return response
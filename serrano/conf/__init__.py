@@ -65,6 +65,13 @@ def test_setting_changed_handler(**kwargs):
     elif kwargs['setting'].startswith(SETTING_PREFIX):
         key = kwargs['setting'][SETTING_PREFIX_LEN:]
         value = kwargs['value']
+
+        # The setting no longer exists once the override is disabled, so
+        # the project's value or the default is restored.
+        if value is None and not hasattr(django_settings, kwargs['setting']):
+            value = getattr(django_settings, 'SERRANO', {}).get(
+                key, getattr(global_settings, key, None))
+
         setattr(settings, key, value)
 
 
@@ -121,10 +128,45 @@ class Objectset(Dependency):
             return False
 
 
+class Zstandard(Dependency):
+    """zstandard provides bindings to the Zstandard compression library.
+
+    Install by doing `pip install zstandard`. When installed, export and
+    preview responses are compressed using zstd for clients that accept it.
+    """
+
+    name = 'zstandard'
+
+    def test_install(self):
+        try:
+            import zstandard  # noqa
+        except ImportError:
+            return False
+
+
+class Numpy(Dependency):
+    """NumPy provides fast operations on numeric arrays.
+
+    Install by doing `pip install numpy`. When installed, the clustering of
+    field dimensions is vectorized which allows far more observations to be
+    clustered.
+    """
+
+    name = 'numpy'
+
+    def test_install(self):
+        try:
+            import numpy  # noqa
+        except ImportError:
+            return False
+
+
 # Keep track of the officially supported apps and libraries used for various
 # features.
 OPTIONAL_DEPS = {
+    'numpy': Numpy(),
     'objectset': Objectset(),
+    'zstandard': Zstandard(),
 }
 
 
@@ -47,6 +47,19 @@ AUTH_RATE_LIMIT_COUNT = None
 # will default to RATE_LIMIT_SECONDS.
 AUTH_RATE_LIMIT_SECONDS = None
 
+# Number of buckets the rate limiting interval is divided into. Requests are
+# counted per bucket and the counts of the buckets of the last interval are
+# summed, so the interval slides by the width of a bucket. At most
+# RATE_LIMIT_COUNT * (1 + 1 / RATE_LIMIT_BUCKETS) requests are accepted in
+# any interval.
+RATE_LIMIT_BUCKETS = 10
+
+# Number of seconds a process rejects the requests of a client that has
+# exceeded its rate limit without checking the cache. This reduces cache
+# traffic from clients that keep retrying, but the client may be rejected
+# for up to this many seconds after its interval ends. Disabled if None.
+RATE_LIMIT_LOCAL_SECONDS = None
+
 # Name of the reverseable url to use when constructing query urls in emails
 # notifying people that a query has been shared with them.
 QUERY_REVERSE_NAME = None
@@ -77,3 +90,160 @@ STATS_CAPABLE = lambda x: not x.searchable
 
 # Time to wait when performing a single count on the stats endpoint.
 STATS_COUNT_TIMEOUT = 5
+
+# Number of threads in the process-wide pool that counts on the stats
+# endpoint are executed in. Each thread keeps its own database connection
+# which is reused between counts subject to CONN_MAX_AGE.
+STATS_COUNT_WORKERS = 4
+
+# Maximum number of counts a single request executes concurrently in the
+# pool. Lower this to share the pool fairly between concurrent requests. If
+# this setting is not explicitly set, it will default to half of
+# STATS_COUNT_WORKERS so a single request cannot occupy the whole pool.
+STATS_COUNT_REQUEST_LIMIT = None
+
+# Maximum number of counts combined into a single statement on the stats
+# endpoint. Counts against the same database are executed as `UNION ALL`
+# subqueries and the batches are executed in parallel in the pool. Set to
+# 0 to execute each count as its own query.
+STATS_COUNT_BATCH_SIZE = 10
+
+# Number of registers, as a power of two, of the HyperLogLog sketches used
+# for approximate distinct counts on the field stats endpoint with
+# `approx=true`. The relative standard error of a count is
+# 1.04 / sqrt(2 ** precision), about 1.6% for the default of 12.
+STATS_SKETCH_PRECISION = 12
+
+# Number of primary key ranges a sketch is built from in parallel by the
+# `build_sketches` command. Built sketches are used for the unfiltered
+# counts of a field. Sketches of filtered counts are only computed, in SQL,
+# on PostgreSQL.
+STATS_SKETCH_PARTITIONS = 4
+
+# Time to wait for a single partition of a sketch to be built.
+STATS_SKETCH_TIMEOUT = 30
+
+# Number of equal-width buckets the approximate quantiles of numeric
+# fields are interpolated from on the field stats endpoint. The error of a
+# quantile is at most the range of the values divided by this number.
+STATS_QUANTILE_BUCKETS = 100
+
+# Maximum number of observations the field dimensions endpoint clusters
+# when NumPy is installed. Without NumPy, the limit is 50000.
+DIMS_MAXIMUM_OBSERVATIONS = 1000000
+
+# Number of observations sampled per iteration of the mini-batch k-means
+# used for field dimensions when NumPy is installed. Fewer observations
+# are clustered using all of them in each iteration.
+DIMS_KMEANS_BATCH_SIZE = 10000
+
+# Combinations of fields to pre-aggregate counts for on the field dimensions
+# endpoint. Each combination is a list of field keys, either primary keys
+# or dotted natural keys, e.g. `['tests.title.salary', 'tests.title.name']`.
+# Requests for any subset of the fields of a combination are answered from
+# the stored counts when the default tree and query processor are used and
+# the context only has conditions on those fields. See `serrano.cubes`.
+DIMS_CUBES = ()
+
+# Maximum number of bins returned by the field distribution endpoint when
+# the values are binned using the `bins`, `bin_width` or `interval`
+# parameters. Requests that would produce more bins are rejected.
+DIST_MAXIMUM_BINS = 1000
+
+# Dotted path to the class used to index field values for searching. When
+# set, the `query` lookup on the field values endpoint is answered by an
+# in-memory index rather than scanning the table. The built-in index is
+# `serrano.index.NgramIndex`. See `serrano.index.FieldValueIndex` for the
+# interface. Indexes are built by the `build_indexes` command and written to
+# files in FIELD_VALUE_INDEX_DIR, which must be shared by the web processes
+# and defaults to the system temporary directory. Fields whose index has not
+# been built for their current data version are searched in the database.
+# By default, no index is used.
+FIELD_VALUE_INDEX = None
+FIELD_VALUE_INDEX_DIR = None
+
+# Number of submitted values or labels validated per query by the field
+# values endpoint. Large lists are validated in chunks to bound the size
+# of the IN clauses, which must stay below the parameter limit of the
+# database, e.g. 999 for SQLite. With `bulk=true`, the validated chunks
+# are streamed to the client followed by the counts of valid and invalid
+# values.
+VALUES_VALIDATE_CHUNK_SIZE = 500
+
+# If true, paginated resources respond with the last-known count or the
+# count estimated by the query planner (PostgreSQL only) when the exact
+# count is not cached, rather than blocking on a full count. The exact
+# count is refreshed in the background and the response is marked as
+# approximate.
+PAGINATOR_APPROXIMATE_COUNTS = False
+
+# List/tuple of export types that are streamed to the client rather than
+# written to the response in full before it is sent. Only exporters that
+# write rows incrementally benefit from streaming. Exporters that build
+# archives, such as SAS and R, require the complete output.
+STREAMING_EXPORT_TYPES = ('csv',)
+
+# Size in bytes of the chunks sent to the client when streaming and the
+# maximum number of chunks buffered while the client is reading.
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_MAX_CHUNKS = 16
+
+# Number of rows fetched at a time from the server-side cursor used when
+# streaming exports. Only applies to PostgreSQL.
+STREAM_CURSOR_ITERSIZE = 2000
+
+# Boolean denoting whether export and preview responses are compressed when
+# the client accepts a supported content coding. gzip is always supported,
+# zstd is supported if the zstandard library is installed.
+COMPRESSION_ENABLED = True
+
+# Compression level used for gzip (1-9) and the minimum size in bytes of a
+# non-streaming response for it to be compressed.
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_SIZE = 1024
+
+# The page range of an export requested with the `parallel` parameter is
+# split into at most this many ranges, each computed by an async job, so
+# they are computed by as many async workers as are running. The export
+# fails if the ranges are not done within the timeout in seconds.
+EXPORT_PARALLEL_JOBS = 4
+EXPORT_PARALLEL_TIMEOUT = 60 * 10
+
+# Async jobs with the same context, view, export type, page range and
+# processor are deduplicated while a matching job is queued or running. By
+# default jobs are only shared by requests of the same user. Set to true to
+# share jobs across users, which is only safe if the query processors do
+# not depend on the requesting user.
+SHARE_ASYNC_JOBS = False
+
+# Minimum number of seconds between updates of the progress of an async
+# job. The progress is stored in the default cache, which must be shared
+# by the workers and the web processes.
+JOB_PROGRESS_INTERVAL = 1
+
+# Bounds of the Retry-After header, in seconds, returned for pending jobs.
+# Within the bounds, the value is the estimated time remaining.
+JOB_RETRY_AFTER_MIN = 1
+JOB_RETRY_AFTER_MAX = 30
+
+# Maximum number of seconds a request to a job or job result may block
+# waiting for the job to finish using the `wait` parameter. Each waiting
+# request holds a web worker, so this should be kept short.
+JOB_WAIT_MAX = 30
+
+# Number of seconds the results of async jobs are kept.
+JOB_RESULT_TTL = 60 * 60
+
+# Results of async jobs with at least this many rows are written to a file
+# in JOB_SPILL_DIR rather than stored in the job store, which only keeps a
+# handle to the file. The directory must be shared by the workers and the
+# web processes and defaults to the system temporary directory. Spilled
+# results are removed when the job is deleted or after JOB_RESULT_TTL
+# seconds. Set to None to keep all results in the job store.
+JOB_SPILL_ROWS = 10000
+JOB_SPILL_DIR = None
+
+# Number of seconds the session DataContext and DataView of a user or
+# session are cached across requests. The cache is invalidated when they are
+# saved through the API. Set to None to disable the cache.
+SESSION_OBJECT_CACHE_TIMEOUT = 60 * 60
@@ -0,0 +1,284 @@
+"""Pre-aggregated counts for field dimensions.
+
+The field dimensions endpoint groups the rows of the tree by the selected
+fields and counts them, which requires a join and aggregation over the
+whole tree on every request. A cube holds the counts grouped by a
+configured combination of fields so the counts for any subset of its
+fields can be computed from the cube without touching the database.
+
+Cubes are configured with the DIMS_CUBES setting and stored in the data
+cache. A cube is keyed by the `data_version` of its fields, so each cube is
+rebuilt independently when the data of one of its fields changes. Cubes
+can be built ahead of time using `refresh_cubes`.
+
+Only the default tree and query processor are supported. Contexts are
+evaluated against the cube if they consist of conditions on the cube's
+fields combined with AND. Otherwise the counts are computed by the
+database.
+"""
+from django.core.cache import get_cache
+from django.db.models import Count
+from modeltree.tree import MODELTREE_DEFAULT_ALIAS, trees
+from avocado.conf import settings as avocado_settings
+from avocado.core.cache import cache_key
+from avocado.core.cache.model import NEVER_EXPIRE
+from avocado.models import DataField
+from avocado.query import pipeline
+from serrano.conf import settings
+
+
+def _lt(value, other):
+    return value < other
+
+
+def _lte(value, other):
+    return value <= other
+
+
+def _gt(value, other):
+    return value > other
+
+
+def _gte(value, other):
+    return value >= other
+
+
+def _exact(value, other):
+    return value == other
+
+
+def _in(value, other):
+    return value in other
+
+
+def _range(value, other):
+    return other[0] <= value <= other[1]
+
+
+def _notnull(value, other):
+    return True
+
+
+# Operators that can be evaluated against the values of a cube. Null values
+# never match, which is equivalent to the database.
+OPERATORS = {
+    'exact': _exact,
+    'in': _in,
+    'lt': _lt,
+    'lte': _lte,
+    'gt': _gt,
+    'gte': _gte,
+    'range': _range,
+}
+
+
+def get_field(key):
+    """Returns the DataField for a key which is either a primary key, a
+    dotted natural key or a list of the natural key's components.
+    """
+    if isinstance(key, basestring):
+        key = key.split('.')
+
+    if isinstance(key, (list, tuple)):
+        return DataField.objects.get_by_natural_key(*key)
+
+    return DataField.objects.get_by_natural_key(int(key))
+
+
+class Cube(object):
+    "Counts of the rows of the tree grouped by the values of fields."
+
+    def __init__(self, fields, tree=MODELTREE_DEFAULT_ALIAS):
+        self.fields = list(fields)
+        self.tree = tree
+        self.pks = [f.pk for f in self.fields]
+
+    def get_key(self):
+        version = ':'.join([str(f.data_version) for f in self.fields])
+
+        return cache_key('serrano:cube', version=version,
+                         kwargs={'fields': self.pks, 'tree': self.tree})
+
+    def build(self):
+        "Computes the counts and stores them in the cache."
+        tree = trees[self.tree]
+
+        QueryProcessor = pipeline.query_processors['default']
+        queryset = QueryProcessor(tree=tree).get_queryset()
+
+        groupby = [tree.query_string_for_field(f.field, model=f.model)
+                   for f in self.fields]
+
+        rows = list(queryset.values(*groupby)
+                    .annotate(count=Count(tree.root_model._meta.pk.name))
+                    .values_list('count', *groupby).order_by())
+
+        cache = get_cache(avocado_settings.DATA_CACHE)
+        cache.set(self.get_key(), rows, timeout=NEVER_EXPIRE)
+
+        return rows
+
+    def get_rows(self):
+        "Returns the rows of (count, value, ...), building them if stale."
+        cache = get_cache(avocado_settings.DATA_CACHE)
+        rows = cache.get(self.get_key())
+
+        if rows is None:
+            rows = self.build()
+
+        return rows
+
+    def is_stale(self):
+        cache = get_cache(avocado_settings.DATA_CACHE)
+        return cache.get(self.get_key()) is None
+
+    def covers(self, fields):
+        "Returns true if the cube includes the fields."
+        pks = set(self.pks)
+
+        for f in fields:
+            if f.pk not in pks:
+                return False
+
+        return True
+
+    def get_index(self, key):
+        "Returns the index of the field for a context field key or None."
+        if isinstance(key, basestring):
+            key = tuple(key.split('.'))
+        elif isinstance(key, list):
+            key = tuple(key)
+
+        for i, f in enumerate(self.fields):
+            if key == f.pk or key == f.natural_key():
+                return i
+
+    def get_conditions(self, context):
+        """Returns the conditions of the context as (index, match, value,
+        negated) tuples or None if the context cannot be evaluated against
+        the cube.
+        """
+        if not context:
+            return []
+
+        if context.get('enabled') is False:
+            return []
+
+        if 'children' in context:
+            if context.get('type', 'and') != 'and':
+                return
+
+            conditions = []
+
+            for child in context['children']:
+                child_conditions = self.get_conditions(child)
+
+                if child_conditions is None:
+                    return
+
+                conditions.extend(child_conditions)
+
+            return conditions
+
+        if 'field' not in context or 'operator' not in context:
+            return
+
+        index = self.get_index(context['field'])
+
+        if index is None:
+            return
+
+        operator = context['operator']
+        negated = operator.startswith('-')
+        operator = operator.lstrip('-')
+        value = context.get('value')
+
+        if operator == 'isnull':
+            # Null values are matched by negating a match of any value.
+            negated = negated != bool(value)
+            return [(index, _notnull, None, negated)]
+
+        if operator not in OPERATORS:
+            return
+
+        field = self.fields[index].field
+
+        try:
+            if isinstance(value, (list, tuple)):
+                value = [field.to_python(v) for v in value]
+            else:
+                value = field.to_python(value)
+        except Exception:
+            return
+
+        return [(index, OPERATORS[operator], value, negated)]
+
+    def match(self, values, conditions):
+        for index, match, value, negated in conditions:
+            # Nulls never match a condition, so they match a negated one.
+            matched = values[index] is not None and \
+                match(values[index], value)
+
+            if matched == negated:
+                return False
+
+        return True
+
+    def rollup(self, fields, conditions=None, nulls=False):
+        """Returns rows of (count, value, ...) for the fields, which must be
+        covered by the cube, for the cells matching the conditions. Groups
+        with null values are excluded unless `nulls` is true.
+        """
+        indexes = [self.pks.index(f.pk) for f in fields]
+        counts = {}
+
+        for row in self.get_rows():
+            values = row[1:]
+
+            if conditions and not self.match(values, conditions):
+                continue
+
+            key = tuple([values[i] for i in indexes])
+
+            if not nulls and None in key:
+                continue
+
+            counts[key] = counts.get(key, 0) + row[0]
+
+        return [(count,) + k for k, count in counts.items()]
+
+
+def get_cubes():
+    "Returns the cubes configured by DIMS_CUBES."
+    cubes = []
+
+    for keys in settings.DIMS_CUBES:
+        try:
+            cubes.append(Cube([get_field(key) for key in keys]))
+        except DataField.DoesNotExist:
+            continue
+
+    return cubes
+
+
+def find_cube(fields, tree=MODELTREE_DEFAULT_ALIAS):
+    "Returns the smallest cube that covers the fields or None."
+    if tree != MODELTREE_DEFAULT_ALIAS or not settings.DIMS_CUBES:
+        return
+
+    cubes = [c for c in get_cubes() if c.covers(fields)]
+
+    if cubes:
+        return min(cubes, key=lambda c: len(c.fields))
+
+
+def refresh_cubes():
+    "Builds the cubes that are stale and returns the number built."
+    built = 0
+
+    for cube in get_cubes():
+        if cube.is_stale():
+            cube.build()
+            built += 1
+
+    return built
@@ -0,0 +1,310 @@
+"""In-memory search indexes for field values.
+
+Searching field values through the database results in an `icontains`
+scan of the underlying table for every lookup, which is too slow for
+typeahead on large tables. An index holds the distinct values of a field
+along with their labels and answers substring lookups without touching
+the database.
+
+Building an index reads all of the field's values, so it is never done in
+a request. Indexes are built ahead of time by the `build_indexes` command,
+which writes them to files in FIELD_VALUE_INDEX_DIR named by the field's
+`data_version`. Indexes are far larger than the item limit of cache
+backends such as memcached, so they are not stored in the cache. Each
+process loads the index of a field from its file on first use and keeps it
+in memory. If the index has not been built, or the data has been modified
+since, searches fall back to the database until the command is run again.
+"""
+import os
+import glob
+import logging
+import tempfile
+import threading
+import cPickle as pickle
+from array import array
+from django.utils.encoding import smart_unicode
+from django.utils.importlib import import_module
+from serrano.conf import settings
+
+log = logging.getLogger(__name__)
+
+
+class FieldValueIndex(object):
+    """Base class for field value indexes.
+
+    Subclasses must implement `add` and `search`. The values are added in
+    the field's order so search results are returned in the same order
+    the database search would have returned them.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.version = field.data_version
+
+    def get_rows(self, queryset=None):
+        "Returns an iterator of (value, label, search text) rows."
+        field = self.field
+
+        if queryset is None:
+            queryset = field.model.objects.all()
+
+        names = (field.value_field.name, field.label_field.name,
+                 field.search_field.name)
+
+        return queryset.values_list(*names)\
+            .order_by(field.order_field.name).distinct().iterator()
+
+    def build(self, queryset=None):
+        "Builds the index from the field's data."
+        for value, label, text in self.get_rows(queryset):
+            self.add(value, label, text)
+
+    def add(self, value, label, text):
+        "Adds a value to the index. `text` is the searched representation."
+        raise NotImplementedError
+
+    def search(self, query):
+        "Returns a list of (value, label) pairs matching the query."
+        raise NotImplementedError
+
+
+class NgramIndex(FieldValueIndex):
+    """Inverted index of character n-grams.
+
+    Each gram of the search text up to `size` characters maps to a sorted
+    array of value positions. Lookups intersect the positions of the
+    query's grams and verify the candidates against the search text,
+    which makes the lookup equivalent to a case-insensitive substring
+    match.
+    """
+
+    size = 3
+
+    def __init__(self, field):
+        super(NgramIndex, self).__init__(field)
+
+        self.values = []
+        self.labels = []
+        self.texts = []
+        self.positions = {}
+        self.grams = {}
+
+    def _grams(self, text):
+        grams = set()
+
+        for size in range(1, self.size + 1):
+            for i in range(len(text) - size + 1):
+                grams.add(text[i:i + size])
+
+        return grams
+
+    def add(self, value, label, text):
+        if text is None:
+            text = u''
+        else:
+            text = smart_unicode(text).lower()
+
+        # Values may have more than one search text, all of which are
+        # indexed against the same position.
+        if value in self.positions:
+            position = self.positions[value]
+            self.texts[position] += u'\x00' + text
+        else:
+            position = len(self.values)
+            self.positions[value] = position
+            self.values.append(value)
+            self.labels.append(smart_unicode(label))
+            self.texts.append(text)
+
+        for gram in self._grams(text):
+            postings = self.grams.get(gram)
+
+            if postings is None:
+                self.grams[gram] = array('l', [position])
+            elif postings[-1] != position:
+                # Positions are normally appended in order. Out of order
+                # positions only occur for values with multiple search
+                # texts and are rare, so the array is resorted.
+                if postings[-1] < position:
+                    postings.append(position)
+                elif position not in postings:
+                    self.grams[gram] = array(
+                        'l', sorted(postings.tolist() + [position]))
+
+    def _candidates(self, query):
+        if len(query) <= self.size:
+            return self.grams.get(query, ())
+
+        grams = set()
+        for i in range(len(query) - self.size + 1):
+            grams.add(query[i:i + self.size])
+
+        postings = sorted([self.grams.get(g, ()) for g in grams], key=len)
+
+        if not postings[0]:
+            return ()
+
+        candidates = set(postings[0])
+
+        for other in postings[1:]:
+            candidates.intersection_update(other)
+
+            if not candidates:
+                break
+
+        return sorted(candidates)
+
+    def search(self, query):
+        query = smart_unicode(query).lower()
+
+        if not query:
+            return list(zip(self.values, self.labels))
+
+        results = []
+
+        for position in self._candidates(query):
+            if query in self.texts[position]:
+                results.append((self.values[position],
+                                self.labels[position]))
+
+        return results
+
+
+# Process-level registry of built indexes keyed by field primary key.
+_indexes = {}
+_lock = threading.Lock()
+
+# Primary keys of the fields whose index is being loaded.
+_loading = set()
+
+
+def get_index_class():
+    path = settings.FIELD_VALUE_INDEX
+
+    if not path:
+        return
+
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(import_module(module_name), class_name)
+
+
+def get_index_dir():
+    return settings.FIELD_VALUE_INDEX_DIR or tempfile.gettempdir()
+
+
+def get_index_path(field, klass, version=None):
+    "Returns the path of the index file of the field."
+    if version is None:
+        version = field.data_version
+
+    name = 'serrano-index-{0}-{1}-{2}.pickle'.format(
+        field.pk, klass.__name__, version)
+
+    return os.path.join(get_index_dir(), name)
+
+
+def register_index(index):
+    with _lock:
+        _indexes[index.field.pk] = index
+
+
+def build_index(field, queryset=None):
+    """Builds the index for the field, writes it to the field's index file
+    and registers it in this process. This reads all of the field's values,
+    so it is only done by the `build_indexes` command.
+
+    Returns None if no index class is configured.
+    """
+    klass = get_index_class()
+
+    if klass is None:
+        return
+
+    index = klass(field)
+    index.build(queryset)
+
+    path = get_index_path(field, klass)
+
+    # The index is written to a temporary file which is renamed so other
+    # processes never read a partially written index.
+    fd, tmp = tempfile.mkstemp(prefix='serrano-index-', suffix='.tmp',
+                               dir=get_index_dir())
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+
+        os.rename(tmp, path)
+    except Exception:
+        os.remove(tmp)
+        raise
+
+    # Remove the indexes of previous data versions.
+    pattern = get_index_path(field, klass, version='*')
+
+    for other in glob.glob(pattern):
+        if other != path:
+            try:
+                os.remove(other)
+            except OSError:
+                pass
+
+    register_index(index)
+
+    return index
+
+
+def load_index(field, klass):
+    "Loads the index of the field from its file or returns None."
+    path = get_index_path(field, klass)
+
+    if not os.path.exists(path):
+        return
+
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except Exception:
+        log.exception('error loading the index of "{0}"'.format(field))
+
+
+def get_index(field):
+    """Returns the index for the field if it is current.
+
+    Otherwise the index is loaded from its file if it has been built for
+    the field's data version. None is returned if it has not been built or
+    is being loaded by another thread, so the search falls back to the
+    database.
+    """
+    klass = get_index_class()
+
+    if klass is None:
+        return
+
+    index = _indexes.get(field.pk)
+
+    if index is not None and isinstance(index, klass) \
+            and index.version == field.data_version:
+        return index
+
+    with _lock:
+        if field.pk in _loading:
+            return
+
+        _loading.add(field.pk)
+
+    try:
+        index = load_index(field, klass)
+    finally:
+        with _lock:
+            _loading.discard(field.pk)
+
+    if index is not None:
+        register_index(index)
+
+    return index
+
+
+def clear_indexes():
+    with _lock:
+        _indexes.clear()
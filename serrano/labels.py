@@ -0,0 +1,207 @@
+"""Value-label maps of fields shared across requests.
+
+`DataField.value_labels` queries the distinct values and labels of a field
+for every queryset it is called with. Since the label of a value does not
+depend on the queryset, a single map of all of the field's values is built
+and used for any queryset.
+
+The map is stored in the data cache as parallel tuples of the sorted
+values and their labels, which is far smaller than a dict when pickled and
+in memory. Labels are looked up by bisecting the values. The map is keyed
+by the field's `data_version` so it is rebuilt when the data changes. The
+pickled map is split into chunks since cache backends such as memcached
+limit the size of an item. If Avocado's data cache is disabled, the map is
+built whenever it is used.
+
+Callers that only need the labels of a few values use `get_labels`, which
+queries the labels of just those values.
+"""
+import cPickle as pickle
+from bisect import bisect_left
+from django.core.cache import get_cache
+from django.utils.encoding import smart_unicode
+from avocado.conf import settings as avocado_settings
+from avocado.core.cache import cache_key
+from avocado.core.cache.model import NEVER_EXPIRE
+
+# Size in bytes of the chunks of a pickled map stored in the cache, which is
+# below memcached's default item limit of 1 MB.
+CHUNK_SIZE = 512 * 1024
+
+# Number of values per query when looking up the labels of values.
+LABELS_QUERY_SIZE = 1000
+
+
+class LabelMap(object):
+    """Read-only mapping of values to labels backed by sorted parallel
+    tuples. The label of a null value is kept separately since nulls cannot
+    be compared with values of all types.
+    """
+
+    def __init__(self, pairs=()):
+        null = None
+        items = []
+
+        for value, label in pairs:
+            if value is None:
+                null = label
+            else:
+                items.append((value, label))
+
+        items.sort(key=lambda item: item[0])
+
+        if items:
+            self.values, self.labels = [tuple(t) for t in zip(*items)]
+        else:
+            self.values, self.labels = (), ()
+
+        self.null = null
+
+    def _index(self, value):
+        try:
+            i = bisect_left(self.values, value)
+        except TypeError:
+            return
+
+        if i < len(self.values) and self.values[i] == value:
+            return i
+
+    def get(self, value, default=None):
+        if value is None:
+            return default if self.null is None else self.null
+
+        i = self._index(value)
+
+        if i is None:
+            return default
+
+        return self.labels[i]
+
+    def __contains__(self, value):
+        if value is None:
+            return self.null is not None
+
+        return self._index(value) is not None
+
+    def __getitem__(self, value):
+        if value not in self:
+            raise KeyError(value)
+
+        return self.get(value)
+
+    def __len__(self):
+        return len(self.values) + (self.null is not None)
+
+    def __getstate__(self):
+        return (self.values, self.labels, self.null)
+
+    def __setstate__(self, state):
+        self.values, self.labels, self.null = state
+
+
+def get_label_pairs(field):
+    "Returns the distinct (value, label) pairs of all of the field's rows."
+    if field.field.choices:
+        return [(v, smart_unicode(l)) for v, l in field.field.choices]
+
+    queryset = field.model.objects.values_list(
+        field.value_field.name, field.label_field.name).order_by().distinct()
+
+    return [(v, smart_unicode(l)) for v, l in queryset.iterator()]
+
+
+def get_labels(field, values):
+    """Returns a dict of the labels of the given values of the field. Only
+    the given values are queried, which is cheaper than building the map of
+    all of the field's values for a limited number of values.
+    """
+    if field.field.choices:
+        return dict(get_label_pairs(field))
+
+    values = list(set([value for value in values if value is not None]))
+    lookup = '{0}__in'.format(field.value_field.name)
+    labels = {}
+
+    for i in range(0, len(values), LABELS_QUERY_SIZE):
+        chunk = values[i:i + LABELS_QUERY_SIZE]
+
+        queryset = field.model.objects.filter(**{lookup: chunk})\
+            .values_list(field.value_field.name, field.label_field.name)\
+            .order_by().distinct()
+
+        for value, label in queryset.iterator():
+            labels[value] = smart_unicode(label)
+
+    return labels
+
+
+def get_label_map_key(field):
+    return cache_key('serrano:labels', version=field.data_version,
+                     kwargs={'pk': field.pk,
+                             'value': field.value_field.name,
+                             'label': field.label_field.name})
+
+
+def set_chunked(cache, key, obj, chunk_size=None):
+    """Stores the pickled object in the cache in chunks of `chunk_size`
+    bytes, which defaults to CHUNK_SIZE.
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    chunks = {}
+
+    for i in range(0, max(len(data), 1), chunk_size):
+        chunks['{0}:{1}'.format(key, len(chunks))] = data[i:i + chunk_size]
+
+    cache.set_many(chunks, timeout=NEVER_EXPIRE)
+
+    # The number of chunks is set last so a partially stored object is not
+    # read.
+    cache.set(key, len(chunks), timeout=NEVER_EXPIRE)
+
+
+def get_chunked(cache, key):
+    """Returns the object stored by `set_chunked` or None if it or any of
+    its chunks are not in the cache.
+    """
+    count = cache.get(key)
+
+    if count is None:
+        return
+
+    keys = ['{0}:{1}'.format(key, i) for i in range(count)]
+    chunks = cache.get_many(keys)
+
+    if len(chunks) != count:
+        return
+
+    return pickle.loads(''.join([chunks[k] for k in keys]))
+
+
+def build_label_map(field):
+    "Builds and caches the value-label map of the field."
+    labels = LabelMap(get_label_pairs(field))
+
+    if avocado_settings.DATA_CACHE_ENABLED:
+        cache = get_cache(avocado_settings.DATA_CACHE)
+        set_chunked(cache, get_label_map_key(field), labels)
+
+    return labels
+
+
+def get_value_labels(field):
+    """Returns the cached value-label map of the field or builds it. Values
+    of any queryset of the field can be looked up in the map.
+    """
+    if not avocado_settings.DATA_CACHE_ENABLED:
+        return build_label_map(field)
+
+    cache = get_cache(avocado_settings.DATA_CACHE)
+    labels = get_chunked(cache, get_label_map_key(field))
+
+    if labels is None:
+        labels = build_label_map(field)
+
+    return labels
@@ -0,0 +1,61 @@
+import os
+import time
+import logging
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from avocado.management.base import DataFieldCommand
+from serrano.index import build_index, get_index_class, get_index_path
+
+log = logging.getLogger(__name__)
+
+
+__doc__ = """\
+Builds the value indexes used to search the values of string fields when
+the FIELD_VALUE_INDEX setting is defined. Searches fall back to the database
+until the index of the field's current data version is built, so this should
+be run whenever the data is loaded. Pass `--force` to rebuild existing indexes.
+"""
+
+
+class Command(DataFieldCommand):
+    help = __doc__
+
+    option_list = BaseCommand.option_list + (
+        make_option('--force',
+                    action='store_true',
+                    help='Rebuilds existing indexes.',
+                    default=False),
+    )
+
+    def handle_fields(self, fields, **options):
+        force = options.get('force')
+
+        klass = get_index_class()
+
+        if klass is None:
+            self.stdout.write('No index class is defined by the '
+                              'FIELD_VALUE_INDEX setting.')
+            return
+
+        built = skipped = errors = 0
+        t0 = time.time()
+
+        for f in fields:
+            if f.simple_type != 'string':
+                continue
+
+            if not force and os.path.exists(get_index_path(f, klass)):
+                skipped += 1
+                continue
+
+            try:
+                build_index(f)
+                built += 1
+            except Exception:
+                errors += 1
+                log.exception('error building the index of "{0}"'
+                              .format(f))
+
+        self.stdout.write('{0}/{1}/{2} built/skipped/errors'
+                          .format(built, skipped, errors))
+        self.stdout.write('Took {0} s'.format(round(time.time() - t0, 2)))
@@ -0,0 +1,65 @@
+import time
+import logging
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from avocado.management.base import DataFieldCommand
+from serrano.sketches import build_sketch, get_cached_sketch
+
+log = logging.getLogger(__name__)
+
+# Fields of these types have exact stats rather than approximate counts.
+EXACT_TYPES = ('number', 'date', 'time', 'datetime')
+
+
+__doc__ = """\
+Builds the HyperLogLog sketches used for approximate distinct counts of all
+of a field's values on the field stats endpoint. Sketches are rebuilt when
+the data version of the field changes, so this should be run after the data
+is loaded. Pass `--force` to rebuild existing sketches.
+"""
+
+
+class Command(DataFieldCommand):
+    help = __doc__
+
+    option_list = BaseCommand.option_list + (
+        make_option('--force',
+                    action='store_true',
+                    help='Rebuilds existing sketches.',
+                    default=False),
+
+        make_option('--precision',
+                    type='int',
+                    dest='precision',
+                    help='Number of registers as a power of two. Defaults '
+                         'to the STATS_SKETCH_PRECISION setting.'),
+    )
+
+    def handle_fields(self, fields, **options):
+        force = options.get('force')
+        precision = options.get('precision')
+
+        built = skipped = errors = 0
+        t0 = time.time()
+
+        for f in fields:
+            if f.simple_type in EXACT_TYPES:
+                continue
+
+            if not force and get_cached_sketch(f, precision) is not None:
+                skipped += 1
+                continue
+
+            try:
+                if build_sketch(f, precision) is None:
+                    errors += 1
+                else:
+                    built += 1
+            except Exception:
+                errors += 1
+                log.exception('error building the sketch of "{0}"'
+                              .format(f))
+
+        self.stdout.write('{0}/{1}/{2} built/skipped/errors'
+                          .format(built, skipped, errors))
+        self.stdout.write('Took {0} s'.format(round(time.time() - t0, 2)))
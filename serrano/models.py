@@ -1,5 +1,8 @@
 from django.db import models
+from django.db.models.signals import post_delete, post_save
 from django.contrib.auth.models import User
+from avocado.models import DataContext, DataView
+from .resources.base import invalidate_session_object
 from .tokens import generate_random_token
 
 
@@ -36,3 +39,16 @@ class ApiToken(models.Model):
         if not self.token:
             self.token = generate_random_token(32, test=unique_token)
         return super(ApiToken, self).save(*args, **kwargs)
+
+
+def invalidate_session_objects(sender, instance, **kwargs):
+    """Invalidates the cached session object of the owner of a context or
+    view whenever one is saved or deleted, including deletes cascaded from
+    the owner, so an owner whose ID is reused never reads a stale object.
+    """
+    invalidate_session_object(instance)
+
+
+for model in (DataContext, DataView):
+    post_save.connect(invalidate_session_objects, sender=model)
+    post_delete.connect(invalidate_session_objects, sender=model)
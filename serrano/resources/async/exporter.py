@@ -2,8 +2,8 @@ from django.conf.urls import patterns, url
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
 
-from avocado.query.utils import async_get_result_rows
 from serrano.resources.exporter import ExporterResource, ExporterRootResource
+from serrano.resources.jobs import get_or_create_job
 from serrano.resources.processors import ASYNC_EXPORTER_RESULT_PROCESSOR_NAME
 
 
@@ -40,7 +40,7 @@ class AsyncExporterResource(ExporterResource):
             'result_processor': ASYNC_EXPORTER_RESULT_PROCESSOR_NAME
         }
 
-        job_id = async_get_result_rows(
+        job_id = get_or_create_job(
             context, view, query_options, job_data, request=request)
 
         return HttpResponseRedirect(
@@ -3,8 +3,8 @@ from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
 
 from avocado.export import HTMLExporter
-from avocado.query.utils import async_get_result_rows
 from serrano.resources.preview import PreviewResource
+from serrano.resources.jobs import get_or_create_job
 from serrano.resources.processors import ASYNC_PREVIEW_RESULT_PROCESSOR_NAME
 
 
@@ -42,7 +42,7 @@ class AsyncPreviewResource(PreviewResource):
             'result_processor': ASYNC_PREVIEW_RESULT_PROCESSOR_NAME
         }
 
-        job_id = async_get_result_rows(
+        job_id = get_or_create_job(
             context, view, query_options, job_data, request=request)
 
         return HttpResponseRedirect(
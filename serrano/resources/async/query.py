@@ -4,7 +4,7 @@ from django.http import HttpResponseRedirect
 from django.views.decorators.cache import never_cache
 
 from avocado.export import JSONExporter
-from avocado.query.utils import async_get_result_rows
+from serrano.resources.jobs import get_or_create_job
 from serrano.resources.processors import ASYNC_QUERY_RESULT_PROCESSOR_NAME
 from serrano.resources.query.results import QueryResultsResource
 
@@ -38,7 +38,7 @@ class AsyncQueryResultsResource(QueryResultsResource):
             'result_processor': ASYNC_QUERY_RESULT_PROCESSOR_NAME
         }
 
-        job_id = async_get_result_rows(
+        job_id = get_or_create_job(
             request.instance.context,
             request.instance.view,
             query_options,
@@ -1,9 +1,15 @@
+import math
+import time
+import uuid
+import logging
 import functools
 
-from datetime import datetime
 from django.core.cache import cache
+from django.http import StreamingHttpResponse
+from restlib2.http import methods
 from restlib2.params import Parametizer
 from restlib2.resources import Resource
+from avocado.core.cache.model import NEVER_EXPIRE
 from avocado.models import DataContext, DataView, DataQuery
 from serrano.conf import settings
 from django.contrib.auth import authenticate, login
@@ -15,7 +21,152 @@ __all__ = ('BaseResource', 'ThrottledResource')
 
 SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
 
+log = logging.getLogger(__name__)
 
+
+# Clients that exceeded their rate limit mapped to the time until which
+# their requests are rejected by this process without checking the cache.
+_limited_clients = {}
+
+# Number of entries in `_limited_clients` above which expired entries are
+# purged.
+_LIMITED_CLIENTS_PURGE_SIZE = 1000
+
+
+def get_bucket_keys(key, seconds, buckets=None):
+    """Returns the keys of the buckets of the window of the last `seconds`,
+    ending with the key of the current bucket.
+    """
+    if buckets is None:
+        buckets = settings.RATE_LIMIT_BUCKETS
+
+    width = float(seconds) / buckets
+    current = int(time.time() / width)
+
+    return ['{0}:{1}'.format(key, i)
+            for i in range(current - buckets + 1, current + 1)]
+
+
+def get_request_count(key, seconds, buckets=None):
+    "Returns the number of requests counted in the last `seconds`."
+    return sum(cache.get_many(get_bucket_keys(key, seconds, buckets))
+               .values())
+
+
+def incr_request_count(key, seconds, buckets=None):
+    """Increments the request count and returns the number of requests in
+    the last `seconds`.
+
+    The window is divided into RATE_LIMIT_BUCKETS buckets which are each
+    counted under their own key and summed, so the window slides by the
+    width of a bucket rather than restarting. The increment is atomic for
+    cache backends that support it, e.g. memcached, so concurrent requests
+    are counted correctly.
+    """
+    keys = get_bucket_keys(key, seconds, buckets)
+    current = keys[-1]
+
+    # Buckets expire once they have left the window.
+    timeout = int(math.ceil(seconds + float(seconds) / len(keys)))
+
+    try:
+        count = cache.incr(current)
+    except ValueError:
+        # The bucket does not exist, unless another request created it
+        # concurrently.
+        if cache.add(current, 1, timeout):
+            count = 1
+        else:
+            try:
+                count = cache.incr(current)
+            except ValueError:
+                count = 1
+
+    if len(keys) > 1:
+        count += sum(cache.get_many(keys[:-1]).values())
+
+    return count
+
+
+def _get_session_object_version_key(klass, user_id=None, session_key=None):
+    if user_id is not None:
+        owner = 'user:{0}'.format(user_id)
+    else:
+        owner = 'session:{0}'.format(session_key)
+
+    return 'serrano:session_{0}:{1}'.format(klass.__name__.lower(), owner)
+
+
+def get_session_object_key(klass, user_id=None, session_key=None):
+    """Returns the cache key of the session object of the user or session.
+
+    The key includes a version which is replaced when the session object is
+    written. Versions are random so a reader that resolved the version
+    before a write cannot cache a stale object under the new version.
+    """
+    version_key = _get_session_object_version_key(
+        klass, user_id, session_key)
+    version = cache.get(version_key)
+
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex, NEVER_EXPIRE)
+        version = cache.get(version_key)
+
+    return '{0}:{1}'.format(version_key, version)
+
+
+def invalidate_session_object(instance):
+    "Invalidates the cached session object of the instance's owner."
+    version_key = _get_session_object_version_key(
+        instance.__class__, instance.user_id, instance.session_key)
+    cache.set(version_key, uuid.uuid4().hex, NEVER_EXPIRE)
+
+
+def get_request_lookups(request):
+    """Returns the number of lookups of request objects that were resolved
+    (misses) and that were returned from the request's cache (hits).
+    """
+    lookups = getattr(request, '_request_object_lookups', None)
+
+    if lookups is None:
+        lookups = request._request_object_lookups = {'hits': 0, 'misses': 0}
+
+    return lookups
+
+
+def memoize_request_object(func):
+    """Caches the object resolved by `func` on the request so it is only
+    resolved once per request.
+
+    Objects built from `attrs` passed as a dict or list are not cached
+    since they are constructed without a lookup.
+    """
+    @functools.wraps(func)
+    def wrapper(request, attrs=None, **kwargs):
+        if isinstance(attrs, (list, dict)):
+            return func(request, attrs=attrs, **kwargs)
+
+        objects = getattr(request, '_request_objects', None)
+
+        if objects is None:
+            objects = request._request_objects = {}
+
+        lookups = get_request_lookups(request)
+        key = (func.__name__, kwargs.get('key'), attrs)
+
+        if key in objects:
+            lookups['hits'] += 1
+            return objects[key]
+
+        lookups['misses'] += 1
+        objects[key] = func(request, attrs=attrs, **kwargs)
+
+        return objects[key]
+
+    return wrapper
+
+
+@memoize_request_object
 def _get_request_object(request, attrs=None, klass=None, key=None):
     """Resolves the appropriate object for use from the request.
 
@@ -84,12 +235,34 @@ def _get_request_object(request, attrs=None, klass=None, key=None):
     except (ValueError, TypeError):
         kwargs['session'] = True
 
+    # Session objects are read on most requests, so they are cached across
+    # requests until they are written.
+    cache_key = None
+    timeout = settings.SESSION_OBJECT_CACHE_TIMEOUT
+
+    if kwargs.get('session') and timeout:
+        user = kwargs.get('user')
+
+        cache_key = get_session_object_key(
+            klass, user_id=user.pk if user else None,
+            session_key=kwargs.get('session_key'))
+
+        instance = cache.get(cache_key)
+
+        if instance is not None:
+            return instance
+
     try:
         # Check that multiple DataViews or DataContexts are not returned
         # If there are more than one, return the most recent
-        return klass.objects.filter(**kwargs).latest('modified')
+        instance = klass.objects.filter(**kwargs).latest('modified')
     except klass.DoesNotExist:
         pass
+    else:
+        if cache_key:
+            cache.set(cache_key, instance, timeout)
+
+        return instance
 
     # Fallback to an instance based off the default template if one exists
     instance = klass()
@@ -107,6 +280,7 @@ get_request_context = functools.partial(
     _get_request_object, klass=DataContext, key='context')
 
 
+@memoize_request_object
 def get_request_query(request, attrs=None):
     """
     Resolves the appropriate DataQuery object for use from the request.
@@ -207,9 +381,27 @@ class BaseResource(Resource):
             elif settings.AUTH_REQUIRED:
                 return True
 
+    def render(self, request, content=None, *args, **kwargs):
+        # Streaming responses are not HttpResponse instances, so they are
+        # passed here by the dispatcher as if they were content.
+        if isinstance(content, StreamingHttpResponse):
+            return content
+
+        return super(BaseResource, self).render(
+            request, content, *args, **kwargs)
+
     def process_response(self, request, response):
-        response = super(BaseResource, self).process_response(
-            request, response)
+        # The content of a streaming response cannot be inspected, so only
+        # cache control is applied.
+        if isinstance(response, StreamingHttpResponse):
+            if request.method == methods.HEAD:
+                response.streaming_content = ()
+
+            if request.method in (methods.GET, methods.HEAD):
+                self.response_cache_control(request, response)
+        else:
+            response = super(BaseResource, self).process_response(
+                request, response)
 
         response = cors.patch_response(request, response, self.allowed_methods)
 
@@ -217,6 +409,12 @@ class BaseResource(Resource):
             request, response, self.get_links(request),
             self.get_link_templates(request))
 
+        lookups = getattr(request, '_request_object_lookups', None)
+
+        if lookups:
+            log.debug('Request object lookups: %(misses)d resolved, '
+                      '%(hits)d saved', lookups)
+
         return response
 
     def get_links(self, request):
@@ -284,38 +482,33 @@ class ThrottledResource(BaseResource):
             # here and let other methods decide how to deal with the bot.
             return False
 
-        # Construct the cache key from the request identifier and lookup
-        # the current cached value for the key. The counts that are stored in
-        # the cache are tuples where the 1st value is the request count for
-        # the given time interval and the 2nd value is the start of the
-        # time interval.
-        cache_key = 'serrano:data_request:{0}'.format(request_id)
-        current_count = cache.get(cache_key)
-
-        # If there is nothing cached for this key then add a new cache value
-        # with a count of 1 and interval starting at the current date and time.
-        # Obviously, if nothing is cached then we can't have had too many
-        # requests as this is the first one so we return False here.
-        if current_count is None:
-            cache.set(cache_key, (1, datetime.now()))
+        # Clients that recently exceeded the limit are rejected without
+        # checking the cache.
+        limited_until = _limited_clients.get(request_id)
+
+        if limited_until is not None:
+            if time.time() < limited_until:
+                return True
+
+            _limited_clients.pop(request_id, None)
+
+        # The requests of the client are counted in the cache over a
+        # sliding window of the interval.
+        cache_key = 'serrano:rate_limit:{0}'.format(request_id)
+        count = incr_request_count(cache_key, limit_seconds)
+
+        if count <= limit_count:
             return False
-        else:
-            # Calculate the time in seconds between the current date and time
-            # and the interval start from the cached value.
-            interval = (datetime.now() - current_count[1]).seconds
-
-            # If we have exceeded the interval size then reset the interval
-            # start time and reset the request count to 1 since we are on a
-            # new interval now.
-            if interval > limit_seconds:
-                cache.set(cache_key, (1, datetime.now()))
-                return False
-
-            # Update the request count to account for this request
-            new_count = current_count[0] + 1
-            cache.set(cache_key, (new_count, current_count[1]))
-
-            # Since we are still within the interval, just check if we have
-            # exceeded the request limit or not and return the result of the
-            # comparison.
-            return new_count > limit_count
+
+        if settings.RATE_LIMIT_LOCAL_SECONDS:
+            if len(_limited_clients) > _LIMITED_CLIENTS_PURGE_SIZE:
+                now = time.time()
+
+                for key, until in _limited_clients.items():
+                    if until <= now:
+                        _limited_clients.pop(key, None)
+
+            _limited_clients[request_id] = time.time() + \
+                min(settings.RATE_LIMIT_LOCAL_SECONDS, limit_seconds)
+
+        return True
@@ -1,21 +1,114 @@
+import math
+import time
 from django.conf.urls import patterns, url
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.http import Http404
+from django_rq import get_queue
 from modeltree.tree import MODELTREE_DEFAULT_ALIAS, trees
-from restlib2.params import Parametizer, IntParam, StrParam
+from restlib2.params import Parametizer, IntParam, StrParam, BoolParam
 
+from avocado.async import utils as async_utils
 from avocado.export import BaseExporter, registry as exporters
+from avocado.conf import settings as avocado_settings
 from avocado.query import pipeline, utils
+from serrano.conf import settings
 from serrano.resources import API_VERSION
 from serrano.resources.base import BaseResource
+from serrano.resources.jobs import PENDING_JOB_STATUSES
 from serrano.resources.processors import EXPORTER_RESULT_PROCESSOR_NAME, \
     process_results
+from serrano.tasks import SpilledRows, get_and_format_range, wait_for_job
 
 
 # Single list of all registered exporters
 EXPORT_TYPES = zip(*exporters.choices)[0]
 
 
+def get_range_rows(job_id, timeout):
+    """Waits for the job computing a range of an export and returns its
+    rows. Raises a ValueError if the job does not finish within `timeout`
+    seconds or does not succeed.
+    """
+    deadline = time.time() + timeout
+
+    while True:
+        job = async_utils.get_job(job_id)
+
+        if job is None:
+            raise ValueError('Range job {0} was canceled.'.format(job_id))
+
+        status = job.get_status()
+
+        if status == 'finished':
+            return job.result['rows']
+
+        if status not in PENDING_JOB_STATUSES:
+            raise ValueError('Range job {0} {1}.'.format(job_id, status))
+
+        remaining = deadline - time.time()
+
+        if remaining <= 0:
+            raise ValueError('Range job {0} timed out.'.format(job_id))
+
+        # The worker marks the job as finished just after the job has
+        # notified it is done.
+        if wait_for_job(job_id, remaining):
+            time.sleep(0.05)
+
+
+def iter_parallel_rows(job_ids, timeout):
+    """Generates the rows of the ranges computed by async jobs in order.
+
+    The ranges are computed by the async workers, so the rows are formatted
+    in separate processes. The rows of a range are read once the range is
+    done, one range at a time. The export fails if all of the ranges are
+    not done within `timeout` seconds.
+    """
+    deadline = time.time() + timeout
+
+    try:
+        for job_id in job_ids:
+            rows = get_range_rows(job_id, deadline - time.time())
+
+            try:
+                for row in rows:
+                    yield row
+            finally:
+                if isinstance(rows, SpilledRows):
+                    rows.delete()
+    finally:
+        # Remove the jobs, canceling those of ranges that were not read.
+        for job_id in job_ids:
+            job = async_utils.get_job(job_id)
+
+            if job is None:
+                continue
+
+            result = job.result
+
+            if result is not None and \
+                    isinstance(result.get('rows'), SpilledRows):
+                result['rows'].delete()
+
+            async_utils.cancel_job(job_id)
+
+
+def split_pages(page, stop_page, jobs):
+    """Splits the page range into at most `jobs` contiguous ranges and
+    returns the (page, stop_page) pairs.
+    """
+    pages = stop_page - page + 1
+    size = int(math.ceil(pages / float(max(min(jobs, pages), 1))))
+
+    ranges = []
+
+    for start in range(page, stop_page + 1, size):
+        ranges.append((start, min(start + size - 1, stop_page)))
+
+    return ranges
+
+
 class ExporterRootResource(BaseResource):
     def get_links(self, request):
         uri = request.build_absolute_uri
@@ -48,7 +141,9 @@ class ExporterRootResource(BaseResource):
 
 
 class ExporterParametizer(Parametizer):
+    gzip = BoolParam(False)
     limit = IntParam(50)
+    parallel = BoolParam(False)
     processor = StrParam('default', choices=pipeline.query_processors)
     reader = StrParam('cached', choices=BaseExporter.readers)
     tree = StrParam(MODELTREE_DEFAULT_ALIAS, choices=trees)
@@ -68,6 +163,69 @@ class ExporterResource(BaseResource):
             session_key=request.session.session_key,
             export_type=export_type)
 
+    def _get_parallel_key(self, query_name):
+        return 'serrano:parallel_export:{0}'.format(query_name)
+
+    def get_parallel(self, request, context, view, export_type, params,
+                     page, stop_page):
+        """Splits the page range into at most EXPORT_PARALLEL_JOBS ranges
+        which are each computed by an async job and returns the result data
+        for the concatenated rows.
+
+        The query is prepared once in the request. Each job reads its range
+        of the query on its own connection in the worker.
+        """
+        query_name = self._get_query_name(request, export_type)
+        limit = params['limit']
+
+        QueryProcessor = pipeline.query_processors[params['processor']]
+        processor = QueryProcessor(context=context, view=view,
+                                   tree=params['tree'])
+        queryset = processor.get_queryset(request=request)
+
+        queue = get_queue(avocado_settings.ASYNC_QUEUE)
+        job_ids = []
+
+        for start, stop in split_pages(page, stop_page,
+                                       settings.EXPORT_PARALLEL_JOBS):
+            name = '{0}:{1}'.format(query_name, start)
+
+            job = queue.enqueue(get_and_format_range,
+                                processor=processor,
+                                export_type=export_type,
+                                model=queryset.model,
+                                query=queryset.query,
+                                db=queryset.db,
+                                offset=limit * (start - 1),
+                                limit=limit * (stop - start + 1),
+                                reader=params['reader'],
+                                query_name=name,
+                                result_ttl=settings.JOB_RESULT_TTL)
+
+            # Canceling the job cancels its query.
+            job.meta['query_name'] = name
+            job.save()
+
+            job_ids.append(job.id)
+
+        # Track the jobs of the ranges so they can be canceled.
+        cache.set(self._get_parallel_key(query_name), job_ids)
+
+        rows = iter_parallel_rows(job_ids, settings.EXPORT_PARALLEL_TIMEOUT)
+
+        return {
+            'context': context,
+            'export_type': export_type,
+            'limit': limit,
+            'offset': None,
+            'page': page,
+            'processor': processor,
+            'queryset': None,
+            'rows': rows,
+            'stop_page': stop_page,
+            'view': view,
+        }
+
     # Resource is dependent on the available export types
     def is_not_found(self, request, response, export_type, **kwargs):
         return export_type not in EXPORT_TYPES
@@ -86,12 +244,36 @@ class ExporterResource(BaseResource):
         query_options.update(**kwargs)
         query_options.update(params)
 
+        page = query_options.get('page')
+        stop_page = query_options.get('stop_page')
+
+        # Page ranges can be computed in parallel by the async workers.
+        if params['parallel'] and page and stop_page and params['limit']:
+            page = int(page)
+            stop_page = int(stop_page)
+
+            if page < 1 or stop_page < page:
+                raise Http404
+
+            if stop_page > page:
+                row_data = self.get_parallel(
+                    request, context, view, export_type, params, page,
+                    stop_page)
+                row_data['gzip'] = params['gzip']
+
+                return process_results(
+                    request, EXPORTER_RESULT_PROCESSOR_NAME, row_data)
+
         try:
             row_data = utils.get_result_rows(context, view, query_options,
                                              request=request)
         except ValueError:
             raise Http404
 
+        # Used to read the rows again if the export is streamed.
+        row_data['reader'] = params['reader']
+        row_data['gzip'] = params['gzip']
+
         return process_results(
             request, EXPORTER_RESULT_PROCESSOR_NAME, row_data)
 
@@ -100,6 +282,18 @@ class ExporterResource(BaseResource):
     def delete(self, request, export_type, **kwargs):
         query_name = self._get_query_name(request, export_type)
         canceled = utils.cancel_query(query_name)
+
+        # Cancel the range jobs of a parallel export.
+        key = self._get_parallel_key(query_name)
+
+        for job_id in cache.get(key) or ():
+            result = async_utils.cancel_job(job_id)
+
+            if result is not None:
+                canceled = result['canceled'] or canceled
+
+        cache.delete(key)
+
         return self.render(request, {'canceled': canceled})
 
 
@@ -8,6 +8,9 @@ from avocado.events import usage
 from avocado.models import DataField
 from avocado.query import pipeline
 from avocado.stats import kmeans
+from serrano.conf import settings, dep_supported
+from serrano.cubes import find_cube
+from serrano.labels import get_value_labels
 from .base import FieldBase
 
 
@@ -15,6 +18,13 @@ MINIMUM_OBSERVATIONS = 500
 MAXIMUM_OBSERVATIONS = 50000
 
 
+def get_maximum_observations():
+    if dep_supported('numpy'):
+        return settings.DIMS_MAXIMUM_OBSERVATIONS
+
+    return MAXIMUM_OBSERVATIONS
+
+
 class FieldDimsParametizer(Parametizer):
     aware = BoolParam(False)
     cluster = BoolParam(True)
@@ -97,8 +107,40 @@ class FieldDimensions(FieldBase):
         queryset = queryset.annotate(count=Count(tree_field.field.name))\
             .values_list('count', *groupby)
 
-        # Evaluate list of points
-        length = len(queryset)
+        # Use the pre-aggregated counts of a cube if one covers the fields
+        # and the context can be evaluated against it.
+        rows = None
+
+        if params['processor'] == 'default':
+            cube = find_cube(fields, params['tree'])
+
+            if cube is not None:
+                conditions = cube.get_conditions(context and context.json)
+
+                if conditions is not None:
+                    rows = cube.rollup(fields, conditions, params['nulls'])
+
+        # Apply ordering. If any of the fields are enumerable, ordering should
+        # be relative to those fields. For continuous data, the ordering is
+        # relative to the count of each group
+        if (any([d.enumerable for d in fields]) and
+                not params['sort'] == 'count'):
+            queryset = queryset.order_by(*groupby)
+
+            if rows is not None:
+                rows.sort(key=lambda row: row[1:])
+        else:
+            queryset = queryset.order_by('-count')
+
+            if rows is not None:
+                rows.sort(key=lambda row: (-row[0], row[1:]))
+
+        # The groups are counted before they are fetched so oversized
+        # results are rejected without reading them.
+        if rows is None:
+            length = queryset.count()
+        else:
+            length = len(rows)
 
         # Nothing to do
         if not length:
@@ -110,7 +152,7 @@ class FieldDimensions(FieldBase):
 
             return resp
 
-        if length > MAXIMUM_OBSERVATIONS:
+        if length > get_maximum_observations():
             data = {
                 'message': 'Data too large',
             }
@@ -118,27 +160,32 @@ class FieldDimensions(FieldBase):
             return self.render(request, data,
                                status=codes.unprocessable_entity)
 
-        # Apply ordering. If any of the fields are enumerable, ordering should
-        # be relative to those fields. For continuous data, the ordering is
-        # relative to the count of each group
-        if (any([d.enumerable for d in fields]) and
-                not params['sort'] == 'count'):
-            queryset = queryset.order_by(*groupby)
-        else:
-            queryset = queryset.order_by('-count')
+        if rows is None:
+            rows = list(queryset)
+            length = len(rows)
 
         clustered = False
+        numeric = all([d.simple_type == 'number' for d in fields])
+        vectorized = numeric and dep_supported('numpy')
+
+        # The rows are clustered as arrays without building points for
+        # each row.
+        if vectorized:
+            from serrano.clustering import cluster_rows
 
-        points = [{
-            'count': point[0],
-            'values': point[1:],
-        } for point in list(queryset)]
+            clustered = params['cluster'] and length >= MINIMUM_OBSERVATIONS
+            points, outliers = cluster_rows(rows, clustered, params['n'])
+        else:
+            points = [{
+                'count': point[0],
+                'values': point[1:],
+            } for point in rows]
 
-        outliers = []
+            outliers = []
 
         # For N-dimensional continuous data, check if clustering should occur
         # to down-sample the data.
-        if all([d.simple_type == 'number' for d in fields]):
+        if numeric and not vectorized:
             # Extract observations for clustering.
             obs = []
 
@@ -193,8 +240,17 @@ class FieldDimensions(FieldBase):
             'aware': params['aware'],
         })
 
+        # Labels are looked up in the value-label map of the field of each
+        # dimension. Fields labeled by their own values do not need a map.
+        label_maps = []
+
+        for f in fields:
+            if f.field.choices or f.label_field.name != f.value_field.name:
+                label_maps.append(get_value_labels(f))
+            else:
+                label_maps.append({})
+
         labeled_points = []
-        value_labels = tree_field.value_labels(queryset=queryset)
 
         for point in points:
             labeled_points.append({
@@ -202,7 +258,7 @@ class FieldDimensions(FieldBase):
                 'values': [{
                     'label': value_labels.get(value, smart_unicode(value)),
                     'value': value
-                } for value in point['values']]
+                } for value, value_labels in zip(point['values'], label_maps)]
             })
 
         return {
@@ -1,16 +1,188 @@
+import math
+from datetime import datetime
+from django.conf import settings as django_settings
+from django.db import connections
+from django.db.models import Max, Min
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 from django.utils.encoding import smart_unicode
 from restlib2.http import codes
-from restlib2.params import Parametizer, StrParam, BoolParam
+from restlib2.params import Parametizer, StrParam, BoolParam, IntParam, \
+    FloatParam
 from modeltree.tree import MODELTREE_DEFAULT_ALIAS, trees
 from avocado.events import usage
 from avocado.query import pipeline
+from serrano.conf import settings
+from serrano.labels import get_value_labels
 from .base import FieldBase, is_field_orphaned
 
+INTERVALS = ('year', 'month', 'day')
+
+
+def get_bin_sql(field, queryset, select, params):
+    """Returns the counts of the field's non-null values grouped by the
+    `select` expression of the column, which is evaluated over a subquery
+    of the values so any joins of the queryset are preserved.
+    """
+    connection = connections[queryset.db]
+    column = connection.ops.quote_name(field.field.column)
+    select = select.format(column)
+
+    inner = queryset.filter(**{field.field_name + '__isnull': False})\
+        .values_list(field.field_name).order_by()
+    sql, inner_params = inner.query.get_compiler(queryset.db).as_sql()
+
+    # The expression is repeated in the GROUP BY clause rather than
+    # referenced by position which is not supported by all backends.
+    sql = 'SELECT {0}, COUNT(*) FROM ({1}) AS dist_subquery ' \
+        'GROUP BY {0} ORDER BY {0}'.format(select, sql)
+
+    cursor = connection.cursor()
+    cursor.execute(sql, list(params) + list(inner_params) +
+                   list(params) + list(params))
+
+    return cursor.fetchall()
+
+
+def get_number_bins(field, queryset, bins=None, bin_width=None):
+    """Returns the counts of the field's values in equal-width bins. Either
+    the number of `bins` between the minimum and maximum values or the
+    `bin_width` starting at the minimum value is specified.
+    """
+    name = field.field_name
+    bounds = queryset.order_by().aggregate(low=Min(name), high=Max(name))
+
+    if bounds['low'] is None:
+        return []
+
+    low, high = float(bounds['low']), float(bounds['high'])
+
+    if bin_width is None:
+        bin_width = (high - low) / bins
+    else:
+        bins = int(math.floor((high - low) / bin_width)) + 1
+
+    # All values are equal.
+    if not bin_width:
+        bins, bin_width = 1, 1.0
+
+    if bins > settings.DIST_MAXIMUM_BINS:
+        raise ValueError('The number of bins exceeds {0}.'.format(
+            settings.DIST_MAXIMUM_BINS))
+
+    connection = connections[queryset.db]
+    select = '(({0} - %s) / %s)'
+
+    # SQLite does not support FLOOR, but the values are not less than the
+    # minimum so truncating is equivalent.
+    if connection.vendor == 'sqlite':
+        select = 'CAST({0} AS INTEGER)'.format(select)
+    else:
+        select = 'FLOOR({0})'.format(select)
+
+    counts = [0] * bins
+
+    for index, count in get_bin_sql(field, queryset, select,
+                                    [low, bin_width]):
+        # The maximum value is included in the last bin.
+        counts[min(int(index), bins - 1)] += count
+
+    result = []
+
+    for i, count in enumerate(counts):
+        start = low + bin_width * i
+        end = high if i == bins - 1 else low + bin_width * (i + 1)
+
+        result.append({
+            'value': start,
+            'label': u'{0} - {1}'.format(start, end),
+            'count': count,
+            'min': start,
+            'max': end,
+        })
+
+    return result
+
+
+def count_intervals(low, high, interval):
+    "Returns the number of intervals between two dates, inclusive."
+    if interval == 'year':
+        return high.year - low.year + 1
+
+    if interval == 'month':
+        return (high.year - low.year) * 12 + high.month - low.month + 1
+
+    return (high - low).days + 1
+
+
+def format_interval(value, interval):
+    # strftime does not support years before 1900 in Python 2.
+    if interval == 'year':
+        return u'{0:04d}'.format(value.year)
+
+    if interval == 'month':
+        return u'{0:04d}-{1:02d}'.format(value.year, value.month)
+
+    return u'{0:04d}-{1:02d}-{2:02d}'.format(
+        value.year, value.month, value.day)
+
+
+def get_date_bins(field, queryset, interval):
+    "Returns the counts of the field's date values truncated to `interval`."
+    name = field.field_name
+    bounds = queryset.order_by().aggregate(low=Min(name), high=Max(name))
+
+    if bounds['low'] is None:
+        return []
+
+    bins = count_intervals(bounds['low'], bounds['high'], interval)
+
+    if bins > settings.DIST_MAXIMUM_BINS:
+        raise ValueError('The number of bins exceeds {0}.'.format(
+            settings.DIST_MAXIMUM_BINS))
+
+    connection = connections[queryset.db]
+    is_datetime = field.simple_type == 'datetime'
+
+    if is_datetime and django_settings.USE_TZ:
+        tzname = timezone.get_current_timezone_name()
+    else:
+        tzname = None
+
+    # Datetimes are truncated in the current time zone from Django 1.6.
+    if is_datetime and hasattr(connection.ops, 'datetime_trunc_sql'):
+        select, params = connection.ops.datetime_trunc_sql(
+            interval, '{0}', tzname)
+    else:
+        select, params = connection.ops.date_trunc_sql(interval, '{0}'), []
+
+    result = []
+
+    for value, count in get_bin_sql(field, queryset, select, params):
+        # Some backends return the truncated values as strings.
+        if isinstance(value, basestring):
+            value = parse_datetime(value) or \
+                datetime.combine(parse_date(value), datetime.min.time())
+
+        if not is_datetime and isinstance(value, datetime):
+            value = value.date()
+
+        result.append({
+            'value': value,
+            'label': format_interval(value, interval),
+            'count': count,
+        })
+
+    return result
+
 
 class FieldDistParametizer(Parametizer):
     aware = BoolParam(False)
     tree = StrParam(MODELTREE_DEFAULT_ALIAS, choices=trees)
     processor = StrParam('default', choices=pipeline.query_processors)
+    bins = IntParam()
+    bin_width = FloatParam()
+    interval = StrParam(None, choices=INTERVALS)
 
 
 class FieldDistribution(FieldBase):
@@ -39,8 +211,12 @@ class FieldDistribution(FieldBase):
         processor = QueryProcessor(context=context, tree=instance.model)
         queryset = processor.get_queryset(request=request)
 
+        if params['bins'] is not None or params['bin_width'] is not None \
+                or params['interval'] is not None:
+            return self.get_bins(request, instance, queryset, params)
+
         # Get the value/label mapping to augment the result for display
-        value_labels = instance.value_labels(queryset=queryset)
+        value_labels = get_value_labels(instance)
 
         result = []
 
@@ -59,3 +235,42 @@ class FieldDistribution(FieldBase):
         usage.log('dist', instance=instance, request=request)
 
         return result
+
+    def get_bins(self, request, instance, queryset, params):
+        """Returns the counts of the field's values grouped into bins by the
+        database, which bounds the size of the response regardless of the
+        number of distinct values.
+        """
+        if params['interval']:
+            if instance.simple_type not in ('date', 'datetime'):
+                message = 'Intervals are only supported for date fields.'
+            else:
+                message = None
+        elif instance.simple_type != 'number':
+            message = 'Bins are only supported for numeric fields.'
+        elif params['bin_width'] is not None and params['bin_width'] <= 0:
+            message = 'The bin width must be greater than zero.'
+        elif params['bin_width'] is None and params['bins'] < 1:
+            message = 'The number of bins must be greater than zero.'
+        else:
+            message = None
+
+        if message is None:
+            try:
+                if params['interval']:
+                    result = get_date_bins(instance, queryset,
+                                           params['interval'])
+                else:
+                    result = get_number_bins(instance, queryset,
+                                             bins=params['bins'],
+                                             bin_width=params['bin_width'])
+            except ValueError as e:
+                message = unicode(e)
+
+        if message is not None:
+            return self.render(request, {'message': message},
+                               status=codes.unprocessable_entity)
+
+        usage.log('dist', instance=instance, request=request)
+
+        return result
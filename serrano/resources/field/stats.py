@@ -1,20 +1,151 @@
 import logging
+from django.core.cache import get_cache
+from django.db import connections
+from django.db.models import Avg, Count, Max, Min, StdDev
 from restlib2.http import codes
 from restlib2.params import Parametizer, BoolParam, StrParam
 from modeltree.tree import MODELTREE_DEFAULT_ALIAS, trees
+from avocado.conf import settings as avocado_settings
+from avocado.core.cache import cache_key
+from avocado.core.cache.model import NEVER_EXPIRE
 from avocado.events import usage
 from avocado.query import pipeline
 from serrano.conf import settings
+from serrano.sketches import get_sketch
 from .base import FieldBase
 from ...links import reverse_tmpl
 
 log = logging.getLogger(__name__)
 
+# Quantiles included in the stats of numeric fields.
+QUANTILES = (0.25, 0.5, 0.75)
+
+
+def get_histogram(field, queryset, low, high, buckets):
+    """Returns the cumulative counts of the field's values less than or
+    equal to each of the upper edges of `buckets` equal-width buckets
+    between `low` and `high` in a single query.
+    """
+    width = (high - low) / float(buckets)
+    edges = [low + width * i for i in range(1, buckets)]
+
+    connection = connections[queryset.db]
+    column = connection.ops.quote_name(field.field.column)
+
+    inner = queryset.values_list(field.field_name).order_by()
+    sql, params = inner.query.get_compiler(queryset.db).as_sql()
+
+    sums = ['SUM(CASE WHEN {0} <= %s THEN 1 ELSE 0 END)'.format(column)
+            for edge in edges]
+
+    sql = 'SELECT {0} FROM ({1}) AS histogram_subquery'.format(
+        ', '.join(sums), sql)
+
+    cursor = connection.cursor()
+    cursor.execute(sql, list(params) + edges)
+
+    counts = [c or 0 for c in cursor.fetchone()]
+
+    return zip(edges, counts) + [(high, None)]
+
+
+def get_quantiles(field, queryset, low, high, count, buckets=None):
+    """Returns approximate quantiles of the field's values interpolated
+    from an equal-width histogram. The error of a quantile is at most the
+    width of a bucket, (high - low) / buckets.
+    """
+    if buckets is None:
+        buckets = settings.STATS_QUANTILE_BUCKETS
+
+    if not count:
+        return {}
+
+    if low == high or buckets < 2:
+        return dict([(str(q), low) for q in QUANTILES])
+
+    low = float(low)
+    high = float(high)
+
+    histogram = get_histogram(field, queryset, low, high, buckets)
+    quantiles = {}
+
+    for q in QUANTILES:
+        target = q * count
+        start, below = low, 0
+
+        for edge, cumulative in histogram:
+            if cumulative is None:
+                cumulative = count
+
+            if cumulative >= target:
+                # Linear interpolation within the bucket.
+                size = cumulative - below
+
+                if size:
+                    value = start + (edge - start) * (target - below) / size
+                else:
+                    value = edge
+
+                quantiles[str(q)] = value
+                break
+
+            start, below = edge, cumulative
+
+    return quantiles
+
+
+def get_number_stats(field, queryset):
+    """Returns the summary statistics of a numeric field. The aggregates
+    are computed in a single query and the quantiles in a second one. The
+    result is cached per field and queryset until the field's data version
+    changes, if Avocado's data cache is enabled.
+    """
+    enabled = avocado_settings.DATA_CACHE_ENABLED
+
+    if enabled:
+        key = cache_key('serrano:field_stats', version=field.data_version,
+                        kwargs={'pk': field.pk, 'queryset': queryset})
+
+        cache = get_cache(avocado_settings.DATA_CACHE)
+        stats = cache.get(key)
+
+        if stats is not None:
+            return stats
+
+    name = field.field_name
+
+    aggregates = {
+        'min': Min(name),
+        'max': Max(name),
+        'avg': Avg(name),
+        'count': Count(name),
+        'total': Count('pk'),
+    }
+
+    # SQLite does not support STDDEV without an extension.
+    if connections[queryset.db].features.supports_stddev:
+        aggregates['stddev'] = StdDev(name)
+
+    stats = queryset.order_by().aggregate(**aggregates)
+
+    total = stats.pop('total')
+    stats.setdefault('stddev', None)
+    stats['null_count'] = total - stats['count']
+
+    stats['quantiles'] = get_quantiles(field, queryset, stats['min'],
+                                       stats['max'], stats['count'])
+
+    if enabled:
+        cache.set(key, stats, timeout=NEVER_EXPIRE)
+
+    return stats
+
 
 class FieldStatsParametizer(Parametizer):
     aware = BoolParam(False)
     tree = StrParam(MODELTREE_DEFAULT_ALIAS, choices=trees)
     processor = StrParam('default', choices=pipeline.query_processors)
+    approx = BoolParam(False)
 
 
 class FieldStats(FieldBase):
@@ -55,11 +186,7 @@ class FieldStats(FieldBase):
         queryset = processor.get_queryset(request=request)
 
         if instance.simple_type == 'number':
-            resp = {
-                'max': instance.max(queryset=queryset),
-                'min': instance.min(queryset=queryset),
-                'avg': instance.avg(queryset=queryset)
-            }
+            resp = get_number_stats(instance, queryset)
         elif (instance.simple_type == 'date' or
               instance.simple_type == 'time' or
               instance.simple_type == 'datetime'):
@@ -67,6 +194,23 @@ class FieldStats(FieldBase):
                 'max': instance.max(queryset=queryset),
                 'min': instance.min(queryset=queryset)
             }
+        elif params['approx']:
+            sketch = get_sketch(instance, queryset=queryset)
+
+            # The exact count is returned if no sketch is available for
+            # the queryset.
+            if sketch is None:
+                resp = {
+                    'count': instance.count(queryset=queryset, distinct=True),
+                    'approx': False,
+                }
+            else:
+                # The error is the relative standard error of the count.
+                resp = {
+                    'count': sketch.count(),
+                    'error': round(sketch.error, 4),
+                    'approx': True,
+                }
         else:
             resp = {
                 'count': instance.count(queryset=queryset, distinct=True)
@@ -1,6 +1,10 @@
+import json
 import logging
+from django.core.paginator import InvalidPage
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.urlresolvers import reverse
 from django.db.models import Q
+from django.http import StreamingHttpResponse
 from django.utils.encoding import smart_unicode
 from restlib2.http import codes
 from restlib2.params import StrParam, IntParam, BoolParam
@@ -8,13 +12,114 @@ from modeltree.tree import MODELTREE_DEFAULT_ALIAS, trees
 from avocado.events import usage
 from avocado.query import pipeline
 from .base import FieldBase, is_field_orphaned
-from ..pagination import PaginatorResource, PaginatorParametizer
+from ..pagination import PaginatorResource, PaginatorParametizer, \
+    QuerySetSequence
+from ...conf import settings
+from ...index import get_index
+from ...labels import get_labels
 from ...links import patch_response, reverse_tmpl
+from ...sampling import sample_values
 
 
 log = logging.getLogger(__name__)
 
 
+def iter_chunks(array, size=None):
+    "Yields slices of the array of at most VALUES_VALIDATE_CHUNK_SIZE."
+    if size is None:
+        size = settings.VALUES_VALIDATE_CHUNK_SIZE
+
+    for start in xrange(0, len(array), size):
+        yield array[start:start + size]
+
+
+def validate_chunk(queryset, instance, chunk):
+    """Validates the values or labels of the data in the chunk against the
+    queryset of value and label pairs. The data are augmented in place with
+    whether they are valid and the corresponding label or value.
+    """
+    value_field_name = instance.field_name
+    label_field_name = instance.label_field.name
+
+    values = set()
+    labels = set()
+
+    # Value takes precedence over label if supplied.
+    for datum in chunk:
+        if 'value' in datum:
+            values.add(datum['value'])
+        else:
+            labels.add(datum['label'])
+
+    lookup = Q()
+
+    # Validate based on the label.
+    if labels:
+        lookup |= Q(**{'{0}__in'.format(label_field_name): list(labels)})
+
+    if values:
+        lookup |= Q(**{'{0}__in'.format(value_field_name): list(values)})
+
+    queryset = queryset.filter(lookup).order_by(value_field_name,
+                                                label_field_name).distinct()
+
+    # A value may have more than one label and vice versa, so every pair is
+    # considered. The first label in order is used for a value and the first
+    # value in order for a label.
+    value_labels = {}
+    label_values = {}
+
+    for value, label in queryset:
+        value_labels.setdefault(value, label)
+        label_values.setdefault(label, value)
+
+    for datum in chunk:
+        if 'value' in datum:
+            valid = datum['value'] in value_labels
+            if valid:
+                label = value_labels[datum['value']]
+            else:
+                label = smart_unicode(datum['value'])
+
+            datum['valid'] = valid
+            datum['label'] = label
+        else:
+            valid = datum['label'] in label_values
+            if valid:
+                value = label_values[datum['label']]
+            else:
+                value = datum['label']
+
+            datum['valid'] = valid
+            datum['value'] = value
+
+
+def stream_validated(queryset, instance, array):
+    """Generator that validates the data in chunks and yields them encoded
+    as a JSON object with the validated data and the counts of valid and
+    invalid data, which follow the data.
+    """
+    valid = 0
+
+    yield '{"values":['
+
+    for i, chunk in enumerate(iter_chunks(array)):
+        validate_chunk(queryset, instance, chunk)
+
+        for datum in chunk:
+            valid += datum['valid']
+
+        data = json.dumps(chunk, cls=DjangoJSONEncoder, separators=(',', ':'))
+
+        # The brackets of the chunk's array are removed to join the chunks.
+        if i:
+            yield ','
+
+        yield data[1:-1]
+
+    yield '],"valid":{0},"invalid":{1}}}'.format(valid, len(array) - valid)
+
+
 class FieldValuesParametizer(PaginatorParametizer):
     aware = BoolParam(False)
     limit = IntParam(10)
@@ -22,6 +127,7 @@ class FieldValuesParametizer(PaginatorParametizer):
     processor = StrParam('default', choices=pipeline.query_processors)
     query = StrParam()
     random = IntParam()
+    bulk = BoolParam(False)
 
 
 class FieldValues(FieldBase, PaginatorResource):
@@ -33,6 +139,10 @@ class FieldValues(FieldBase, PaginatorResource):
 
     parametizer = FieldValuesParametizer
 
+    # Number of values per query when intersecting indexed search results
+    # with a restricted queryset.
+    index_chunk_size = 1000
+
     def get_base_values(self, request, instance, params):
         "Returns the base queryset for this field."
         # The `aware` flag toggles the behavior of the distribution by making
@@ -44,32 +154,97 @@ class FieldValues(FieldBase, PaginatorResource):
         return context.apply(queryset=instance.model.objects.all())
 
     def get_all_values(self, request, instance, queryset):
-        "Returns all distinct values for this field."
-        results = []
-        for value, label in instance.choices(queryset=queryset):
-            results.append({
-                'label': label,
-                'value': value,
-            })
-        return results
+        """Returns all distinct values for this field.
+
+        Unless the field has predefined choices, a lazy sequence is
+        returned so only the requested page is fetched from the database.
+        """
+        if instance.field.choices:
+            results = []
+            for value, label in instance.choices(queryset=queryset):
+                results.append({
+                    'label': label,
+                    'value': value,
+                })
+            return results
+
+        value_field = instance.value_field.name
+        label_field = instance.label_field.name
+        order_field = instance.order_field.name
+
+        # The value field is included in the ordering to make it unique
+        # which is required for cursor-based pagination.
+        ordering = [order_field]
+        if value_field != order_field:
+            ordering.append(value_field)
+
+        names = [value_field]
+        for name in (label_field, order_field):
+            if name not in names:
+                names.append(name)
+
+        queryset = queryset.values(*names).order_by(*ordering).distinct()
+
+        return QuerySetSequence(queryset, lambda row: {
+            'label': smart_unicode(row[label_field]),
+            'value': row[value_field],
+        })
 
     def get_search_values(self, request, instance, query, queryset):
         """
         Performs a search on the underlying data for a field.
 
         This method can be overridden to use an alternate search
-        implementation.
+        implementation. If a field value index is configured, the search
+        is answered by the index.
         """
+        index = get_index(instance)
+
+        if index is not None:
+            return self.get_indexed_search_values(
+                request, instance, query, queryset, index)
+
+        values = list(instance.search(query, queryset=queryset))
+        value_labels = get_labels(instance, values)
         results = []
-        value_labels = instance.value_labels(queryset=queryset)
 
-        for value in instance.search(query, queryset=queryset):
+        for value in values:
             results.append({
                 'label': value_labels.get(value, smart_unicode(value)),
                 'value': value,
             })
         return results
 
+    def get_indexed_search_values(self, request, instance, query, queryset,
+                                  index):
+        "Performs a search on the field value index."
+        items = index.search(query)
+
+        # The index is built from the unfiltered data. If the queryset is
+        # restricted, e.g. by the context, the matched values are
+        # intersected with the values present in the queryset.
+        if items and queryset.query.where:
+            values = [value for value, label in items]
+            lookup = '{0}__in'.format(instance.value_field.name)
+            present = set()
+
+            for i in range(0, len(values), self.index_chunk_size):
+                chunk = values[i:i + self.index_chunk_size]
+                present.update(instance.values_list(
+                    order=False, queryset=queryset).filter(**{lookup: chunk}))
+
+            items = [item for item in items if item[0] in present]
+
+        results = []
+
+        for value, label in items:
+            results.append({
+                'label': label,
+                'value': value,
+            })
+
+        return results
+
     def get_random_values(self, request, instance, random, queryset):
         """
         Returns a random set of value/label pairs.
@@ -77,12 +252,13 @@ class FieldValues(FieldBase, PaginatorResource):
         This is useful for pre-populating documents or form fields with
         example data.
         """
-        values = instance.random(random, queryset=queryset)
+        values = sample_values(instance, random, queryset=queryset)
+        value_labels = get_labels(instance, values)
         results = []
 
         for value in values:
             results.append({
-                'label': instance.get_label(value, queryset=queryset),
+                'label': value_labels.get(value, smart_unicode(value)),
                 'value': value,
             })
 
@@ -117,16 +293,19 @@ class FieldValues(FieldBase, PaginatorResource):
         processor = QueryProcessor(tree=instance.model, context=context)
         queryset = processor.get_queryset(request=request)
 
-        if params['random']:
-            # In the case that the queryset contains a population smaller than
-            # the number of random items being requested, a ValueError will be
-            # triggered. Instead of passing the error on to the client, we
-            # simply return all the possible values.
-            try:
-                return self.get_random_values(
-                    request, instance, params['random'], queryset)
-            except ValueError:
-                return instance.values(queryset=queryset)
+        # If the population is smaller than the number of random values
+        # being requested, the whole population is returned.
+        if params['random'] is not None:
+            if params['random'] < 1:
+                data = {
+                    'message': 'The number of random values must be '
+                               'at least 1.'
+                }
+                return self.render(
+                    request, data, status=codes.unprocessable_entity)
+
+            return self.get_random_values(
+                request, instance, params['random'], queryset)
 
         page = params['page']
         limit = params['limit']
@@ -143,10 +322,29 @@ class FieldValues(FieldBase, PaginatorResource):
 
         # No page specified, return everything.
         if page is None:
-            return values
+            return list(values)
+
+        # Cursor-based pagination is used if a cursor is supplied, an empty
+        # `after` cursor denotes the first page. This is only supported for
+        # queryset-backed values.
+        cursor = params['after'] is not None or params['before'] is not None
 
-        paginator = self.get_paginator(values, limit=limit)
-        page = paginator.page(page)
+        if cursor and isinstance(values, QuerySetSequence):
+            paginator = self.get_cursor_paginator(
+                values.queryset, limit, transform=values.transform)
+
+            try:
+                page = paginator.page(after=params['after'],
+                                      before=params['before'])
+            except InvalidPage:
+                data = {
+                    'message': 'Invalid cursor.',
+                }
+                return self.render(request, data,
+                                   status=codes.unprocessable_entity)
+        else:
+            paginator = self.get_paginator(values, limit=limit)
+            page = paginator.page(page)
 
         # Get paginator-based response.
         data = self.get_page_response(request, paginator, page)
@@ -179,73 +377,33 @@ class FieldValues(FieldBase, PaginatorResource):
         else:
             array = request.data
 
-        values = []
-        labels = []
-        array_map = {}
-
-        # Separate out the values and labels for the lookup. Track indexes
-        # maintain order of array
-        for i, datum in enumerate(array):
-            # Value takes precedence over label if supplied.
-            if 'value' in datum:
-                array_map[i] = 'value'
-                values.append(datum['value'])
-            elif 'label' in datum:
-                array_map[i] = 'label'
-                labels.append(datum['label'])
-            else:
+        # Check each datum has a value or label before any are validated
+        # since bulk results are streamed.
+        for datum in array:
+            if 'value' not in datum and 'label' not in datum:
                 data = {
                     'message': 'Error parsing value or label'
                 }
                 return self.render(request, data,
                                    status=codes.unprocessable_entity)
 
-        value_field_name = instance.field_name
-        label_field_name = instance.label_field.name
-
         # Note, this return a context-aware or naive queryset depending
         # on params. Get the value and label fields so they can be filled
         # in below.
         queryset = self.get_base_values(request, instance, params)\
-            .values_list(value_field_name, label_field_name)
-
-        lookup = Q()
-
-        # Validate based on the label.
-        if labels:
-            lookup |= Q(**{'{0}__in'.format(label_field_name): labels})
-
-        if values:
-            lookup |= Q(**{'{0}__in'.format(value_field_name): values})
-
-        results = queryset.filter(lookup)
-
-        value_labels = dict(results)
-        label_values = dict([(v, k) for k, v in value_labels.items()])
-
-        for i, datum in enumerate(array):
-            if array_map[i] == 'label':
-                valid = datum['label'] in label_values
-                if valid:
-                    value = label_values[datum['label']]
-                else:
-                    value = datum['label']
-
-                datum['valid'] = valid
-                datum['value'] = value
-            else:
-                valid = datum['value'] in value_labels
-                if valid:
-                    label = value_labels[datum['value']]
-                else:
-                    label = smart_unicode(datum['value'])
-
-                datum['valid'] = valid
-                datum['label'] = label
+            .values_list(instance.field_name, instance.label_field.name)
 
         usage.log('validate', instance=instance, request=request, data={
             'count': len(array),
         })
 
+        if params['bulk']:
+            return StreamingHttpResponse(
+                stream_validated(queryset, instance, array),
+                content_type='application/json')
+
+        for chunk in iter_chunks(array):
+            validate_chunk(queryset, instance, chunk)
+
         # Return the augmented data.
         return request.data
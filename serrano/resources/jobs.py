@@ -1,16 +1,155 @@
+import json
+import math
+import time
+import hashlib
 from django.conf.urls import patterns, url
+from django.core.cache import cache
 from django.http import Http404
+from restlib2.params import Parametizer, IntParam
 
 from avocado.async import utils
+from serrano.conf import settings
 from serrano.links import reverse_tmpl
 from serrano.resources.base import ThrottledResource
 from serrano.resources.processors import process_results
+from serrano.tasks import JOB_PROGRESS_TIMEOUT, SpilledRows, \
+    async_get_result_rows, delete_job_progress, get_connection, \
+    get_job_progress, notify_job_done, wait_for_job
+
+# Statuses of jobs that have not completed and can be shared.
+PENDING_JOB_STATUSES = ('queued', 'started')
+
+JOB_FINGERPRINT_KEY = 'serrano:job:{0}'
+
+# Reservation of a fingerprint while its job is created. Concurrent
+# requests with the same fingerprint poll for the job at the interval in
+# seconds until the reservation is released or expires.
+JOB_RESERVE_KEY = 'serrano:job_reserve:{0}'
+JOB_RESERVE_TIMEOUT = 30
+JOB_RESERVE_INTERVAL = 0.05
+
+# Interval in seconds a job is polled at once it has notified it is done.
+JOB_WAIT_INTERVAL = 0.05
+
+# Redis set of the requesters sharing a job.
+JOB_REQUESTERS_KEY = 'serrano:job_requesters:{0}'
+
+
+def get_requester(request):
+    "Returns the identity of the requester of a job."
+    return request.user.username or request.session.session_key
+
+
+def add_job_requester(job_id, requester):
+    # Anonymous requests without a session cannot be told apart.
+    if not requester:
+        return
+
+    key = JOB_REQUESTERS_KEY.format(job_id)
+
+    pipe = get_connection().pipeline()
+    pipe.sadd(key, requester)
+    pipe.expire(key, JOB_PROGRESS_TIMEOUT)
+    pipe.execute()
+
+
+def remove_job_requester(job_id, requester):
+    "Removes the requester of the job and returns the number remaining."
+    key = JOB_REQUESTERS_KEY.format(job_id)
+
+    pipe = get_connection().pipeline()
+    pipe.srem(key, requester or '')
+    pipe.scard(key)
+
+    return pipe.execute()[1]
+
+
+def get_pending_job_id(key):
+    "Returns the ID of the job stored under the key if it is pending."
+    job_id = cache.get(key)
+
+    if job_id is not None:
+        job = utils.get_job(job_id)
+
+        if job is not None and job.get_status() in PENDING_JOB_STATUSES:
+            return job_id
+
+
+def get_job_fingerprint(context, view, query_options, job_data):
+    """Returns a fingerprint identifying the result of an async job.
+
+    Jobs are shared across users only if SHARE_ASYNC_JOBS is true since the
+    query processor may restrict the results to the requesting user.
+    """
+    key = {
+        'context': context.json if context is not None else None,
+        'view': view.json if view is not None else None,
+        'export_type': query_options.get('export_type'),
+        'page': query_options.get('page'),
+        'stop_page': query_options.get('stop_page'),
+        'limit': query_options.get('limit'),
+        'processor': query_options.get('processor'),
+        'tree': query_options.get('tree'),
+        'reader': query_options.get('reader'),
+        'result_processor': job_data.get('result_processor'),
+    }
+
+    if not settings.SHARE_ASYNC_JOBS:
+        key['user'] = job_data.get('user_name') or \
+            job_data.get('session_key')
+
+    data = json.dumps(key, sort_keys=True, default=unicode)
+
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def get_or_create_job(context, view, query_options, job_data, request=None):
+    """Returns the ID of a pending job with the same fingerprint or creates
+    a new job to get the result rows. The requester is recorded so a job
+    shared by several requesters is only canceled by the last one.
+
+    The fingerprint is reserved while the job is created so concurrent
+    requests do not create duplicate jobs.
+    """
+    fingerprint = get_job_fingerprint(context, view, query_options, job_data)
+    key = JOB_FINGERPRINT_KEY.format(fingerprint)
+    reserve_key = JOB_RESERVE_KEY.format(fingerprint)
+
+    while True:
+        job_id = get_pending_job_id(key)
+
+        if job_id is not None:
+            break
+
+        if cache.add(reserve_key, 1, JOB_RESERVE_TIMEOUT):
+            try:
+                job_id = async_get_result_rows(
+                    context, view, query_options, job_data, request=request)
+
+                cache.set(key, job_id)
+            finally:
+                cache.delete(reserve_key)
+
+            break
+
+        time.sleep(JOB_RESERVE_INTERVAL)
+
+    add_job_requester(job_id, job_data.get('user_name') or
+                      job_data.get('session_key'))
+
+    return job_id
+
+
+class JobParametizer(Parametizer):
+    wait = IntParam(0)
 
 
 class JobResource(ThrottledResource):
     """
     Resource for getting information about a single job.
     """
+    parametizer = JobParametizer
+
     def is_not_found(self, request, response, **kwargs):
         return self.get_object(request, **kwargs) is None
 
@@ -38,24 +177,112 @@ class JobResource(ThrottledResource):
                 uri, 'serrano:jobs:result', {'job_uuid': (int, 'id')}),
         }
 
+    def wait(self, request):
+        """
+        Blocks until the pending job is done if the `wait` parameter is set
+        to the maximum number of seconds to wait.
+
+        The job is fetched again so the current status is returned.
+        """
+        params = self.get_params(request)
+        timeout = min(params['wait'], settings.JOB_WAIT_MAX)
+        job_id = request.instance.id
+
+        if timeout <= 0 or \
+                request.instance.get_status() not in PENDING_JOB_STATUSES:
+            return
+
+        deadline = time.time() + timeout
+
+        if wait_for_job(job_id, timeout):
+            # The job notifies it is done before the worker stores its status
+            # and result, so the job is polled until it is no longer pending
+            # for the rest of the wait.
+            while True:
+                job = utils.get_job(job_id)
+
+                if job is None or \
+                        job.get_status() not in PENDING_JOB_STATUSES or \
+                        time.time() >= deadline:
+                    break
+
+                time.sleep(JOB_WAIT_INTERVAL)
+
+        request.instance = utils.get_job(job_id)
+
+        if request.instance is None:
+            raise Http404
+
+    def get_retry_after(self, progress):
+        """
+        Returns the number of seconds the client should wait before polling
+        a pending job again based on the estimated time remaining.
+        """
+        seconds = settings.JOB_RETRY_AFTER_MIN
+
+        if progress and progress.get('remaining') is not None:
+            seconds = max(seconds, int(math.ceil(progress['remaining'])))
+
+        return min(seconds, settings.JOB_RETRY_AFTER_MAX)
+
     def get(self, request, **kwargs):
         """
-        Return the ID and current status of this job.
+        Return the ID, current status and progress of this job.
+
+        The progress is reported once the job has started reading rows. For
+        pending jobs, the Retry-After header is set to the suggested number
+        of seconds to wait before polling again.
+
+        If `wait` is set, the response is returned as soon as the job is
+        done or after `wait` seconds, whichever comes first.
 
         If a job with the supplied ID could not be found, this will return 404.
         """
-        return {
+        self.wait(request)
+
+        status = request.instance.get_status()
+        progress = get_job_progress(request.instance.id)
+
+        data = {
             'id': request.instance.id,
-            'status': request.instance.get_status(),
+            'status': status,
         }
 
+        if progress is not None:
+            data['progress'] = progress
+
+        response = self.render(request, data)
+
+        if status in PENDING_JOB_STATUSES:
+            response['Retry-After'] = str(self.get_retry_after(progress))
+
+        return response
+
     def delete(self, request, **kwargs):
         """
         Delete the job.
 
+        A job shared by several requesters is only canceled once the last
+        of them deletes it.
+
         If the job with the supplied ID is not found, this will return a 404.
         """
-        return utils.cancel_job(request.instance.id)
+        if remove_job_requester(request.instance.id, get_requester(request)):
+            return
+
+        # Remove the spilled rows of a finished job.
+        result = request.instance.result
+
+        if result is not None and isinstance(result.get('rows'), SpilledRows):
+            result['rows'].delete()
+
+        delete_job_progress(request.instance.id)
+        canceled = utils.cancel_job(request.instance.id)
+
+        # Clients waiting on the canceled job are woken up.
+        notify_job_done(request.instance.id)
+
+        return canceled
 
 
 class JobResultResource(JobResource):
@@ -91,12 +318,23 @@ class JobResultResource(JobResource):
         method makes no assumption of that as the job management is handled
         by Avocado and this method should be independent of the async system
         used for creating and running jobs.
+
+        If `wait` is set, the result is returned as soon as the job is done.
+        A 404 is returned if the job is not done after `wait` seconds.
         """
+        self.wait(request)
+
         result = request.instance.result
 
         if result is None:
             raise Http404
 
+        # Spilled rows are removed once they expire.
+        rows = result.get('rows')
+
+        if isinstance(rows, SpilledRows) and not rows.exists():
+            raise Http404
+
         return process_results(
             request, request.instance.meta['result_processor'], result)
 
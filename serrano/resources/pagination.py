@@ -1,37 +1,415 @@
+import json
+import base64
+import logging
+import threading
+from django.db import connections
+from django.db.models import Q
 from django.db.models.query import QuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.core.cache import cache
-from django.core.paginator import Paginator
+from django.core.paginator import Paginator, Page, InvalidPage, EmptyPage, \
+    PageNotAnInteger
+from django.core.serializers.json import DjangoJSONEncoder
 from avocado.core.cache import cache_key
+from avocado.core.cache.model import NEVER_EXPIRE
 from avocado.conf import settings
-from restlib2.params import Parametizer, IntParam
+from restlib2.params import Parametizer, IntParam, StrParam
 from restlib2.resources import Resource
+from serrano.conf import settings as serrano_settings
 
-__all__ = ('PaginatorResource', 'PaginatorParametizer')
+__all__ = ('PaginatorResource', 'PaginatorParametizer', 'QuerySetSequence',
+           'CursorPaginator')
+
+
+log = logging.getLogger(__name__)
 
 
 def _count(s):
-    if isinstance(s, QuerySet):
+    if isinstance(s, (QuerySet, QuerySetSequence)):
         return s.count()
 
     return len(s)
 
 
+def estimate_count(queryset):
+    """Returns the number of rows estimated by the query planner or None
+    if the database does not support estimates.
+    """
+    connection = connections[queryset.db]
+
+    if connection.vendor != 'postgresql':
+        return
+
+    try:
+        sql, params = queryset.query.sql_with_params()
+    except EmptyResultSet:
+        return 0
+
+    cursor = connection.cursor()
+
+    try:
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+        plan = cursor.fetchone()[0]
+    finally:
+        cursor.close()
+
+    # Older versions of psycopg2 do not decode the JSON output.
+    if not isinstance(plan, list):
+        plan = json.loads(plan)
+
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def refresh_count(queryset, key, last_key, lock_key):
+    "Counts the queryset and caches the exact and last-known count."
+    try:
+        count = queryset.count()
+        cache.set(key, count)
+        cache.set(last_key, count, timeout=NEVER_EXPIRE)
+    except Exception:
+        log.exception('Error refreshing paginator count')
+    finally:
+        cache.delete(lock_key)
+
+        # The thread has its own connection which must be closed to prevent
+        # it from remaining open after the thread exits.
+        connections[queryset.db].close()
+
+
+class ApproximatePaginator(Paginator):
+    """Paginator for approximate counts.
+
+    Since the count may be lower than the actual number of items, pages
+    past the estimated number of pages are not rejected and pages are
+    not truncated to the count.
+    """
+    approximate = True
+
+    def validate_number(self, number):
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger('That page number is not an integer')
+
+        if number < 1:
+            raise EmptyPage('That page number is less than 1')
+
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        bottom = (number - 1) * self.per_page
+        top = bottom + self.per_page
+        return ApproximatePage(self.object_list[bottom:top], number, self)
+
+
+class ApproximatePage(Page):
+    def has_next(self):
+        # A full page may be followed by items beyond the estimate.
+        if len(self.object_list) == self.paginator.per_page:
+            return True
+
+        return self.number < self.paginator.num_pages
+
+
+class QuerySetSequence(object):
+    """Lazy sequence over a queryset that transforms each row.
+
+    Slicing is delegated to the queryset so paginating the sequence only
+    fetches the rows of the requested page rather than the whole result.
+    """
+    def __init__(self, queryset, transform):
+        self.queryset = queryset
+        self.transform = transform
+
+    def count(self):
+        return self.queryset.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __iter__(self):
+        for row in self.queryset.iterator():
+            yield self.transform(row)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.transform(row) for row in self.queryset[key]]
+
+        return self.transform(self.queryset[key])
+
+
+def encode_cursor(values):
+    "Encodes a list of sort key values into an opaque cursor."
+    data = json.dumps(values, cls=DjangoJSONEncoder, separators=(',', ':'))
+    return base64.urlsafe_b64encode(data.encode('utf-8')).rstrip('=')
+
+
+def decode_cursor(cursor):
+    "Decodes a cursor into a list of sort key values."
+    try:
+        cursor = str(cursor)
+        cursor += '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(cursor).decode('utf-8'))
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidPage('Invalid cursor')
+
+    if not isinstance(values, list):
+        raise InvalidPage('Invalid cursor')
+
+    return values
+
+
+class CursorPage(object):
+    "A page of items relative to a cursor."
+    def __init__(self, object_list, paginator, next_cursor=None,
+                 previous_cursor=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class CursorPaginator(object):
+    """Paginates an ordered queryset by the values of its sort keys.
+
+    Rather than using an offset, pages are requested relative to an opaque
+    cursor that encodes the sort key of the last item of the previous page
+    (`after`) or the first item of the next page (`before`). The rows are
+    filtered on the sort key, so the cost of a page does not depend on its
+    depth and no count of the total number of rows is required.
+
+    The queryset must be ordered by keys that uniquely identify a row and
+    must yield dicts or objects that expose the keys, i.e. a `values()` or
+    a model queryset. Nulls are treated as the largest value as they are in
+    PostgreSQL.
+    """
+    def __init__(self, queryset, per_page, transform=None):
+        ordering = queryset.query.order_by
+
+        if not ordering:
+            raise ValueError('Cursor pagination requires an ordered queryset')
+
+        self.queryset = queryset
+        self.per_page = per_page
+        self.has_limit = bool(per_page)
+        self.transform = transform
+
+        self.keys = []
+        for name in ordering:
+            descending = name.startswith('-')
+            name = name.lstrip('-')
+            field = queryset.model._meta.get_field(name)
+            self.keys.append((name, descending, field.null))
+
+    def get_key(self, row):
+        if isinstance(row, dict):
+            return [row[name] for name, descending, null in self.keys]
+
+        return [getattr(row, name) for name, descending, null in self.keys]
+
+    def _greater(self, name, value, null):
+        if value is None:
+            return
+
+        lookup = Q(**{'{0}__gt'.format(name): value})
+
+        if null:
+            lookup |= Q(**{'{0}__isnull'.format(name): True})
+
+        return lookup
+
+    def _less(self, name, value, null):
+        if value is None:
+            return Q(**{'{0}__isnull'.format(name): False})
+
+        return Q(**{'{0}__lt'.format(name): value})
+
+    def _equal(self, name, value):
+        if value is None:
+            return Q(**{'{0}__isnull'.format(name): True})
+
+        return Q(**{name: value})
+
+    def get_lookup(self, values, reverse=False):
+        """Returns the lookup for rows after the sort key values or before
+        them if `reverse` is true.
+        """
+        if len(values) != len(self.keys):
+            raise InvalidPage('Invalid cursor')
+
+        lookup = None
+        prefix = Q()
+
+        for (name, descending, null), value in zip(self.keys, values):
+            if descending != reverse:
+                term = self._less(name, value, null)
+            else:
+                term = self._greater(name, value, null)
+
+            if term is not None:
+                term = prefix & term
+
+                if lookup is None:
+                    lookup = term
+                else:
+                    lookup |= term
+
+            prefix &= self._equal(name, value)
+
+        return lookup
+
+    def _fetch(self, queryset):
+        if self.has_limit:
+            return list(queryset[:self.per_page + 1])
+
+        return list(queryset)
+
+    def page(self, after=None, before=None):
+        """Returns the page after or before the cursor. If neither are
+        supplied, the first page is returned.
+        """
+        queryset = self.queryset
+
+        if before:
+            ordering = []
+            for name, descending, null in self.keys:
+                ordering.append(name if descending else '-' + name)
+
+            lookup = self.get_lookup(decode_cursor(before), reverse=True)
+
+            if lookup is None:
+                rows = []
+            else:
+                rows = self._fetch(queryset.filter(lookup).order_by(*ordering))
+
+            has_previous = self.has_limit and len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            rows.reverse()
+            has_next = True
+        else:
+            if after:
+                lookup = self.get_lookup(decode_cursor(after))
+
+                if lookup is None:
+                    rows = []
+                else:
+                    rows = self._fetch(queryset.filter(lookup))
+            else:
+                rows = self._fetch(queryset)
+
+            has_next = self.has_limit and len(rows) > self.per_page
+
+            if self.has_limit:
+                rows = rows[:self.per_page]
+
+            has_previous = bool(after)
+
+        next_cursor = previous_cursor = None
+
+        if rows:
+            if has_next:
+                next_cursor = encode_cursor(self.get_key(rows[-1]))
+            if has_previous:
+                previous_cursor = encode_cursor(self.get_key(rows[0]))
+        elif before:
+            # Nothing precedes the cursor, the next page is the first one.
+            next_cursor = ''
+
+        if self.transform is not None:
+            rows = [self.transform(row) for row in rows]
+
+        return CursorPage(rows, self, next_cursor=next_cursor,
+                          previous_cursor=previous_cursor)
+
+
 class PaginatorParametizer(Parametizer):
     page = IntParam(1)
     limit = IntParam(20)
+    after = StrParam()
+    before = StrParam()
 
 
 class PaginatorResource(Resource):
     parametizer = PaginatorParametizer
 
+    # Toggles the approximate count strategy for this resource. If None,
+    # the PAGINATOR_APPROXIMATE_COUNTS setting is used.
+    approximate_counts = None
+
+    def get_approximate_count(self, queryset):
+        """Returns a count for the queryset and whether it is approximate.
+
+        The exact count is returned if it is cached. Otherwise the
+        last-known count or the query planner's estimate is returned and
+        the exact count is refreshed in the background.
+        """
+        key = cache_key('paginator', kwargs={'queryset': queryset})
+        count = cache.get(key)
+
+        if count is not None:
+            return count, False
+
+        last_key = '{0}:last'.format(key)
+        lock_key = '{0}:lock'.format(key)
+
+        count = cache.get(last_key)
+
+        if count is None:
+            try:
+                count = estimate_count(queryset)
+            except Exception:
+                log.exception('Error estimating paginator count')
+
+        # No estimate is available, fallback to the exact count.
+        if count is None:
+            count = queryset.count()
+            cache.set(key, count)
+            cache.set(last_key, count, timeout=NEVER_EXPIRE)
+            return count, False
+
+        # Only one refresh is performed at a time for the queryset.
+        if cache.add(lock_key, True):
+            thread = threading.Thread(
+                target=refresh_count,
+                args=(queryset, key, last_key, lock_key))
+            thread.daemon = True
+            thread.start()
+
+        return count, True
+
     def get_paginator(self, queryset, limit):
-        paginator = Paginator(queryset, per_page=limit)
-        paginator.has_limit = bool(limit)
+        # The underlying queryset of a lazy sequence is used so the key
+        # is derived from the SQL rather than the sequence object.
+        if isinstance(queryset, QuerySetSequence):
+            key_queryset = queryset.queryset
+        else:
+            key_queryset = queryset
+
+        approximate_counts = self.approximate_counts
+
+        if approximate_counts is None:
+            approximate_counts = serrano_settings.PAGINATOR_APPROXIMATE_COUNTS
+
+        approximate = False
+
+        if approximate_counts and limit and \
+                isinstance(key_queryset, QuerySet):
+            count, approximate = self.get_approximate_count(key_queryset)
 
         # Cache count for paginator to prevent redundant calls between requests
-        if settings.DATA_CACHE_ENABLED:
+        elif settings.DATA_CACHE_ENABLED:
             key = cache_key('paginator', kwargs={
-                'queryset': queryset
+                'queryset': key_queryset
             })
 
             count = cache.get(key)
@@ -42,6 +420,12 @@ class PaginatorResource(Resource):
         else:
             count = _count(queryset)
 
+        if approximate:
+            paginator = ApproximatePaginator(queryset, per_page=limit)
+        else:
+            paginator = Paginator(queryset, per_page=limit)
+
+        paginator.has_limit = bool(limit)
         paginator._count = count
 
         if not limit:
@@ -50,8 +434,60 @@ class PaginatorResource(Resource):
 
         return paginator
 
+    def get_cursor_paginator(self, queryset, limit, transform=None):
+        "Returns a cursor paginator for an ordered queryset."
+        return CursorPaginator(queryset, per_page=limit, transform=transform)
+
+    def get_cursor_page_links(self, request, path, page, extra=None):
+        "Returns the page links for a cursor page."
+        uri = request.build_absolute_uri
+        params = {}
+
+        if page.paginator.has_limit:
+            params['limit'] = page.paginator.per_page
+        else:
+            params['limit'] = 0
+
+        if extra:
+            for key, value in extra.items():
+                if key in ('page', 'after', 'before'):
+                    continue
+
+                if key in request.GET and value is not None and value != '':
+                    params.setdefault(key, request.GET.get(key))
+
+        def build(**cursor):
+            pairs = dict(params, **cursor)
+            pairs = sorted(['{0}={1}'.format(k, v) for k, v in pairs.items()])
+            return uri('{0}?{1}'.format(path, '&'.join(pairs)))
+
+        cursor = {}
+        for key in ('after', 'before'):
+            if request.GET.get(key):
+                cursor[key] = request.GET[key]
+
+        if not cursor:
+            cursor['after'] = ''
+
+        links = {
+            'self': build(**cursor),
+            'base': uri(path),
+            'first': build(after=''),
+        }
+
+        if page.has_previous():
+            links['prev'] = build(before=page.previous_cursor)
+
+        if page.has_next():
+            links['next'] = build(after=page.next_cursor)
+
+        return links
+
     def get_page_links(self, request, path, page, extra=None):
         "Returns the page links."
+        if isinstance(page, CursorPage):
+            return self.get_cursor_page_links(request, path, page, extra)
+
         uri = request.build_absolute_uri
 
         # format string will be expanded below
@@ -100,9 +536,21 @@ class PaginatorResource(Resource):
         return links
 
     def get_page_response(self, request, paginator, page):
-        return {
+        if isinstance(paginator, CursorPaginator):
+            return {
+                'limit': paginator.per_page if paginator.has_limit else 0,
+                'next_cursor': page.next_cursor,
+                'prev_cursor': page.previous_cursor,
+            }
+
+        data = {
             'count': paginator.count,
             'limit': paginator.per_page if paginator.has_limit else 0,
             'num_pages': paginator.num_pages,
             'page_num': page.number,
         }
+
+        if getattr(paginator, 'approximate', False):
+            data['approximate'] = True
+
+        return data
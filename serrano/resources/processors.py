@@ -5,13 +5,17 @@ except ImportError:
 from datetime import datetime
 
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.db import connections
+from django.http import HttpResponse, StreamingHttpResponse
 from restlib2.serializers import serializers
 
 from avocado.events import usage
 from avocado.query.utils import get_exporter_class
+from serrano import compression
 from serrano.conf import settings
 from serrano.links import patch_response
+from serrano.streaming import get_server_side_iterable, stream_write
+from serrano.tasks import SpilledRows, read_rows
 
 
 ASYNC_EXPORTER_RESULT_PROCESSOR_NAME = 'async_exporter'
@@ -23,6 +27,16 @@ PREVIEW_RESULT_PROCESSOR_NAME = 'preview'
 QUERY_RESULT_PROCESSOR_NAME = 'query'
 
 
+def get_result_model(result_data):
+    """Returns the model of the result. Results of async jobs are stored
+    with the model rather than the queryset.
+    """
+    if result_data.get('model') is not None:
+        return result_data['model']
+
+    return result_data['queryset'].model
+
+
 class BaseResultProcessor(object):
     name = 'default'
 
@@ -37,6 +51,54 @@ class BaseResultProcessor(object):
 class ExporterResultProcessor(BaseResultProcessor):
     name = EXPORTER_RESULT_PROCESSOR_NAME
 
+    def is_streaming(self, request, result_data):
+        "Returns true if the export should be streamed."
+        return result_data['export_type'] in settings.STREAMING_EXPORT_TYPES
+
+    def is_evaluated(self, result_data):
+        """Returns true if the rows have already been evaluated, e.g. by an
+        async job, or are not backed by a queryset.
+        """
+        return isinstance(result_data['rows'],
+                          (list, tuple, SpilledRows)) or \
+            result_data['queryset'] is None
+
+    def get_streaming_rows(self, exporter, result_data):
+        """Returns the rows to be written to a streaming export.
+
+        Evaluated rows are returned as is. Otherwise the rows are read as
+        by `get_result_rows` from a server-side cursor so the result set is
+        not loaded into memory at once.
+        """
+        if self.is_evaluated(result_data):
+            return result_data['rows']
+
+        processor = result_data['processor']
+
+        return read_rows(processor, exporter, result_data['view'],
+                         result_data['queryset'],
+                         offset=result_data['offset'],
+                         limit=result_data['limit'],
+                         reader=result_data.get('reader'),
+                         get_iterable=get_server_side_iterable(processor))
+
+    def get_streaming_content(self, request, exporter, result_data):
+        "Returns an iterator of the export content."
+        evaluated = self.is_evaluated(result_data)
+
+        def write(buff):
+            try:
+                rows = self.get_streaming_rows(exporter, result_data)
+                exporter.write(rows, buff=buff, request=request)
+            finally:
+                # Connections are thread-local, close the one opened by
+                # the producer thread. The connection of evaluated rows
+                # may not exist in this process, e.g. for async jobs.
+                if not evaluated:
+                    connections[result_data['queryset'].db].close()
+
+        return stream_write(write)
+
     def process(self, request, result_data):
         export_type = result_data['export_type']
         exporter = result_data['processor'].get_exporter(
@@ -53,19 +115,42 @@ class ExporterResultProcessor(BaseResultProcessor):
         else:
             file_tag = 'all'
 
-        resp = HttpResponse()
-        exporter.write(result_data['rows'], buff=resp, request=request)
+        # The export file itself is compressed rather than the response.
+        gzip = result_data.get('gzip', False)
+
+        if self.is_streaming(request, result_data):
+            content = self.get_streaming_content(
+                request, exporter, result_data)
+
+            if gzip:
+                content = compression.compress_stream(content, 'gzip')
+
+            resp = StreamingHttpResponse(content)
+        else:
+            resp = HttpResponse()
+            exporter.write(result_data['rows'], buff=resp, request=request)
+
+            if gzip:
+                resp.content = compression.compress(resp.content, 'gzip')
 
         filename = '{0}-{1}-data.{2}'.format(file_tag,
                                              datetime.now(),
                                              exporter.file_extension)
 
+        if gzip:
+            filename += '.gz'
+
         cookie_name = settings.EXPORT_COOKIE_NAME_TEMPLATE.format(export_type)
         resp.set_cookie(cookie_name, settings.EXPORT_COOKIE_DATA)
 
         resp['Content-Disposition'] = 'attachment; filename="{0}"'\
                                       .format(filename)
-        resp['Content-Type'] = exporter.content_type
+
+        if gzip:
+            resp['Content-Type'] = 'application/gzip'
+        else:
+            resp['Content-Type'] = exporter.content_type
+            resp = compression.patch_response(request, resp)
 
         usage.log('export', request=request, data={
             'type': export_type,
@@ -164,7 +249,7 @@ class PreviewResultProcessor(BaseResultProcessor):
             header.append(obj)
 
         # Various model options
-        opts = result_data['queryset'].model._meta
+        opts = get_result_model(result_data)._meta
 
         model_name = opts.verbose_name.format()
         model_name_plural = opts.verbose_name_plural.format()
@@ -186,6 +271,8 @@ class PreviewResultProcessor(BaseResultProcessor):
         links = self.get_page_links(
             request, path, result_data['page'], result_data['limit'])
 
+        response = compression.patch_response(request, response)
+
         return patch_response(request, response, links, {})
 
 
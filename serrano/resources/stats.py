@@ -1,8 +1,14 @@
+import os
+import logging
 import weakref
 import threading
+from collections import deque
 from multiprocessing.pool import ThreadPool
 from django.core.urlresolvers import reverse
 from django.core.cache import get_cache
+from django.db import DatabaseError, connections
+from django.db.models import Sum
+from django.db.models.sql.datastructures import EmptyResultSet
 from django.conf.urls import patterns, url
 from django.views.decorators.cache import never_cache
 from restlib2.params import Parametizer, BoolParam, StrParam
@@ -14,19 +20,174 @@ from avocado.core.cache.model import NEVER_EXPIRE
 from ..conf import settings as serrano_settings
 from .base import BaseResource, ThrottledResource
 
+log = logging.getLogger(__name__)
 
-def get_count(request, model, refresh, processor, context):
-    opts = model._meta
+# Process-wide pool of threads the counts are executed in. It is created
+# on first use and recreated if the process has been forked since.
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+# Counters of the tasks submitted to the pool.
+_pool_stats = {
+    'submitted': 0,
+    'completed': 0,
+    'active': 0,
+    'peak_active': 0,
+    'timeouts': 0,
+}
+_pool_stats_lock = threading.Lock()
+
+
+def get_pool():
+    "Returns the process-wide pool of threads used for counts."
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # Workaround for a Python bug for versions 2.7.5 and below
+            # http://bugs.python.org/issue10015
+            if not hasattr(threading.current_thread(), '_children'):
+                threading.current_thread()._children = \
+                    weakref.WeakKeyDictionary()
+
+            _pool = ThreadPool(serrano_settings.STATS_COUNT_WORKERS)
+            _pool_pid = os.getpid()
+
+        return _pool
+
+
+def close_pool():
+    "Terminates the pool. A new one is created on next use."
+    global _pool
+
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.terminate()
+            _pool.join()
+
+        _pool = None
+
+
+def _incr_pool_stat(name, value=1):
+    with _pool_stats_lock:
+        _pool_stats[name] += value
+
+        if name == 'active' and \
+                _pool_stats['active'] > _pool_stats['peak_active']:
+            _pool_stats['peak_active'] = _pool_stats['active']
 
+
+def get_pool_stats():
+    """Returns the counters of the count pool. `queued` is the number of
+    tasks waiting for a free thread, so a pool is saturated when it is
+    above zero.
+    """
+    with _pool_stats_lock:
+        stats = dict(_pool_stats)
+
+    stats['workers'] = serrano_settings.STATS_COUNT_WORKERS
+    stats['queued'] = stats['submitted'] - stats['completed'] - \
+        stats['active']
+
+    return stats
+
+
+def reset_pool_stats():
+    with _pool_stats_lock:
+        for key in _pool_stats:
+            _pool_stats[key] = 0
+
+
+def get_count_queryset(request, model, processor, context):
     # Build a queryset through the context which is toggled by
     # the parameter.
     processor = processor(context=context, tree=model)
-    queryset = processor.get_queryset(request=request)
+    return processor.get_queryset(request=request)
 
-    # Get count from cache or database
+
+def get_data_versions():
+    """Returns the data version of each model with fields keyed by the
+    model's table. The version of a model is the sum of the data versions
+    of its fields, so it changes when any of them is incremented.
+    """
+    versions = {}
+
+    rows = DataField.objects.values_list('app_name', 'model_name')\
+        .annotate(version=Sum('data_version')).order_by()
+
+    for app_name, model_name, version in rows:
+        model = DataField(app_name=app_name, model_name=model_name).model
+
+        if model is not None:
+            versions[model._meta.db_table] = version
+
+    return versions
+
+
+def get_count_tables(queryset):
+    "Returns the names of the tables the queryset reads from."
+    query = queryset.query
+    tables = set([queryset.model._meta.db_table])
+
+    for alias in query.tables:
+        tables.add(query.alias_map[alias].table_name)
+
+    return tables
+
+
+def get_count_version(queryset, versions):
+    """Returns the version of the data counted by the queryset. Tables
+    without fields do not contribute to the version.
+    """
+    tables = sorted(get_count_tables(queryset))
+
+    return '|'.join(['{0}:{1}'.format(t, versions.get(t, 0))
+                     for t in tables])
+
+
+def get_count_key(model, queryset, versions=None):
+    """Returns the cache key of the count. If `versions` is given, the key
+    includes the data version of the tables the count reads from so the
+    count is recomputed when the underlying data changes.
+    """
+    opts = model._meta
     label = ':'.join([opts.app_label, opts.module_name, 'count'])
-    key = cache_key(label, kwargs={'queryset': queryset})
 
+    version = None
+
+    if versions is not None:
+        version = get_count_version(queryset, versions)
+
+    return cache_key(label, version=version, kwargs={'queryset': queryset})
+
+
+def is_unfiltered(queryset):
+    """Returns true if the queryset selects all rows of its table. The
+    primary keys are unique in that case so the count does not require
+    a distinct.
+    """
+    query = queryset.query
+
+    return not query.where and not query.having and query.low_mark == 0 \
+        and query.high_mark is None and len(get_count_tables(queryset)) == 1
+
+
+def count_queryset(queryset):
+    if is_unfiltered(queryset):
+        return queryset.order_by().count()
+
+    return queryset.values('pk').distinct().count()
+
+
+def get_count(request, model, refresh, processor, context, versions=None):
+    queryset = get_count_queryset(request, model, processor, context)
+
+    # Get count from cache or database
+    try:
+        key = get_count_key(model, queryset, versions)
+    except EmptyResultSet:
+        return 0
     cache = get_cache(avocado_settings.DATA_CACHE)
 
     if refresh:
@@ -35,17 +196,212 @@ def get_count(request, model, refresh, processor, context):
         count = cache.get(key)
 
     if count is None:
-        count = queryset.values('pk').distinct().count()
+        count = count_queryset(queryset)
         cache.set(key, count, timeout=NEVER_EXPIRE)
 
-    # Close the connection in the thread to prevent 'idle in transaction'
-    # situtations.
-    from django.db import connection
-    connection.close()
-
     return count
 
 
+def get_count_sql(queryset):
+    "Returns the SQL and params of a distinct count of the queryset."
+    if is_unfiltered(queryset):
+        queryset = queryset.values('pk').order_by()
+    else:
+        queryset = queryset.values('pk').distinct().order_by()
+
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+
+    return 'SELECT COUNT(*) FROM ({0}) AS count_subquery'.format(sql), params
+
+
+def get_batch_counts(querysets):
+    """Returns the distinct counts of querysets in order.
+
+    The counts are combined into a single statement of `UNION ALL`
+    subqueries. The querysets must use the same database. If the
+    statement fails, the querysets are counted individually.
+    """
+    counts = [0] * len(querysets)
+    parts = []
+    params = []
+
+    for i, queryset in enumerate(querysets):
+        try:
+            sql, _params = get_count_sql(queryset)
+        except EmptyResultSet:
+            continue
+
+        parts.append('SELECT {0}, ({1})'.format(i, sql))
+        params.extend(_params)
+
+    if not parts:
+        return counts
+
+    try:
+        cursor = connections[querysets[0].db].cursor()
+        cursor.execute(' UNION ALL '.join(parts), params)
+
+        for i, count in cursor.fetchall():
+            counts[i] = count
+    except DatabaseError:
+        log.exception('Batched count failed, counting individually')
+
+        for i, queryset in enumerate(querysets):
+            counts[i] = count_queryset(queryset)
+
+    return counts
+
+
+def run_count(func, args):
+    "Executes a count in a pool thread and tracks the pool's usage."
+    _incr_pool_stat('active')
+
+    try:
+        return func(*args)
+    finally:
+        # Connections are kept open for the next count executed in this
+        # thread unless they have exceeded CONN_MAX_AGE or errored.
+        # Closing them is the only option prior to Django 1.6.
+        for connection in connections.all():
+            if hasattr(connection, 'close_if_unusable_or_obsolete'):
+                connection.close_if_unusable_or_obsolete()
+            else:
+                connection.close()
+
+        _incr_pool_stat('active', -1)
+        _incr_pool_stat('completed')
+
+
+def get_request_limit():
+    "Returns the number of counts a single request executes concurrently."
+    limit = serrano_settings.STATS_COUNT_REQUEST_LIMIT
+
+    if limit is None:
+        limit = serrano_settings.STATS_COUNT_WORKERS // 2
+
+    return max(limit, 1)
+
+
+def iter_counts(tasks, limit=None, timeout=None):
+    """Executes the count tasks, (func, args) pairs, in the process-wide
+    pool and yields the results in order. A task that fails or does not
+    finish within `timeout` seconds is yielded as None.
+
+    At most `limit` tasks are outstanding at once so a single request
+    cannot occupy the whole pool.
+    """
+    if limit is None:
+        limit = get_request_limit()
+
+    if timeout is None:
+        timeout = serrano_settings.STATS_COUNT_TIMEOUT
+
+    pool = get_pool()
+    tasks = iter(tasks)
+    pending = deque()
+
+    def submit():
+        for task in tasks:
+            _incr_pool_stat('submitted')
+            pending.append(pool.apply_async(run_count, args=task))
+            return True
+
+        return False
+
+    while len(pending) < limit and submit():
+        pass
+
+    while pending:
+        result = pending.popleft()
+
+        try:
+            yield result.get(timeout=timeout)
+        except Exception:
+            if not result.ready():
+                _incr_pool_stat('timeouts')
+
+            yield None
+
+        submit()
+
+    stats = get_pool_stats()
+
+    log.debug('Count pool: {active} active, {queued} queued, '
+              '{peak_active} peak active of {workers} workers, '
+              '{timeouts} timeouts'.format(**stats))
+
+
+def get_counts(request, models, refresh, processor, context):
+    """Returns the distinct counts of the models in order. A count that
+    fails or times out is None.
+
+    Counts are cached until the data version of the fields of the tables
+    they read from changes. Counts that are not cached are batched by
+    database into statements of at most STATS_COUNT_BATCH_SIZE counts which
+    are executed in parallel.
+    """
+    batch_size = serrano_settings.STATS_COUNT_BATCH_SIZE
+    versions = get_data_versions()
+
+    if not batch_size or batch_size < 2:
+        return list(iter_counts([
+            (get_count, (request, model, refresh, processor, context,
+                         versions))
+            for model in models
+        ]))
+
+    cache = get_cache(avocado_settings.DATA_CACHE)
+
+    counts = [None] * len(models)
+    batches = []
+    pending = {}
+
+    for i, model in enumerate(models):
+        # The key is derived from the SQL of the queryset which cannot be
+        # compiled for an empty queryset. A model whose queryset cannot be
+        # built is not counted.
+        try:
+            queryset = get_count_queryset(request, model, processor, context)
+            key = get_count_key(model, queryset, versions)
+        except EmptyResultSet:
+            counts[i] = 0
+            continue
+        except Exception:
+            log.exception('Failed to build the count queryset of {0}'
+                          .format(model._meta.object_name))
+            continue
+
+        if not refresh:
+            counts[i] = cache.get(key)
+
+            if counts[i] is not None:
+                continue
+
+        batch = pending.get(queryset.db)
+
+        if batch is None:
+            batch = pending[queryset.db] = []
+            batches.append(batch)
+
+        batch.append((i, key, queryset))
+
+        # Start a new batch for the database once this one is full.
+        if len(batch) == batch_size:
+            del pending[queryset.db]
+
+    tasks = [(get_batch_counts, ([q for i, k, q in b],)) for b in batches]
+
+    for batch, batch_counts in zip(batches, iter_counts(tasks)):
+        if batch_counts is None:
+            continue
+
+        for (i, key, queryset), count in zip(batch, batch_counts):
+            counts[i] = count
+            cache.set(key, count, timeout=NEVER_EXPIRE)
+
+    return counts
+
+
 class StatsResource(BaseResource):
     def get_links(self, request):
         uri = request.build_absolute_uri
@@ -83,19 +439,8 @@ class CountStatsResource(ThrottledResource):
             .values_list('app_name', 'model_name')\
             .order_by('model_name').distinct()
 
-        results = []
         data = []
-        models = set()
-
-        QueryProcessor = pipeline.query_processors[params['processor']]
-
-        # Workaround for a Python bug for versions 2.7.5 and below
-        # http://bugs.python.org/issue10015
-        if not hasattr(threading.current_thread(), '_children'):
-            threading.current_thread()._children = weakref.WeakKeyDictionary()
-
-        # Pool of threads to execute the counts in parallel
-        pool = ThreadPool()
+        models = []
 
         for app_name, model_name in model_names:
             # DataField used here to resolve foreign key-based fields.
@@ -105,7 +450,7 @@ class CountStatsResource(ThrottledResource):
             if model in models:
                 continue
 
-            models.add(model)
+            models.append(model)
 
             opts = model._meta
 
@@ -131,25 +476,13 @@ class CountStatsResource(ThrottledResource):
                 'verbose_name_plural': verbose_name_plural,
             })
 
-            # Asynchronously execute the count
-            result = pool.apply_async(get_count, args=(
-                request,
-                model,
-                params['refresh'],
-                QueryProcessor,
-                context
-            ))
-
-            results.append(result)
-
-        pool.close()
-
-        for i, r in enumerate(results):
-            try:
-                count = r.get(timeout=serrano_settings.STATS_COUNT_TIMEOUT)
-                data[i]['count'] = count
-            except Exception:
-                pass
+        QueryProcessor = pipeline.query_processors[params['processor']]
+
+        counts = get_counts(request, models, params['refresh'],
+                            QueryProcessor, context)
+
+        for i, count in enumerate(counts):
+            data[i]['count'] = count
 
         return data
 
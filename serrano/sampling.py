@@ -0,0 +1,62 @@
+"""Random samples of the distinct values of a field.
+
+`DataField.random` loads every distinct value of the field to sample from
+them in Python. Instead, the sample is selected by the database by ordering
+the distinct values randomly with a limit, so only the sampled values are
+transferred. Backends without a LIMIT clause use a reservoir sample over
+an iterator of the values which holds at most `k` values in memory.
+
+If the population is smaller than the sample, the whole population is
+returned.
+"""
+import random
+from django.db import connections
+
+# Backends that support ordering by the random function with a LIMIT.
+LIMIT_VENDORS = ('postgresql', 'sqlite', 'mysql')
+
+
+def reservoir_sample(iterable, k, rand=None):
+    "Returns a uniform sample of at most k items of the iterable."
+    if rand is None:
+        rand = random
+
+    sample = []
+
+    for i, item in enumerate(iterable):
+        if i < k:
+            sample.append(item)
+        else:
+            j = rand.randint(0, i)
+
+            if j < k:
+                sample[j] = item
+
+    return sample
+
+
+def sample_values(field, k, queryset=None):
+    "Returns a random sample of at most k distinct values of the field."
+    values = field.values_list(order=False, queryset=queryset)
+
+    connection = connections[values.db]
+
+    if connection.vendor not in LIMIT_VENDORS:
+        return reservoir_sample(values.iterator(), k)
+
+    sql, params = values.query.get_compiler(values.db).as_sql()
+
+    # The distinct values are selected in a subquery since some backends
+    # require the ORDER BY expressions of a SELECT DISTINCT to be selected.
+    sql = 'SELECT * FROM ({0}) AS sample_subquery ORDER BY {1} LIMIT %s'\
+        .format(sql, connection.ops.random_function_sql())
+
+    cursor = connection.cursor()
+    cursor.execute(sql, list(params) + [k])
+
+    # Values are converted since backend conversions of the column are not
+    # applied to raw queries.
+    to_python = field.field.to_python
+
+    return [row[0] if row[0] is None else to_python(row[0])
+            for row in cursor.fetchall()]
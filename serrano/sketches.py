@@ -0,0 +1,297 @@
+"""HyperLogLog sketches for approximate distinct counts of field values.
+
+An exact distinct count requires the database to sort or hash every value
+of the field. A HyperLogLog sketch estimates the number of distinct values
+from a fixed number of small registers with a relative standard error of
+`1.04 / sqrt(m)` where `m` is the number of registers.
+
+Sketches are never built from the values in a request. The sketch of all
+of a field's values is built ahead of time with the `build_sketches`
+command and is used for unfiltered querysets. Sketches are mergeable: the
+sketch of a union of rows is the register-wise maximum of the sketches of
+its parts, so the rows are split into primary key ranges whose sketches are
+built in parallel and merged. The sketch is cached per field, keyed by the
+field's `data_version`.
+
+Filtered querysets have no precomputed sketch. On PostgreSQL, their
+registers are computed by the database so only `m` rows are transferred.
+On other backends, no sketch is available for them.
+"""
+import math
+import struct
+import hashlib
+from django.core.cache import get_cache
+from django.db import connections
+from django.db.models import Max, Min
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils.encoding import smart_str
+from avocado.conf import settings as avocado_settings
+from avocado.core.cache import cache_key
+from avocado.core.cache.model import NEVER_EXPIRE
+from serrano.conf import settings
+
+
+class HyperLogLog(object):
+    """HyperLogLog sketch with 2 ** `precision` registers.
+
+    Values are hashed to the first 64 bits of their MD5 digest. The first
+    `precision` bits select the register and the register keeps the maximum
+    position of the first set bit in the remaining bits. MD5 is used since
+    it is available in SQL on PostgreSQL.
+    """
+
+    def __init__(self, precision=None, registers=None):
+        if precision is None:
+            precision = settings.STATS_SKETCH_PRECISION
+
+        if not 4 <= precision <= 16:
+            raise ValueError('Precision must be between 4 and 16.')
+
+        self.precision = precision
+        self.m = 1 << precision
+
+        if registers is None:
+            registers = bytearray(self.m)
+        elif len(registers) != self.m:
+            raise ValueError('Expected {0} registers.'.format(self.m))
+
+        self.registers = bytearray(registers)
+
+    def _hash(self, value):
+        digest = hashlib.md5(smart_str(value)).digest()
+        return struct.unpack('>Q', digest[:8])[0]
+
+    def add(self, value):
+        x = self._hash(value)
+        bits = 64 - self.precision
+
+        index = x >> bits
+        rest = x & ((1 << bits) - 1)
+
+        # Position of the first set bit in the remaining bits, or one more
+        # than the number of bits if none are set. The bit length is taken
+        # from the binary string since int.bit_length requires Python 2.7.
+        length = rest and len(bin(rest)) - 2
+        rank = bits - length + 1
+
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def update(self, values):
+        for value in values:
+            self.add(value)
+
+    def merge(self, other):
+        "Merges another sketch of the same precision into this one."
+        if other.precision != self.precision:
+            raise ValueError('Sketches must have the same precision.')
+
+        registers = self.registers
+
+        for i, rank in enumerate(other.registers):
+            if rank > registers[i]:
+                registers[i] = rank
+
+    @property
+    def error(self):
+        "Relative standard error of the estimate."
+        return 1.04 / math.sqrt(self.m)
+
+    def _alpha(self):
+        if self.m == 16:
+            return 0.673
+        if self.m == 32:
+            return 0.697
+        if self.m == 64:
+            return 0.709
+        return 0.7213 / (1 + 1.079 / self.m)
+
+    def count(self):
+        "Returns the estimated number of distinct values."
+        m = self.m
+        estimate = self._alpha() * m * m / \
+            sum([2.0 ** -r for r in self.registers])
+
+        # Linear counting is more accurate for small cardinalities.
+        if estimate <= 2.5 * m:
+            zeros = self.registers.count(b'\x00')
+
+            if zeros:
+                estimate = m * math.log(float(m) / zeros)
+
+        return int(round(estimate))
+
+    def __getstate__(self):
+        return {'precision': self.precision,
+                'registers': str(self.registers)}
+
+    def __setstate__(self, state):
+        self.__init__(state['precision'], bytearray(state['registers']))
+
+
+def get_partitions(queryset, partitions=None):
+    """Splits the queryset into at most `partitions` querysets by ranges
+    of the primary key. Querysets of models without an integer primary key
+    are not split.
+    """
+    if partitions is None:
+        partitions = settings.STATS_SKETCH_PARTITIONS
+
+    if not partitions or partitions < 2 or \
+            queryset.model._meta.pk.get_internal_type() not in \
+            ('AutoField', 'IntegerField', 'BigIntegerField'):
+        return [queryset]
+
+    bounds = queryset.order_by().aggregate(low=Min('pk'), high=Max('pk'))
+    low, high = bounds['low'], bounds['high']
+
+    if low is None:
+        return [queryset]
+
+    size = int(math.ceil((high - low + 1) / float(partitions)))
+    querysets = []
+
+    for start in range(low, high + 1, size):
+        querysets.append(queryset.filter(pk__gte=start,
+                                         pk__lt=start + size))
+
+    return querysets
+
+
+def get_partition_sketch(field_name, queryset, precision):
+    "Builds the sketch of the field's non-null values in the queryset."
+    sketch = HyperLogLog(precision)
+
+    values = queryset.order_by().values_list(field_name, flat=True)\
+        .iterator()
+
+    for value in values:
+        if value is not None:
+            sketch.add(value)
+
+    return sketch
+
+
+# Computes the registers of the non-null values of a subquery on PostgreSQL
+# the same way as `HyperLogLog.add`.
+SQL_REGISTERS = """
+SELECT substring(h FROM 1 FOR {precision})::bit({precision})::int,
+    MAX(CASE position(B'1' IN substring(h FROM {offset}))
+        WHEN 0 THEN {empty}
+        ELSE position(B'1' IN substring(h FROM {offset}))
+    END)
+FROM (
+    SELECT ('x' || substr(md5(value::text), 1, 16))::bit(64) AS h
+    FROM ({sql}) AS sketch_values (value)
+    WHERE value IS NOT NULL
+) AS sketch_hashes
+GROUP BY 1
+"""
+
+
+def get_sql_sketch(field, queryset, precision):
+    """Returns the sketch of the field's values in the queryset with the
+    registers computed by the database. Only supported on PostgreSQL.
+    """
+    sketch = HyperLogLog(precision)
+
+    values = queryset.order_by().values_list(field.field_name)
+
+    try:
+        sql, params = values.query.get_compiler(values.db).as_sql()
+    except EmptyResultSet:
+        return sketch
+
+    sql = SQL_REGISTERS.format(sql=sql, precision=precision,
+                               offset=precision + 1,
+                               empty=64 - precision + 1)
+
+    cursor = connections[values.db].cursor()
+    cursor.execute(sql, params)
+
+    for index, rank in cursor.fetchall():
+        sketch.registers[index] = rank
+
+    return sketch
+
+
+def get_sketch_key(field, precision):
+    return cache_key('serrano:sketch', version=field.data_version,
+                     kwargs={'pk': field.pk, 'precision': precision})
+
+
+def build_sketch(field, precision=None):
+    """Builds and caches the sketch of all of the field's values. This reads
+    every value of the field, so it is done ahead of time by the
+    `build_sketches` command rather than in a request.
+
+    Multiple partitions are built in parallel in the stats count pool.
+    Returns None if any partition fails.
+    """
+    from serrano.resources.stats import iter_counts
+
+    if precision is None:
+        precision = settings.STATS_SKETCH_PRECISION
+
+    queryset = field.model.objects.all()
+    partitions = get_partitions(queryset)
+
+    # The registers of the partitions are computed by the database on
+    # PostgreSQL.
+    if connections[queryset.db].vendor == 'postgresql':
+        build = get_sql_sketch
+        field_arg = field
+    else:
+        build = get_partition_sketch
+        field_arg = field.field_name
+
+    # A single partition is built in the calling thread.
+    if len(partitions) == 1:
+        sketch = build(field_arg, partitions[0], precision)
+    else:
+        tasks = [(build, (field_arg, q, precision)) for q in partitions]
+
+        sketch = HyperLogLog(precision)
+
+        for partition in iter_counts(tasks,
+                                     timeout=settings.STATS_SKETCH_TIMEOUT):
+            if partition is None:
+                return
+
+            sketch.merge(partition)
+
+    cache = get_cache(avocado_settings.DATA_CACHE)
+    cache.set(get_sketch_key(field, precision), sketch, timeout=NEVER_EXPIRE)
+
+    return sketch
+
+
+def get_cached_sketch(field, precision=None):
+    "Returns the sketch built by `build_sketch` or None if there is none."
+    if precision is None:
+        precision = settings.STATS_SKETCH_PRECISION
+
+    cache = get_cache(avocado_settings.DATA_CACHE)
+
+    return cache.get(get_sketch_key(field, precision))
+
+
+def get_sketch(field, queryset=None, precision=None):
+    """Returns the sketch of the field's values in the queryset without
+    reading the values. Returns None if the sketch is not available, which
+    is the case for unfiltered querysets if the field's sketch has not been
+    built and for filtered querysets on backends other than PostgreSQL.
+    """
+    from serrano.resources.stats import is_unfiltered
+
+    if queryset is None:
+        queryset = field.model.objects.all()
+
+    if precision is None:
+        precision = settings.STATS_SKETCH_PRECISION
+
+    if queryset.model is field.model and is_unfiltered(queryset):
+        return get_cached_sketch(field, precision)
+
+    if connections[queryset.db].vendor == 'postgresql':
+        return get_sql_sketch(field, queryset, precision)
@@ -0,0 +1,236 @@
+"""Utilities for streaming responses.
+
+Exporters write to a file-like object in a single blocking call. To stream
+the output, the exporter is run in a producer thread which writes to a
+bounded buffer that is consumed by the response iterator. The producer
+blocks when the buffer is full, so memory use is bounded by the buffer size
+regardless of the size of the export.
+"""
+import sys
+import uuid
+import logging
+import threading
+from contextlib import contextmanager
+from Queue import Queue, Full
+from django.db import connections, transaction
+from django.db.models.query import EmptyQuerySet
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.utils import six
+from avocado.query.pipeline import QueryProcessor
+from avocado.query.utils import TEMP_DB_ALIAS_PREFIX, ensure_connection, \
+    named_connection
+from serrano.conf import settings
+
+log = logging.getLogger(__name__)
+
+# Marks the end of the stream in the buffer queue.
+_END = object()
+
+
+class StreamAborted(Exception):
+    "Raised in the producer when the consumer stops reading the stream."
+
+
+class StreamBuffer(object):
+    """File-like object that passes written data to a consumer.
+
+    Writes are accumulated into chunks of `chunk_size` bytes which are put
+    on a queue holding at most `max_chunks` chunks.
+    """
+    def __init__(self, chunk_size=None, max_chunks=None):
+        if chunk_size is None:
+            chunk_size = settings.STREAM_CHUNK_SIZE
+
+        if max_chunks is None:
+            max_chunks = settings.STREAM_MAX_CHUNKS
+
+        self.chunk_size = chunk_size
+        self.queue = Queue(maxsize=max_chunks)
+        self.aborted = False
+        self.position = 0
+        self._chunks = []
+        self._size = 0
+
+    def put(self, item):
+        # A timeout is used so the producer can detect the consumer has
+        # gone away while waiting for room in the queue.
+        while True:
+            if self.aborted:
+                raise StreamAborted
+
+            try:
+                self.queue.put(item, timeout=0.5)
+                return
+            except Full:
+                pass
+
+    def write(self, data):
+        if self.aborted:
+            raise StreamAborted
+
+        if not data:
+            return
+
+        self._chunks.append(data)
+        self._size += len(data)
+        self.position += len(data)
+
+        if self._size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self._chunks:
+            data = b''.join(self._chunks)
+            self._chunks = []
+            self._size = 0
+            self.put(data)
+
+    def tell(self):
+        return self.position
+
+
+def stream_write(write, chunk_size=None, max_chunks=None):
+    """Generator of the data written by `write` to a stream buffer.
+
+    `write` is called with the buffer in a producer thread once the first
+    chunk is requested. Exceptions raised by `write` are raised in the
+    consumer. If the consumer stops iterating, the next write in the
+    producer raises StreamAborted which ends the thread.
+    """
+    buff = StreamBuffer(chunk_size=chunk_size, max_chunks=max_chunks)
+    errors = []
+
+    def produce():
+        try:
+            write(buff)
+            buff.flush()
+        except StreamAborted:
+            return
+        except Exception:
+            errors.append(sys.exc_info())
+
+        try:
+            buff.put(_END)
+        except StreamAborted:
+            pass
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            chunk = buff.queue.get()
+
+            if chunk is _END:
+                break
+
+            yield chunk
+
+        if errors:
+            six.reraise(*errors[0])
+    finally:
+        buff.aborted = True
+
+
+def iter_server_side(queryset, itersize=None):
+    """Returns an iterator of rows for a queryset using a server-side cursor.
+
+    A server-side (named) cursor is only supported for PostgreSQL. For other
+    databases, the rows are read using the compiler's iterator. This must
+    be called in the thread that iterates the rows since connections are
+    thread-local.
+    """
+    if itersize is None:
+        itersize = settings.STREAM_CURSOR_ITERSIZE
+
+    # Empty querysets are not propagated to the internal query object in
+    # Django 1.5 and below.
+    if isinstance(queryset, EmptyQuerySet):
+        return
+
+    alias = queryset.db
+    connection = connections[alias]
+    compiler = queryset.query.get_compiler(alias)
+
+    if connection.vendor != 'postgresql':
+        for row in compiler.results_iter():
+            yield row
+        return
+
+    try:
+        sql, params = compiler.as_sql()
+    except EmptyResultSet:
+        return
+
+    # Columns added for ordering a distinct query are not part of the row.
+    trim = len(compiler.ordering_aliases)
+
+    # Register the backend process of this thread's connection for named
+    # connections so the query can be canceled.
+    prefix = TEMP_DB_ALIAS_PREFIX.format('')
+
+    if alias.startswith(prefix):
+        named_connection(alias[len(prefix):], alias)
+    else:
+        ensure_connection(connection)
+
+    # The cursor is declared in a transaction since a cursor held across
+    # commits in autocommit mode is materialized by PostgreSQL.
+    with cursor_transaction(alias):
+        name = 'serrano_{0}'.format(uuid.uuid4().hex)
+        cursor = connection.connection.cursor(name=name)
+        cursor.itersize = itersize
+
+        try:
+            cursor.execute(sql, params)
+
+            for row in cursor:
+                if trim:
+                    row = row[:-trim]
+
+                yield row
+        finally:
+            cursor.close()
+
+
+@contextmanager
+def cursor_transaction(using):
+    """Holds a transaction open on the connection while the block runs.
+
+    Django 1.5 does not have `atomic`. Its connections are always in a
+    transaction, so transaction management is entered to keep the ORM from
+    committing while the block runs.
+    """
+    if hasattr(transaction, 'atomic'):
+        with transaction.atomic(using=using):
+            yield
+        return
+
+    transaction.enter_transaction_management(using=using)
+    transaction.managed(True, using=using)
+
+    try:
+        yield
+    finally:
+        transaction.leave_transaction_management(using=using)
+
+
+def get_server_side_iterable(processor):
+    """Returns the `get_iterable` function rows are streamed from. The rows
+    of the processor's iterable are read from a server-side cursor, unless
+    the processor overrides `get_iterable` in which case it is used as is.
+    """
+    if type(processor).get_iterable.im_func is not \
+            QueryProcessor.get_iterable.im_func:
+        return processor.get_iterable
+
+    def get_iterable(queryset, offset=None, limit=None):
+        offset = offset or 0
+
+        if offset or limit:
+            queryset = queryset[offset:offset + limit if limit else None]
+
+        return iter_server_side(queryset)
+
+    return get_iterable
@@ -0,0 +1,380 @@
+"""Functions executed by async jobs.
+
+These wrap Avocado's `get_result_rows`. The query is prepared in the request
+and the job reads the rows, publishing its progress while the rows are read
+so clients can poll the job less often.
+
+Progress is stored in the cache rather than the job's meta since the
+worker overwrites the meta with its own copy when the job finishes.
+
+Large results are spilled to files so only a handle to the rows is kept
+in the job store.
+"""
+import os
+import math
+import time
+import glob
+import tempfile
+import cPickle as pickle
+from itertools import islice
+from django.core.cache import cache
+from django.db.models.query import QuerySet
+from django_rq import get_queue
+from rq import get_current_job
+
+from avocado.conf import settings as avocado_settings
+from avocado.query.utils import close_connection, get_exporter_class, \
+    get_result_rows, isolate_queryset
+from serrano.conf import settings
+from serrano.resources.pagination import estimate_count
+
+JOB_PROGRESS_KEY = 'serrano:job_progress:{0}'
+
+# Redis list that a job pushes to when it is done to wake up waiting clients.
+JOB_DONE_KEY = 'serrano:job_done:{0}'
+
+# Progress and notifications of finished jobs are kept for a day.
+JOB_PROGRESS_TIMEOUT = 60 * 60 * 24
+
+
+def get_connection():
+    return get_queue(avocado_settings.ASYNC_QUEUE).connection
+
+
+def get_job_progress(job_id):
+    "Returns the last published progress of the job or None."
+    return cache.get(JOB_PROGRESS_KEY.format(job_id))
+
+
+def delete_job_progress(job_id):
+    cache.delete(JOB_PROGRESS_KEY.format(job_id))
+
+
+def notify_job_done(job_id):
+    "Wakes up the clients waiting on the job."
+    key = JOB_DONE_KEY.format(job_id)
+    connection = get_connection()
+
+    pipe = connection.pipeline()
+    pipe.lpush(key, 1)
+    pipe.expire(key, JOB_PROGRESS_TIMEOUT)
+    pipe.execute()
+
+
+def wait_for_job(job_id, timeout):
+    """Blocks until the job is done or the timeout in seconds expires.
+
+    Returns true if the job is done. The notification is popped and pushed
+    back onto the same list atomically so it remains for other clients.
+    """
+    # A timeout of zero blocks indefinitely.
+    timeout = max(int(math.ceil(timeout)), 1)
+    key = JOB_DONE_KEY.format(job_id)
+
+    return get_connection().brpoplpush(key, key, timeout=timeout) is not None
+
+
+class JobProgress(object):
+    """Publishes the progress of reading rows in a job.
+
+    `total` is the expected number of rows if known. It is used with the
+    rate rows are read to estimate the remaining time. Progress is
+    published at most once every JOB_PROGRESS_INTERVAL seconds.
+    """
+    def __init__(self, job_id, page=None, stop_page=None, page_size=None,
+                 total=None):
+        self.job_id = job_id
+        self.page = page
+        self.stop_page = stop_page
+        self.page_size = page_size
+        self.total = total
+        self.rows = 0
+        self.started = time.time()
+        self.published = None
+
+    def get_page(self):
+        "Returns the page currently being read."
+        if not self.page or not self.page_size:
+            return self.page
+
+        page = self.page + self.rows // self.page_size
+
+        return min(page, max(self.stop_page or self.page, self.page))
+
+    def get_remaining(self, elapsed):
+        "Returns the estimated number of seconds remaining."
+        if not self.total or not self.rows:
+            return
+
+        if self.rows >= self.total:
+            return 0
+
+        return elapsed / self.rows * (self.total - self.rows)
+
+    def get_data(self):
+        elapsed = time.time() - self.started
+
+        return {
+            'rows': self.rows,
+            'total': self.total,
+            'page': self.get_page(),
+            'elapsed': round(elapsed, 3),
+            'remaining': self.get_remaining(elapsed),
+        }
+
+    def publish(self, done=False):
+        data = self.get_data()
+
+        if done:
+            data['remaining'] = 0
+
+        cache.set(JOB_PROGRESS_KEY.format(self.job_id), data,
+                  JOB_PROGRESS_TIMEOUT)
+
+        self.published = time.time()
+
+    def iterate(self, rows):
+        "Generator that counts the rows and publishes the progress."
+        interval = settings.JOB_PROGRESS_INTERVAL
+
+        self.publish()
+
+        for row in rows:
+            self.rows += 1
+
+            if time.time() - self.published >= interval:
+                self.publish()
+
+            yield row
+
+        self.publish(done=True)
+
+
+class SpilledRows(object):
+    """Rows of a job result that have been written to a file.
+
+    The rows are written as a sequence of pickled chunks and read back
+    one chunk at a time. Only the path is stored with the job result.
+    """
+    prefix = 'serrano-job-'
+    suffix = '.rows'
+
+    def __init__(self, path, count):
+        self.path = path
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        with open(self.path, 'rb') as f:
+            while True:
+                try:
+                    chunk = pickle.load(f)
+                except EOFError:
+                    return
+
+                for row in chunk:
+                    yield row
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def delete(self):
+        if self.exists():
+            os.remove(self.path)
+
+
+def cleanup_spilled_rows(max_age=None):
+    """Removes spilled rows that are older than `max_age` seconds, which
+    defaults to the result TTL of jobs.
+    """
+    if max_age is None:
+        max_age = settings.JOB_RESULT_TTL
+
+    directory = settings.JOB_SPILL_DIR or tempfile.gettempdir()
+    pattern = os.path.join(directory, SpilledRows.prefix + '*' +
+                           SpilledRows.suffix)
+    expired = time.time() - max_age
+
+    for path in glob.glob(pattern):
+        try:
+            if os.path.getmtime(path) < expired:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def spill_rows(rows):
+    """Evaluates the rows and returns them as a list or, if there are at
+    least JOB_SPILL_ROWS rows, as SpilledRows.
+    """
+    threshold = settings.JOB_SPILL_ROWS
+
+    if not threshold:
+        return list(rows)
+
+    rows = iter(rows)
+    chunk = list(islice(rows, threshold))
+
+    if len(chunk) < threshold:
+        return chunk
+
+    cleanup_spilled_rows()
+
+    fd, path = tempfile.mkstemp(prefix=SpilledRows.prefix,
+                                suffix=SpilledRows.suffix,
+                                dir=settings.JOB_SPILL_DIR)
+    count = 0
+
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            while chunk:
+                pickle.dump(chunk, f, pickle.HIGHEST_PROTOCOL)
+                count += len(chunk)
+                chunk = list(islice(rows, threshold))
+    except Exception:
+        os.remove(path)
+        raise
+
+    return SpilledRows(path, count)
+
+
+def read_rows(processor, exporter, view, queryset, offset=None, limit=None,
+              reader=None, get_iterable=None):
+    """Returns the formatted rows of the queryset as read by Avocado's
+    `get_result_rows`. The rows are read from `get_iterable`, which defaults
+    to the processor's `get_iterable`.
+    """
+    if get_iterable is None:
+        get_iterable = processor.get_iterable
+
+    # If concepts are selected for ordering only, the rows are sliced while
+    # being read. See `get_result_rows`.
+    order_only = lambda f: not f.get('visible', True)
+
+    if filter(order_only, view.parse().facets):
+        return exporter.manual_read(get_iterable(queryset=queryset),
+                                    offset=offset,
+                                    limit=limit)
+
+    method = exporter.reader(reader)
+
+    return method(get_iterable(queryset=queryset, limit=limit,
+                               offset=offset))
+
+
+def async_get_result_rows(context, view, query_options, job_options=None,
+                          request=None):
+    """Creates a new job to asynchronously get result rows and returns the
+    job ID. This is equivalent to Avocado's `async_get_result_rows`.
+
+    The query is prepared by Avocado's `get_result_rows` in the request, so
+    the query processor receives the request, and the rows are read by the
+    job.
+    """
+    result = get_result_rows(context, view, query_options, request=request)
+
+    # The rows are not read in the request. The query is passed rather than
+    # the queryset since pickling a queryset evaluates it.
+    del result['rows']
+
+    queryset = result.pop('queryset')
+    limit = result['limit']
+
+    # The planner estimate is used for the expected number of rows.
+    total = estimate_count(queryset)
+
+    if limit and (total is None or total > limit):
+        total = limit
+
+    queue = get_queue(avocado_settings.ASYNC_QUEUE)
+
+    job = queue.enqueue(get_and_format_rows,
+                        result=result,
+                        model=queryset.model,
+                        query=queryset.query,
+                        db=queryset.db,
+                        reader=query_options.get('reader'),
+                        page_size=query_options.get('limit') or 0,
+                        total=total,
+                        result_ttl=settings.JOB_RESULT_TTL)
+
+    job.meta.update(job_options or {})
+    job.save()
+
+    return job.id
+
+
+def get_and_format_rows(result, model, query, db, reader=None,
+                        page_size=None, total=None):
+    """Reads and formats the rows of the result prepared by Avocado's
+    `get_result_rows` and returns the result with the rows. The progress of
+    the job is published while the rows are read.
+    """
+    # The connection is passed since workers may be run without pushing
+    # a connection on the stack.
+    job = get_current_job(connection=get_connection())
+
+    # Waiters are notified however the job ends, including when the query
+    # fails or is canceled.
+    try:
+        queryset = QuerySet(model=model, query=query, using=db)
+
+        exporter = result['processor'].get_exporter(
+            get_exporter_class(result['export_type']))
+
+        rows = read_rows(result['processor'], exporter, result['view'],
+                         queryset, offset=result['offset'],
+                         limit=result['limit'], reader=reader)
+
+        if job is not None:
+            progress = JobProgress(job.id, page=result['page'],
+                                   stop_page=result['stop_page'],
+                                   page_size=page_size, total=total)
+            rows = progress.iterate(rows)
+
+        rows = spill_rows(rows)
+    finally:
+        if job is not None:
+            notify_job_done(job.id)
+
+    # The queryset is not returned since pickling it for the job store
+    # would evaluate the whole query. Only its model is kept for the
+    # result processors.
+    return dict(result, queryset=None, model=model, rows=rows)
+
+
+def get_and_format_range(processor, export_type, model, query, db, offset,
+                         limit, reader=None, query_name=None):
+    """Reads and formats a range of the rows of a query prepared in the
+    request and returns the rows. Used to compute the page ranges of an
+    export in parallel.
+
+    The queryset is isolated to a connection named `query_name` in the
+    worker so the range can be canceled. The connection is closed when the
+    range has been read.
+    """
+    job = get_current_job(connection=get_connection())
+
+    try:
+        queryset = QuerySet(model=model, query=query, using=db)
+
+        if query_name:
+            queryset = isolate_queryset(query_name, queryset)
+
+        exporter = processor.get_exporter(get_exporter_class(export_type))
+
+        try:
+            rows = read_rows(processor, exporter, processor.view, queryset,
+                             offset=offset, limit=limit, reader=reader)
+
+            rows = spill_rows(rows)
+        finally:
+            if query_name:
+                close_connection(query_name)
+    finally:
+        if job is not None:
+            notify_job_done(job.id)
+
+    return {'rows': rows}
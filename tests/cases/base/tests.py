@@ -1,10 +1,29 @@
 import time
+import random
+import datetime
+import zlib
+import cPickle as pickle
+from django.http import HttpResponse, StreamingHttpResponse
+from django.core.cache import get_cache
 from django.test import TestCase
+from django.test.client import RequestFactory
 from django.test.utils import override_settings
 from django.core.urlresolvers import reverse
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate
+from django.db import transaction
+from django.utils import unittest
 from restlib2.http import codes
+from avocado.query.pipeline import QueryProcessor
+from avocado.stats import kmeans
+from serrano import compression
+from serrano.conf import dep_supported
+from serrano.labels import LabelMap, get_chunked, set_chunked
+from serrano.resources.exporter import split_pages
+from serrano.sampling import reservoir_sample
+from serrano.sketches import HyperLogLog
+from serrano.streaming import cursor_transaction, get_server_side_iterable
+from serrano.tasks import SpilledRows, spill_rows
 from serrano.tokens import token_generator, generate_random_token
 
 
@@ -111,3 +130,260 @@ class TokenBackendTestCase(TestCase):
         resp = self.client.get(reverse('serrano:root'),
                                HTTP_ACCEPT='application/json')
         self.assertEqual(resp.status_code, codes.unauthorized)
+
+
+class CompressionTestCase(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_get_encoding(self):
+        request = self.factory.get('/')
+        self.assertEqual(compression.get_encoding(request), None)
+
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(compression.get_encoding(request), 'gzip')
+
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip;q=0')
+        self.assertEqual(compression.get_encoding(request), None)
+
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='*;q=0.5')
+        self.assertTrue(compression.get_encoding(request) in
+                        compression.get_encodings())
+
+    def test_patch_response(self):
+        content = 'a,b,c\n' * 1000
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip')
+
+        response = compression.patch_response(
+            request, HttpResponse(content))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        self.assertEqual(zlib.decompress(response.content,
+                                         16 + zlib.MAX_WBITS), content)
+
+        response = compression.patch_response(
+            request, StreamingHttpResponse(iter([content, content])))
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        data = b''.join(response.streaming_content)
+        self.assertEqual(zlib.decompress(data, 16 + zlib.MAX_WBITS),
+                         content * 2)
+
+        # Small responses are not compressed.
+        response = compression.patch_response(request, HttpResponse('a'))
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+    @override_settings(SERRANO_COMPRESSION_ENABLED=False)
+    def test_disabled(self):
+        request = self.factory.get('/', HTTP_ACCEPT_ENCODING='gzip')
+        response = compression.patch_response(
+            request, HttpResponse('a,b,c\n' * 1000))
+        self.assertFalse(response.has_header('Content-Encoding'))
+
+
+class SpillRowsTestCase(TestCase):
+    @override_settings(SERRANO_JOB_SPILL_ROWS=3)
+    def test_below_threshold(self):
+        self.assertEqual(spill_rows(iter([(1,), (2,)])), [(1,), (2,)])
+
+    @override_settings(SERRANO_JOB_SPILL_ROWS=3)
+    def test_spill(self):
+        rows = [(i, 'row {0}'.format(i)) for i in range(7)]
+        spilled = spill_rows(iter(rows))
+
+        self.assertTrue(isinstance(spilled, SpilledRows))
+        self.assertEqual(len(spilled), 7)
+        self.assertEqual(list(spilled), rows)
+
+        spilled.delete()
+        self.assertFalse(spilled.exists())
+
+    @override_settings(SERRANO_JOB_SPILL_ROWS=None)
+    def test_disabled(self):
+        self.assertEqual(len(spill_rows(iter([(1,)] * 5))), 5)
+
+
+class ServerSideIterableTestCase(TestCase):
+    def test_slice(self):
+        for name in ('a', 'b', 'c', 'd'):
+            User.objects.create_user(username=name)
+
+        get_iterable = get_server_side_iterable(QueryProcessor())
+        queryset = User.objects.order_by('username')\
+            .values_list('username')
+
+        self.assertEqual(list(get_iterable(queryset, offset=1, limit=2)),
+                         [('b',), ('c',)])
+        self.assertEqual(list(get_iterable(queryset, offset=3)), [('d',)])
+        self.assertEqual(list(get_iterable(queryset, limit=1)), [('a',)])
+
+    def test_processor_iterable(self):
+        class ListQueryProcessor(QueryProcessor):
+            def get_iterable(self, *args, **kwargs):
+                return [('a',)]
+
+        # The iterable of a processor that overrides it is used as is.
+        processor = ListQueryProcessor()
+        self.assertEqual(get_server_side_iterable(processor),
+                         processor.get_iterable)
+
+    def test_cursor_transaction_compat(self):
+        User.objects.create_user(username='a')
+
+        # Django 1.5 does not have `atomic`.
+        atomic = transaction.atomic
+        del transaction.atomic
+
+        try:
+            with cursor_transaction('default'):
+                names = list(User.objects.values_list('username',
+                                                      flat=True))
+        finally:
+            transaction.atomic = atomic
+
+        self.assertEqual(names, ['a'])
+
+
+class SplitPagesTestCase(TestCase):
+    def test_split(self):
+        self.assertEqual(split_pages(1, 10, 4),
+                         [(1, 3), (4, 6), (7, 9), (10, 10)])
+        self.assertEqual(split_pages(3, 4, 4), [(3, 3), (4, 4)])
+        self.assertEqual(split_pages(2, 5, 1), [(2, 5)])
+
+
+class HyperLogLogTestCase(TestCase):
+    def test_count(self):
+        sketch = HyperLogLog(12)
+        sketch.update(range(20000))
+
+        # Within three standard errors.
+        error = abs(sketch.count() - 20000) / 20000.0
+        self.assertTrue(error < 3 * sketch.error)
+
+        # Small counts are exact for practical purposes.
+        sketch = HyperLogLog(12)
+        sketch.update(['a', 'b', 'c', 'a'])
+        self.assertEqual(sketch.count(), 3)
+
+    def test_merge(self):
+        a = HyperLogLog(10)
+        a.update(range(0, 3000))
+
+        b = HyperLogLog(10)
+        b.update(range(2000, 5000))
+
+        union = HyperLogLog(10)
+        union.update(range(0, 5000))
+
+        a.merge(b)
+        self.assertEqual(a.registers, union.registers)
+
+        self.assertRaises(ValueError, a.merge, HyperLogLog(11))
+
+    def test_pickle(self):
+        sketch = HyperLogLog(8)
+        sketch.update(range(100))
+
+        other = pickle.loads(pickle.dumps(sketch))
+        self.assertEqual(other.precision, 8)
+        self.assertEqual(other.registers, sketch.registers)
+
+
+class LabelMapTestCase(TestCase):
+    def test_lookup(self):
+        labels = LabelMap([(3, u'Three'), (1, u'One'), (None, u'Unknown'),
+                           (2, u'Two')])
+
+        self.assertEqual(labels.values, (1, 2, 3))
+        self.assertEqual(len(labels), 4)
+        self.assertEqual(labels[2], u'Two')
+        self.assertEqual(labels.get(None), u'Unknown')
+        self.assertEqual(labels.get(4, u'4'), u'4')
+        self.assertTrue(1 in labels)
+        self.assertFalse(0 in labels)
+        self.assertRaises(KeyError, lambda: labels[5])
+
+        # Values that cannot be compared are not found.
+        self.assertEqual(labels.get(datetime.date.today()), None)
+
+    def test_pickle(self):
+        labels = LabelMap([('a', u'A'), ('b', u'B')])
+
+        other = pickle.loads(pickle.dumps(labels, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(other.values, ('a', 'b'))
+        self.assertEqual(other['b'], u'B')
+
+    def test_chunked(self):
+        cache = get_cache('django.core.cache.backends.locmem.LocMemCache')
+        labels = LabelMap([(i, unicode(i)) for i in range(1000)])
+
+        set_chunked(cache, 'labels', labels, chunk_size=1000)
+
+        self.assertTrue(cache.get('labels') > 1)
+        self.assertEqual(get_chunked(cache, 'labels')[999], u'999')
+
+        # Objects missing a chunk are not read.
+        cache.delete('labels:1')
+        self.assertEqual(get_chunked(cache, 'labels'), None)
+
+
+class ReservoirSampleTestCase(TestCase):
+    def test_sample(self):
+        sample = reservoir_sample(iter(range(1000)), 10,
+                                  rand=random.Random(0))
+        self.assertEqual(len(sample), 10)
+        self.assertEqual(len(set(sample)), 10)
+
+        # Not just the first items.
+        self.assertNotEqual(sample, range(10))
+
+        # Smaller populations are returned whole.
+        self.assertEqual(reservoir_sample(iter(range(3)), 10), [0, 1, 2])
+
+
+@unittest.skipUnless(dep_supported('numpy'), 'NumPy is not installed')
+class ClusteringTestCase(TestCase):
+    def setUp(self):
+        self.rows = []
+
+        for i in range(600):
+            center = (i % 3) * 50
+            self.rows.append((1 + i % 5, center + i % 7, center * 2 - i % 4))
+
+        self.rows.append((1, 10000, 10000))
+
+    def test_find_outliers(self):
+        import numpy
+        from serrano.clustering import find_outliers
+
+        obs = [row[1:] for row in self.rows]
+
+        self.assertEqual(list(find_outliers(numpy.array(obs, dtype=float))),
+                         kmeans.find_outliers(obs, normalized=False))
+
+    def test_cluster_rows(self):
+        from serrano.clustering import cluster_rows
+
+        rows = self.rows + [(2, None, 5)]
+        points, outliers = cluster_rows(rows, True, 3)
+
+        # The values of the rows are returned, not their float conversions.
+        self.assertEqual(outliers, [[10000, 10000]])
+        self.assertTrue(isinstance(outliers[0][0], int))
+
+        # Three clusters followed by the point with a null value.
+        self.assertEqual(len(points), 4)
+        self.assertEqual(points[-1], {'count': 2, 'values': [None, 5]})
+
+        centers = sorted([int(round(p['values'][0])) for p in points[:3]])
+        self.assertEqual(centers, [3, 53, 103])
+
+    def test_cluster_rows_not_clustered(self):
+        from serrano.clustering import cluster_rows
+
+        points, outliers = cluster_rows(self.rows, False)
+
+        self.assertEqual(len(points), 600)
+        self.assertEqual(points[0], {'count': 1, 'values': [0, 0]})
+        self.assertTrue(isinstance(points[0]['values'][0], int))
+        self.assertEqual(outliers, [{'count': 1, 'values': [10000, 10000]}])
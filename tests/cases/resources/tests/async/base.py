@@ -1,11 +1,18 @@
 import json
+import time
 import uuid
+import threading
 
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import Client, TestCase
+from django.test.utils import override_settings
 from django.http import HttpResponseRedirect
 from restlib2.http import codes
 
 from avocado.async import utils
+from serrano.resources.jobs import JOB_FINGERPRINT_KEY, JOB_RESERVE_KEY, \
+    get_job_fingerprint, get_or_create_job
 
 
 class JobTestCaseMixin(object):
@@ -81,6 +88,76 @@ class JobTestCase(TestCase, JobTestCaseMixin):
                                    HTTP_ACCEPT='application/json')
         self.assertEqual(response.status_code, codes.not_found)
 
+    def test_duplicate_job(self):
+        User.objects.create_user(username='test', password='test')
+        self.client.login(username='test', password='test')
+
+        job = self.request_and_assert_job('/api/async/preview/')
+
+        # An identical request while the job is pending redirects to it.
+        response = self.client.get('/api/async/preview/',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(
+            response['Location'],
+            'http://testserver/api/jobs/{0}/'.format(job.id))
+        self.assertEqual(utils.get_job_count(), 1)
+
+        # A different page range is a different job.
+        self.request_and_assert_job('/api/async/preview/2/')
+
+        # Once the job is deleted, a new job is created.
+        self.client.delete('/api/jobs/{0}/'.format(job.id))
+        response = self.client.get('/api/async/preview/',
+                                   HTTP_ACCEPT='application/json')
+        self.assertNotEqual(
+            response['Location'],
+            'http://testserver/api/jobs/{0}/'.format(job.id))
+
+    @override_settings(SERRANO_SHARE_ASYNC_JOBS=True)
+    def test_shared_job(self):
+        User.objects.create_user(username='a', password='a')
+        User.objects.create_user(username='b', password='b')
+
+        self.client.login(username='a', password='a')
+        response = self.client.get('/api/async/preview/',
+                                   HTTP_ACCEPT='application/json')
+        location = response['Location']
+        job_id = location.split('/')[-2]
+
+        other = Client()
+        other.login(username='b', password='b')
+        response = other.get('/api/async/preview/',
+                             HTTP_ACCEPT='application/json')
+        self.assertEqual(response['Location'], location)
+
+        # The job is only canceled once neither requester references it.
+        self.client.delete('/api/jobs/{0}/'.format(job_id))
+        self.assertFalse(utils.get_job(job_id) is None)
+
+        other.delete('/api/jobs/{0}/'.format(job_id))
+        self.assertTrue(utils.get_job(job_id) is None)
+
+    def test_reserved_job(self):
+        response = self.client.get('/api/async/preview/',
+                                   HTTP_ACCEPT='application/json')
+        job_id = response['Location'].split('/')[-2]
+
+        fingerprint = get_job_fingerprint(None, None, {}, {})
+        reserve_key = JOB_RESERVE_KEY.format(fingerprint)
+        cache.add(reserve_key, 1)
+
+        def create():
+            time.sleep(0.2)
+            cache.set(JOB_FINGERPRINT_KEY.format(fingerprint), job_id)
+            cache.delete(reserve_key)
+
+        # A request for a reserved fingerprint waits for the job being
+        # created rather than creating another one.
+        creator = threading.Thread(target=create)
+        creator.start()
+        self.assertEqual(get_or_create_job(None, None, {}, {}), job_id)
+        creator.join()
+
     def test_delete_invalid_job(self):
         # Trying to delete a job that is not in the queue should result in
         # a 404 not found response.
@@ -1,5 +1,6 @@
 import json
 import time
+import threading
 
 from django.contrib.auth.models import User
 from django.http import HttpResponseRedirect
@@ -7,6 +8,8 @@ from django.test import TestCase
 from restlib2.http import codes
 
 from avocado.async import utils
+from serrano.tasks import notify_job_done
+from tests.models import Employee
 from .base import JobTestCaseMixin
 from ..base import TransactionBaseTestCase
 
@@ -85,6 +88,126 @@ class AsyncPreviewResourceProcessorTestCase(
         content = json.loads(response.content)
         self.assertEqual(len(content['items']), 6)
 
+    def test_progress(self):
+        response = self.client.get('/api/async/preview/1/?limit=3',
+                                   HTTP_ACCEPT='application/json')
+        job_id = response['Location'].split('/')[-2]
+
+        # Pending jobs suggest when to poll again.
+        response = self.client.get('/api/jobs/{0}/'.format(job_id),
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse('progress' in json.loads(response.content))
+
+        utils.run_jobs()
+
+        response = self.client.get('/api/jobs/{0}/'.format(job_id),
+                                   HTTP_ACCEPT='application/json')
+        self.assertFalse(response.has_header('Retry-After'))
+
+        progress = json.loads(response.content)['progress']
+        self.assertEqual(progress['rows'], 3)
+        self.assertEqual(progress['total'], 3)
+        self.assertEqual(progress['page'], 1)
+        self.assertEqual(progress['remaining'], 0)
+
+    def test_result_model(self):
+        response = self.client.get('/api/async/preview/1/?limit=3',
+                                   HTTP_ACCEPT='application/json')
+        job_id = response['Location'].split('/')[-2]
+
+        utils.run_jobs()
+
+        # The queryset is not stored with the result since pickling it
+        # evaluates the whole query.
+        result = utils.get_job(job_id).result
+        self.assertEqual(result['queryset'], None)
+        self.assertEqual(result['model'], Employee)
+
+        response = self.client.get('/api/jobs/{0}/result/'.format(job_id),
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['item_name'],
+                         'employee')
+
+    def test_wait(self):
+        response = self.client.get('/api/async/preview/1/?limit=3',
+                                   HTTP_ACCEPT='application/json')
+        job_id = response['Location'].split('/')[-2]
+
+        # Not done within the wait time.
+        response = self.client.get(
+            '/api/jobs/{0}/result/?wait=1'.format(job_id),
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.not_found)
+
+        responses = []
+
+        def wait():
+            responses.append(self.client.get(
+                '/api/jobs/{0}/result/?wait=10'.format(job_id),
+                HTTP_ACCEPT='application/json'))
+
+        # Run the job while the request is waiting. The worker must run in
+        # the main thread.
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        time.sleep(0.5)
+        utils.run_jobs()
+        waiter.join()
+
+        self.assertEqual(responses[0].status_code, codes.ok)
+        self.assertEqual(
+            len(json.loads(responses[0].content)['items']), 3)
+
+    def test_wait_result_stored(self):
+        response = self.client.get('/api/async/preview/1/?limit=3',
+                                   HTTP_ACCEPT='application/json')
+        job_id = response['Location'].split('/')[-2]
+
+        # The job notifies waiters before the worker stores its result.
+        notify_job_done(job_id)
+
+        responses = []
+
+        def wait():
+            responses.append(self.client.get(
+                '/api/jobs/{0}/result/?wait=10'.format(job_id),
+                HTTP_ACCEPT='application/json'))
+
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        time.sleep(1.5)
+        utils.run_jobs()
+        waiter.join()
+
+        self.assertEqual(responses[0].status_code, codes.ok)
+
+    def test_wait_failed(self):
+        response = self.client.get(
+            '/api/async/preview/?processor=failing',
+            HTTP_ACCEPT='application/json')
+        job_id = response['Location'].split('/')[-2]
+
+        responses = []
+
+        def wait():
+            responses.append(self.client.get(
+                '/api/jobs/{0}/?wait=10'.format(job_id),
+                HTTP_ACCEPT='application/json'))
+
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        time.sleep(0.5)
+
+        start = time.time()
+        utils.run_jobs()
+        waiter.join()
+
+        # The waiter returns as soon as the job fails.
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(
+            json.loads(responses[0].content)['status'], 'failed')
+
 
 class AsyncPreviewResourceTestCase(TestCase, JobTestCaseMixin):
     def setUp(self):
@@ -3,14 +3,20 @@ import time
 
 from django.contrib.auth.models import User
 from django.core import management
+from django.core.cache import cache
 from django.test import TestCase, TransactionTestCase
+from django.test.client import RequestFactory
 from django.test.utils import override_settings
 from restlib2.http import codes
 
 from avocado.history.models import Revision
 from avocado.models import DataField, DataView, DataContext
+from serrano.forms import ContextForm
 from serrano.models import ApiToken
 from serrano.resources import API_VERSION
+from serrano.resources.base import _limited_clients, get_request_context, \
+    get_request_count, incr_request_count, \
+    get_request_lookups, get_request_query
 
 
 class BaseTestCase(TestCase):
@@ -124,6 +130,65 @@ class RootResourceTestCase(TestCase):
         self.assertEqual(response.status_code, codes.ok)
 
 
+class RequestObjectTestCase(BaseTestCase):
+    def test_memoized(self):
+        DataContext(user=self.user, session=True).save()
+
+        request = RequestFactory().get('/')
+        request.user = self.user
+
+        with self.assertNumQueries(1):
+            context = get_request_context(request)
+            self.assertTrue(get_request_context(request) is context)
+
+        self.assertEqual(get_request_lookups(request),
+                         {'hits': 1, 'misses': 1})
+
+        # The query resolves the same context and view.
+        query = get_request_query(request)
+        self.assertEqual(query.context_json, context.json)
+        self.assertEqual(get_request_lookups(request),
+                         {'hits': 2, 'misses': 3})
+
+        # Objects built from attributes are not cached.
+        self.assertFalse(get_request_context(request, attrs={}) is
+                         get_request_context(request, attrs={}))
+
+    def test_session_object_cache(self):
+        DataContext(user=self.user, session=True).save()
+
+        request = RequestFactory().get('/')
+        request.user = self.user
+        context = get_request_context(request)
+
+        # Later requests read the session context from the cache.
+        request = RequestFactory().get('/')
+        request.user = self.user
+
+        with self.assertNumQueries(0):
+            self.assertEqual(get_request_context(request).pk, context.pk)
+
+        # Saving the context through the form invalidates the cache.
+        form = ContextForm(request, {'json': {'type': 'and', 'children': []},
+                                     'session': True}, instance=context)
+        self.assertTrue(form.is_valid())
+        form.save()
+
+        request = RequestFactory().get('/')
+        request.user = self.user
+        self.assertEqual(get_request_context(request).json,
+                         {'type': 'and', 'children': []})
+
+        # Deleting the owner deletes the context, so an owner that reuses
+        # the ID does not read the cached context.
+        pk = self.user.pk
+        self.user.delete()
+
+        request = RequestFactory().get('/')
+        request.user = User.objects.create_user(username='reused', pk=pk)
+        self.assertEqual(get_request_context(request).pk, None)
+
+
 @override_settings(SERRANO_RATE_LIMIT_COUNT=None)
 class ThrottledResourceTestCase(BaseTestCase):
     def test_too_many_auth_requests(self):
@@ -164,6 +229,49 @@ class ThrottledResourceTestCase(BaseTestCase):
                                        HTTP_ACCEPT='application/json')
             self.assertEqual(response.status_code, codes.ok)
 
+    @override_settings(SERRANO_RATE_LIMIT_LOCAL_SECONDS=60)
+    def test_local_limit(self):
+        f = DataField.objects.all()[0]
+        url = '/api/fields/{0}/'.format(f.pk)
+        key = 'serrano:rate_limit:auth:{0}'.format(self.user.pk)
+
+        self.client.login(username='root', password='password')
+        cache.clear()
+
+        try:
+            for _ in range(40):
+                response = self.client.get(url,
+                                           HTTP_ACCEPT='application/json')
+                self.assertEqual(response.status_code, codes.ok)
+
+            response = self.client.get(url, HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, codes.too_many_requests)
+            self.assertEqual(get_request_count(key, 6), 41)
+
+            # The process rejects the client without checking the cache.
+            cache.clear()
+
+            response = self.client.get(url, HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, codes.too_many_requests)
+            self.assertEqual(get_request_count(key, 6), 0)
+        finally:
+            _limited_clients.clear()
+
+    def test_sliding_window(self):
+        key = 'serrano:rate_limit:test'
+        cache.clear()
+
+        for i in range(1, 6):
+            self.assertEqual(incr_request_count(key, 2, buckets=10), i)
+
+        # The window slides rather than restarting, so requests at the end
+        # of one window are counted at the start of the next.
+        time.sleep(1)
+        self.assertEqual(incr_request_count(key, 2, buckets=10), 6)
+
+        time.sleep(1.5)
+        self.assertEqual(incr_request_count(key, 2, buckets=10), 2)
+
     def test_too_many_requests(self):
         f = DataField.objects.all()[0]
 
@@ -1,6 +1,9 @@
 import json
+import zlib
 from django.test import TestCase
+from django.test.utils import override_settings
 from restlib2.http import codes
+from avocado.async import utils
 from avocado.conf import OPTIONAL_DEPS
 from serrano.resources import API_VERSION
 
@@ -75,3 +78,61 @@ class ExporterResourceTestCase(TestCase):
     def test_export_bad_page_range(self):
         response = self.client.get('/api/data/export/csv/3...1/')
         self.assertEqual(response.status_code, codes.not_found)
+
+    def test_export_streaming(self):
+        response = self.client.get('/api/data/export/csv/')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertTrue(response.streaming)
+        self.assertFalse(response.has_header('Content-Length'))
+
+        # The header row is always written.
+        content = b''.join(response.streaming_content)
+        self.assertTrue(content.splitlines())
+
+    @override_settings(SERRANO_STREAMING_EXPORT_TYPES=())
+    def test_export_not_streaming(self):
+        response = self.client.get('/api/data/export/csv/')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertFalse(response.streaming)
+        self.assertEqual(response.get('Content-Type'), 'text/csv')
+
+    def test_export_gzip(self):
+        response = self.client.get('/api/data/export/csv/?gzip=true')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertTrue(response.get('Content-Disposition').endswith(
+            '.csv.gz"'))
+        self.assertEqual(response.get('Content-Type'), 'application/gzip')
+
+        content = b''.join(response.streaming_content)
+        self.assertTrue(zlib.decompress(content, 16 + zlib.MAX_WBITS))
+
+    def test_export_content_encoding(self):
+        response = self.client.get('/api/data/export/csv/',
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response.get('Content-Type'), 'text/csv')
+
+    @override_settings(SERRANO_EXPORT_PARALLEL_JOBS=2)
+    def test_export_parallel(self):
+        response = self.client.get('/api/data/export/csv/1...3/?limit=2')
+        expected = b''.join(response.streaming_content)
+
+        initial_count = utils.get_job_count()
+
+        response = self.client.get(
+            '/api/data/export/csv/1...3/?limit=2&parallel=true')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertTrue(response.get('Content-Disposition').startswith(
+            'attachment; filename="p1-3'))
+
+        # The pages are split into at most EXPORT_PARALLEL_JOBS ranges.
+        self.assertEqual(utils.get_job_count(), initial_count + 2)
+        utils.run_jobs()
+
+        # Pages are concatenated in order.
+        self.assertEqual(b''.join(response.streaming_content), expected)
+
+    def test_export_parallel_bad_page_range(self):
+        response = self.client.get('/api/data/export/csv/3...1/?parallel=1')
+        self.assertEqual(response.status_code, codes.not_found)
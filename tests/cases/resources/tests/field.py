@@ -1,8 +1,20 @@
 import json
+import shutil
+import tempfile
+from StringIO import StringIO
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connections
 from django.test.utils import override_settings
+from avocado.core.cache import cache_key
 from avocado.models import DataField
 from avocado.events.models import Log
+from avocado.query.pipeline import QueryProcessor
 from restlib2.http import codes
+from serrano.cubes import Cube
+from serrano.index import clear_indexes, get_index
+from serrano.labels import get_label_map_key
+from serrano.resources.field.values import FieldValues
 from .base import BaseTestCase
 from tests.models import Title
 
@@ -191,6 +203,110 @@ class FieldResourceTestCase(BaseTestCase):
         self.assertTrue(content['items'])
         self.assertTrue(len(content['items']), 1)
 
+    def test_values_paginated(self):
+        f2 = DataField.objects.get_by_natural_key('tests',
+                                                  'title',
+                                                  'name')
+
+        response = self.client.get('/api/fields/{0}/values/?limit=3&page=2'
+                                   .format(f2.pk),
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        data = json.loads(response.content)
+        self.assertEqual(data['count'], 7)
+        self.assertEqual(data['num_pages'], 3)
+        self.assertEqual(data['items'], [
+            {'label': 'IT', 'value': 'IT'},
+            {'label': 'Lawyer', 'value': 'Lawyer'},
+            {'label': 'Programmer', 'value': 'Programmer'},
+        ])
+        self.assertTrue('prev' in response['Link'])
+        self.assertTrue('next' in response['Link'])
+
+    @override_settings(SERRANO_PAGINATOR_APPROXIMATE_COUNTS=True)
+    def test_values_approximate_count(self):
+        f2 = DataField.objects.get_by_natural_key('tests',
+                                                  'title',
+                                                  'name')
+
+        # Prime the last-known count for the values queryset and hold the
+        # refresh lock to prevent the background count.
+        queryset = QueryProcessor(tree=Title).get_queryset()
+        values = FieldValues().get_all_values(None, f2, queryset)
+        key = cache_key('paginator', kwargs={'queryset': values.queryset})
+        cache.delete(key)
+        cache.set(key + ':last', 5)
+        cache.set(key + ':lock', True)
+
+        response = self.client.get('/api/fields/{0}/values/?limit=3&page=2'
+                                   .format(f2.pk),
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        data = json.loads(response.content)
+        self.assertEqual(data['count'], 5)
+        self.assertTrue(data['approximate'])
+
+        # Pages are not truncated to the estimated count.
+        self.assertEqual(len(data['items']), 3)
+        self.assertTrue('rel="next"' in response['Link'])
+
+        # The exact count is used once it is available.
+        cache.set(key, 7)
+
+        response = self.client.get('/api/fields/{0}/values/?limit=3&page=2'
+                                   .format(f2.pk),
+                                   HTTP_ACCEPT='application/json')
+        data = json.loads(response.content)
+        self.assertEqual(data['count'], 7)
+        self.assertFalse('approximate' in data)
+
+        cache.delete_many([key, key + ':last', key + ':lock'])
+
+    def test_values_cursor(self):
+        f2 = DataField.objects.get_by_natural_key('tests',
+                                                  'title',
+                                                  'name')
+        url = '/api/fields/{0}/values/'.format(f2.pk)
+
+        # An empty cursor denotes the first page.
+        response = self.client.get(url + '?limit=3&after=',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        data = json.loads(response.content)
+        self.assertFalse('count' in data)
+        self.assertEqual([x['value'] for x in data['items']],
+                         ['Analyst', 'CEO', 'Guard'])
+        self.assertIsNone(data['prev_cursor'])
+        self.assertTrue('rel="next"' in response['Link'])
+        self.assertFalse('rel="last"' in response['Link'])
+
+        response = self.client.get(
+            url + '?limit=3&after={0}'.format(data['next_cursor']),
+            HTTP_ACCEPT='application/json')
+        data = json.loads(response.content)
+        self.assertEqual([x['value'] for x in data['items']],
+                         ['IT', 'Lawyer', 'Programmer'])
+
+        # Page backwards from the second page.
+        previous = self.client.get(
+            url + '?limit=3&before={0}'.format(data['prev_cursor']),
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(
+            [x['value'] for x in json.loads(previous.content)['items']],
+            ['Analyst', 'CEO', 'Guard'])
+
+        response = self.client.get(
+            url + '?limit=3&after={0}'.format(data['next_cursor']),
+            HTTP_ACCEPT='application/json')
+        data = json.loads(response.content)
+        self.assertEqual([x['value'] for x in data['items']], ['QA'])
+        self.assertIsNone(data['next_cursor'])
+        self.assertFalse('rel="next"' in response['Link'])
+
+        response = self.client.get(url + '?after=invalid',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.unprocessable_entity)
+
     def test_values_no_limit(self):
         f2 = DataField.objects.get_by_natural_key('tests',
                                                   'title',
@@ -245,6 +361,37 @@ class FieldResourceTestCase(BaseTestCase):
         self.assertEqual(response.status_code, codes.ok)
         self.assertEqual(len(json.loads(response.content)), 1)
 
+    @override_settings(AVOCADO_DATA_CACHE_ENABLED=True)
+    def test_values_random_labels(self):
+        f2 = DataField.objects.get_by_natural_key('tests',
+                                                  'title',
+                                                  'name')
+        cache.clear()
+
+        response = self.client.get('/api/fields/{0}/values/?random=2'
+                                   .format(f2.pk),
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+
+        for item in json.loads(response.content):
+            self.assertEqual(item['label'], item['value'])
+
+        # Only the sampled values are labeled, the map of all of the
+        # field's labels is not built.
+        self.assertEqual(cache.get(get_label_map_key(f2)), None)
+
+    def test_values_random_invalid(self):
+        f2 = DataField.objects.get_by_natural_key('tests',
+                                                  'title',
+                                                  'name')
+
+        for random in (-1, 0):
+            response = self.client.get(
+                '/api/fields/{0}/values/?random={1}'.format(f2.pk, random),
+                HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code,
+                             codes.unprocessable_entity)
+
     def test_values_query(self):
         f2 = DataField.objects.get_by_natural_key('tests',
                                                   'title',
@@ -275,6 +422,59 @@ class FieldResourceTestCase(BaseTestCase):
             {'label': 'QA', 'value': 'QA'},
         ])
 
+    @override_settings(SERRANO_FIELD_VALUE_INDEX='serrano.index.NgramIndex')
+    def test_values_query_index(self):
+        f2 = DataField.objects.get_by_natural_key('tests',
+                                                  'title',
+                                                  'name')
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        with self.settings(SERRANO_FIELD_VALUE_INDEX_DIR=directory):
+            clear_indexes()
+
+            # Indexes are not built in the request.
+            self.assertEqual(get_index(f2), None)
+
+            call_command('build_indexes', 'tests.title.name',
+                         stdout=StringIO())
+
+            # Indexes are loaded from their files by processes without them.
+            clear_indexes()
+            self.assertTrue(get_index(f2) is not None)
+
+        response = self.client.get('/api/fields/{0}/values/?query=a'
+                                   .format(f2.pk),
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertEqual(json.loads(response.content)['items'], [
+            {'label': 'Analyst', 'value': 'Analyst'},
+            {'label': 'Guard', 'value': 'Guard'},
+            {'label': 'Lawyer', 'value': 'Lawyer'},
+            {'label': 'Programmer', 'value': 'Programmer'},
+            {'label': 'QA', 'value': 'QA'},
+        ])
+
+        # Longer terms are matched on the intersection of their grams.
+        response = self.client.get('/api/fields/{0}/values/?query=RAMM'
+                                   .format(f2.pk),
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['items'], [
+            {'label': 'Programmer', 'value': 'Programmer'},
+        ])
+
+        # Restricted querysets are intersected with the index results.
+        response = self.client.get(
+            '/api/fields/{0}/values/?query=a&processor=under_twenty_thousand'
+            .format(f2.pk),
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertEqual(json.loads(response.content)['items'], [
+            {'label': 'Guard', 'value': 'Guard'},
+            {'label': 'Programmer', 'value': 'Programmer'},
+            {'label': 'QA', 'value': 'QA'},
+        ])
+
     def test_values_validate(self):
         f2 = DataField.objects.get_by_natural_key('tests',
                                                   'title',
@@ -382,6 +582,67 @@ class FieldResourceTestCase(BaseTestCase):
             {'value': 'Programmer', 'label': 'Programmer', 'valid': True},
         ])
 
+    @override_settings(SERRANO_VALUES_VALIDATE_CHUNK_SIZE=2)
+    def test_bulk_validate(self):
+        f2 = DataField.objects.get_by_natural_key('tests',
+                                                  'title',
+                                                  'name')
+        data = [
+            {'label': 'IT'},
+            {'value': 'Bartender'},
+            {'value': 'Programmer'},
+            {'value': 'IT'},
+            {'label': 'Analyst'},
+        ]
+
+        # Without bulk, the chunks are validated the same way.
+        response = self.client.post(
+            '/api/fields/{0}/values/'.format(f2.pk),
+            data=json.dumps(data),
+            content_type='application/json',
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        values = json.loads(response.content)
+        self.assertEqual([v['valid'] for v in values],
+                         [True, False, True, True, True])
+
+        response = self.client.post(
+            '/api/fields/{0}/values/?bulk=1'.format(f2.pk),
+            data=json.dumps(data),
+            content_type='application/json',
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertTrue(response.streaming)
+
+        content = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(content['values'], values)
+        self.assertEqual(content['valid'], 4)
+        self.assertEqual(content['invalid'], 1)
+
+    def test_multiple_labels_validate(self):
+        f = DataField.objects.get_by_natural_key('tests', 'title', 'salary')
+        f.label_field_name = 'name'
+        f.save()
+
+        # Programmer, QA and IT share the same salary.
+        response = self.client.post(
+            '/api/fields/{0}/values/'.format(f.pk),
+            data=json.dumps([
+                {'label': 'Programmer'},
+                {'label': 'QA'},
+                {'label': 'IT'},
+                {'value': 15000},
+            ]),
+            content_type='application/json',
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertEqual(json.loads(response.content), [
+            {'label': 'Programmer', 'value': 15000, 'valid': True},
+            {'label': 'QA', 'value': 15000, 'valid': True},
+            {'label': 'IT', 'value': 15000, 'valid': True},
+            {'label': 'IT', 'value': 15000, 'valid': True},
+        ])
+
     def test_stats(self):
         f2 = DataField.objects.get_by_natural_key('tests',
                                                   'title',
@@ -409,6 +670,14 @@ class FieldResourceTestCase(BaseTestCase):
         self.assertEqual(stats['min'], 10000)
         self.assertEqual(stats['max'], 200000)
         self.assertAlmostEqual(stats['avg'], 53571.42857, places=5)
+        self.assertEqual(stats['count'], 7)
+        self.assertEqual(stats['null_count'], 0)
+
+        # Quantiles are within a bucket width of the exact values.
+        width = (200000 - 10000) / 100.0
+        self.assertTrue(abs(stats['quantiles']['0.25'] - 15000) <= width)
+        self.assertTrue(abs(stats['quantiles']['0.5'] - 15000) <= width)
+        self.assertTrue(abs(stats['quantiles']['0.75'] - 100000) <= width)
 
         # Using an invalid query processor should fall back to the default.
         response = self.client.get('/api/fields/{0}/stats/?processor=INVALID'
@@ -445,6 +714,50 @@ class FieldResourceTestCase(BaseTestCase):
         self.assertEqual(stats['min'], '2000-01-01')
         self.assertEqual(stats['max'], '2010-01-01')
 
+    def test_stats_data_cache_disabled(self):
+        f = DataField.objects.get_by_natural_key('tests', 'title', 'salary')
+        url = '/api/fields/{0}/stats/'.format(f.pk)
+
+        self.client.get(url, HTTP_ACCEPT='application/json')
+
+        # Stats are not cached when Avocado's data cache is disabled, so
+        # changes are reflected without a new data version.
+        Title.objects.filter(salary=200000).update(salary=300000)
+
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(json.loads(response.content)['max'], 300000)
+
+    @override_settings(SERRANO_STATS_SKETCH_PARTITIONS=1)
+    def test_approx_stats(self):
+        f = DataField.objects.get_by_natural_key('tests', 'title', 'name')
+
+        url = '/api/fields/{0}/stats/?approx=true'.format(f.pk)
+
+        # The sketch is not built in the request. The exact count is
+        # returned until it is built.
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+
+        stats = json.loads(response.content)
+        self.assertEqual(stats['count'], f.count(distinct=True))
+        self.assertFalse(stats['approx'])
+
+        call_command('build_sketches', 'tests.title.name', stdout=StringIO())
+
+        response = self.client.get(url, HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+
+        stats = json.loads(response.content)
+        self.assertEqual(stats['count'], f.count(distinct=True))
+        self.assertTrue(stats['approx'])
+        self.assertTrue(0 < stats['error'] < 0.05)
+
+        # Filtered querysets are only estimated on PostgreSQL.
+        if connections['default'].vendor != 'postgresql':
+            response = self.client.get(url + '&processor=manager',
+                                       HTTP_ACCEPT='application/json')
+            self.assertFalse(json.loads(response.content)['approx'])
+
     def test_empty_stats(self):
         f2 = DataField.objects.get_by_natural_key('tests',
                                                   'title',
@@ -497,27 +810,166 @@ class FieldResourceTestCase(BaseTestCase):
             {'label': '15000', 'value': 15000, 'count': 1},
         ])
 
+    def test_dist_bins(self):
+        f = DataField.objects.get_by_natural_key('tests', 'title', 'salary')
+        url = '/api/fields/{0}/dist/'.format(f.pk)
+
+        response = self.client.get(url + '?bins=2',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+
+        content = json.loads(response.content)
+        self.assertEqual([b['count'] for b in content], [6, 1])
+        self.assertEqual(content[0]['min'], 10000)
+        self.assertEqual(content[0]['max'], 105000)
+        self.assertEqual(content[1]['max'], 200000)
+
+        # Empty bins are included.
+        response = self.client.get(url + '?bin_width=50000',
+                                   HTTP_ACCEPT='application/json')
+        content = json.loads(response.content)
+        self.assertEqual([b['count'] for b in content], [5, 1, 0, 1])
+        self.assertEqual([b['value'] for b in content],
+                         [10000, 60000, 110000, 160000])
+
+        with self.settings(SERRANO_DIST_MAXIMUM_BINS=3):
+            response = self.client.get(url + '?bin_width=50000',
+                                       HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code,
+                             codes.unprocessable_entity)
+
+        # Zero is not ignored.
+        for param in ('bins', 'bin_width'):
+            response = self.client.get(url + '?{0}=0'.format(param),
+                                       HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code,
+                             codes.unprocessable_entity)
+
+        # Intervals only apply to dates.
+        response = self.client.get(url + '?interval=year',
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.unprocessable_entity)
+
+        f = DataField.objects.get_by_natural_key('tests', 'project',
+                                                 'due_date')
+        response = self.client.get(
+            '/api/fields/{0}/dist/?interval=year'.format(f.pk),
+            HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, codes.ok)
+        self.assertEqual(json.loads(response.content), [
+            {'label': '2000', 'value': '2000-01-01', 'count': 1},
+            {'label': '2009', 'value': '2009-01-01', 'count': 1},
+            {'label': '2010', 'value': '2010-01-01', 'count': 1},
+        ])
+
+    def test_dims_cube(self):
+        f = DataField.objects.get_by_natural_key('tests', 'title', 'salary')
+        url = '/api/fields/{0}/dims/'.format(f.pk)
+
+        # The order of groups with the same count is not defined.
+        def get_dims():
+            response = self.client.get(url, HTTP_ACCEPT='application/json')
+            content = json.loads(response.content)
+            content['data'].sort(key=lambda p: (-p['count'], p['values']))
+            return content
+
+        expected = get_dims()
+
+        with self.settings(SERRANO_DIMS_CUBES=[['tests.title.salary',
+                                                'tests.title.name']]):
+            self.assertEqual(get_dims(), expected)
+
+            # The counts are stored until the data version changes.
+            Title.objects.filter(salary=10000).update(salary=15000)
+            self.assertEqual(get_dims(), expected)
+
+            f.data_version += 1
+            f.save()
+
+            point = get_dims()['data'][0]
+            self.assertEqual(point['count'], 4)
+            self.assertEqual(point['values'][0]['value'], 15000)
+
+    def test_cube_conditions(self):
+        salary = DataField.objects.get_by_natural_key('tests', 'title',
+                                                      'salary')
+        name = DataField.objects.get_by_natural_key('tests', 'title', 'name')
+
+        cube = Cube([salary, name])
+
+        self.assertEqual(cube.get_conditions(None), [])
+
+        # Conditions on fields outside of the cube or using unsupported
+        # operators cannot be evaluated.
+        self.assertEqual(cube.get_conditions({
+            'field': 'tests.employee.is_manager',
+            'operator': 'exact',
+            'value': True,
+        }), None)
+
+        self.assertEqual(cube.get_conditions({
+            'field': 'tests.title.name',
+            'operator': 'icontains',
+            'value': 'a',
+        }), None)
+
+        conditions = cube.get_conditions({
+            'type': 'and',
+            'children': [{
+                'field': 'tests.title.salary',
+                'operator': 'lt',
+                'value': 20000,
+            }, {
+                'field': name.pk,
+                'operator': '-exact',
+                'value': 'Programmer',
+            }],
+        })
+
+        rows = cube.rollup([salary], conditions)
+        queryset = Title.objects.filter(salary__lt=20000)\
+            .exclude(name='Programmer')
+
+        self.assertEqual(sum([r[0] for r in rows]),
+                         sum([t.employee_set.count() for t in queryset]))
+
     def test_dims(self):
         f3 = DataField.objects.get_by_natural_key('tests',
                                                   'title',
                                                   'salary')
 
+        # The order of groups with the same count is not defined. The types
+        # of the values are compared since ints and floats compare equal.
+        def get_content(response):
+            content = json.loads(response.content)
+            content['data'].sort(key=lambda p: (-p['count'], p['values']))
+
+            for point in content['data']:
+                for value in point['values']:
+                    value['type'] = type(value['value']).__name__
+
+            return content
+
         default_content = {
             u'size': 4,
             u'clustered': False,
             u'outliers': [],
             u'data': [{
                 u'count': 3,
-                u'values': [{'label': '15000', 'value': 15000}]
+                u'values': [{'label': '15000', 'value': 15000,
+                             'type': 'int'}]
             }, {
                 u'count': 1,
-                u'values': [{'label': '10000', 'value': 10000}]
+                u'values': [{'label': '10000', 'value': 10000,
+                             'type': 'int'}]
             }, {
                 u'count': 1,
-                u'values': [{'label': '20000', 'value': 20000}]
+                u'values': [{'label': '20000', 'value': 20000,
+                             'type': 'int'}]
             }, {
                 u'count': 1,
-                u'values': [{'label': '200000', 'value': 200000}]
+                u'values': [{'label': '200000', 'value': 200000,
+                             'type': 'int'}]
             }],
         }
 
@@ -525,7 +977,7 @@ class FieldResourceTestCase(BaseTestCase):
         response = self.client.get('/api/fields/{0}/dims/'.format(f3.pk),
                                    HTTP_ACCEPT='application/json')
         self.assertEqual(response.status_code, codes.ok)
-        self.assertEqual(json.loads(response.content), default_content)
+        self.assertEqual(get_content(response), default_content)
 
         event = Log.objects.filter(event='dims', object_id=f3.pk)
         self.assertTrue(event.exists())
@@ -535,7 +987,7 @@ class FieldResourceTestCase(BaseTestCase):
                                    .format(f3.pk),
                                    HTTP_ACCEPT='application/json')
         self.assertEqual(response.status_code, codes.ok)
-        self.assertEqual(json.loads(response.content), default_content)
+        self.assertEqual(get_content(response), default_content)
 
         # Using the custom query process, we should be limited to a smaller
         # salary set.
@@ -543,12 +995,13 @@ class FieldResourceTestCase(BaseTestCase):
                                    .format(f3.pk),
                                    HTTP_ACCEPT='application/json')
         self.assertEqual(response.status_code, codes.ok)
-        self.assertEqual(json.loads(response.content), {
+        self.assertEqual(get_content(response), {
             u'size': 1,
             u'clustered': False,
             u'outliers': [],
             u'data': [{
                 u'count': 1,
-                u'values': [{'label': '15000', 'value': 15000}]
+                u'values': [{'label': '15000', 'value': 15000,
+                             'type': 'int'}]
             }]
         })
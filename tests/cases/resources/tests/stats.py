@@ -1,7 +1,11 @@
 import json
 from django.core.cache import cache
+from django.db.models import F
+from django.test.utils import override_settings
 from restlib2.http import codes
-from tests.models import Title
+from avocado.models import DataField
+from serrano.resources import stats
+from tests.models import Project, Title
 from .base import BaseTestCase, TransactionBaseTestCase
 
 
@@ -65,6 +69,15 @@ class CountStatsResourceTestCase(TransactionBaseTestCase):
             'count': 2,
         }])
 
+    def test_get_empty_query_processor(self):
+        response = self.client.get('/api/stats/counts/?processor=empty',
+                                   HTTP_ACCEPT='application/json')
+
+        self.assertEqual(response.status_code, codes.ok)
+
+        counts = [m['count'] for m in json.loads(response.content)]
+        self.assertEqual(counts, [0, 0])
+
     def test_post_aware(self):
         context = {
             'field': 'tests.title.salary',
@@ -135,3 +148,87 @@ class CountStatsResourceTestCase(TransactionBaseTestCase):
             'verbose_name_plural': 'Titles',
             'count': 8,
         }])
+
+    @override_settings(SERRANO_STATS_COUNT_REQUEST_LIMIT=1,
+                       SERRANO_STATS_COUNT_BATCH_SIZE=0)
+    def test_pool(self):
+        stats.reset_pool_stats()
+
+        self.client.get('/api/stats/counts/', HTTP_ACCEPT='application/json')
+        pool = stats.get_pool()
+
+        response = self.client.get('/api/stats/counts/',
+                                   HTTP_ACCEPT='application/json')
+
+        # The same pool is used across requests.
+        self.assertTrue(stats.get_pool() is pool)
+
+        counts = [m['count'] for m in json.loads(response.content)]
+        self.assertEqual(counts, [3, 7])
+
+        pool_stats = stats.get_pool_stats()
+        self.assertEqual(pool_stats['submitted'], 4)
+        self.assertEqual(pool_stats['completed'], 4)
+        self.assertEqual(pool_stats['active'], 0)
+        self.assertEqual(pool_stats['queued'], 0)
+        self.assertEqual(pool_stats['peak_active'], 1)
+
+    def test_batch(self):
+        stats.reset_pool_stats()
+
+        response = self.client.get('/api/stats/counts/',
+                                   HTTP_ACCEPT='application/json')
+
+        counts = [m['count'] for m in json.loads(response.content)]
+        self.assertEqual(counts, [3, 7])
+
+        # Both counts are executed in a single task.
+        self.assertEqual(stats.get_pool_stats()['submitted'], 1)
+
+        # Cached counts are not executed again.
+        self.client.get('/api/stats/counts/', HTTP_ACCEPT='application/json')
+        self.assertEqual(stats.get_pool_stats()['submitted'], 1)
+
+    def test_request_limit(self):
+        # Defaults to half of the pool.
+        with self.settings(SERRANO_STATS_COUNT_WORKERS=4):
+            self.assertEqual(stats.get_request_limit(), 2)
+
+        with self.settings(SERRANO_STATS_COUNT_WORKERS=1):
+            self.assertEqual(stats.get_request_limit(), 1)
+
+        with self.settings(SERRANO_STATS_COUNT_REQUEST_LIMIT=3):
+            self.assertEqual(stats.get_request_limit(), 3)
+
+    def test_batch_counts(self):
+        querysets = [
+            Title.objects.all(),
+            Project.objects.none(),
+            Title.objects.filter(salary__gt=15000),
+        ]
+
+        self.assertEqual(stats.get_batch_counts(querysets), [7, 0, 3])
+
+    def test_data_version(self):
+        self.client.get('/api/stats/counts/', HTTP_ACCEPT='application/json')
+
+        Title(name='DevOps').save()
+
+        # Incrementing the data version of the fields invalidates the
+        # cached count of the model.
+        DataField.objects.filter(model_name='title')\
+            .update(data_version=F('data_version') + 1)
+
+        response = self.client.get('/api/stats/counts/',
+                                   HTTP_ACCEPT='application/json')
+
+        counts = [m['count'] for m in json.loads(response.content)]
+        self.assertEqual(counts, [3, 8])
+
+    def test_unfiltered_count(self):
+        self.assertTrue(stats.is_unfiltered(Title.objects.all()))
+        self.assertFalse(stats.is_unfiltered(
+            Title.objects.filter(salary__gt=15000)))
+
+        sql, params = stats.get_count_sql(Title.objects.all())
+        self.assertFalse('DISTINCT' in sql)
@@ -1,5 +1,7 @@
 from avocado.query.pipeline import QueryProcessor
+from rq import get_current_job
 from avocado.models import DataContext
+from serrano.tasks import get_connection
 
 
 class FirstTwoByIdQueryProcessor(QueryProcessor):
@@ -39,3 +41,21 @@ class ManagerQueryProcessor(QueryProcessor):
         })
 
         super(ManagerQueryProcessor, self).__init__(*args, **kwargs)
+
+
+class FailingQueryProcessor(QueryProcessor):
+    "Fails when the rows are read by a job."
+    def get_iterable(self, *args, **kwargs):
+        if get_current_job(connection=get_connection()) is not None:
+            raise ValueError('The query failed.')
+
+        return super(FailingQueryProcessor, self)\
+            .get_iterable(*args, **kwargs)
+
+
+class EmptyQueryProcessor(QueryProcessor):
+    def get_queryset(self, queryset=None, **kwargs):
+        queryset = super(EmptyQueryProcessor, self)\
+            .get_queryset(queryset, **kwargs)
+
+        return queryset.none()
@@ -1,4 +1,5 @@
 import os
+import uuid
 import getpass
 
 DATABASE_USER = os.environ.get('TEST_DATABASE_USER', getpass.getuser())
@@ -60,6 +61,9 @@ CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
         'LOCATION': '127.0.0.1:11211',
+        # The test database is recreated for each run while memcached
+        # persists, so keys are not shared across runs.
+        'KEY_PREFIX': 'serrano-tests-{0}'.format(uuid.uuid4().hex),
     }
 }
 
@@ -93,6 +97,8 @@ AVOCADO = {
         'under_twenty_thousand': 'tests.processors.UnderTwentyThousandQueryProcessor',  # noqa
         'first_title': 'tests.processors.FirstTitleQueryProcessor',
         'first_two': 'tests.processors.FirstTwoByIdQueryProcessor',
+        'failing': 'tests.processors.FailingQueryProcessor',
+        'empty': 'tests.processors.EmptyQueryProcessor',
     },
     'ASYNC_QUEUE': AVOCADO_QUEUE_NAME,
 }